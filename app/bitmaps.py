@@ -0,0 +1,300 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Bitmap indexes for filters on low cardinality fields
+
+Every indexed Promotion gets a dense ordinal (ordinals of deleted ones
+are reused) and each value of available, category and discount bucket
+keeps a Bitmap of the ordinals that have it. A filter expression such as
+
+    category:bogo AND (available:true OR NOT discount:0-10)
+
+is then worked out with whole-bitmap AND, OR and AND NOT operations
+and only the matching Promotions are read.
+
+A Bitmap is split into containers of CHUNK_BITS bits, each one a Python
+long, and containers with no bits set aren't stored, so sparse values
+take little memory and the operations run on machine words in C.
+"""
+
+import re
+import threading
+
+CHUNK_BITS = 1 << 16
+FIELDS = ('available', 'category', 'discount')
+DISCOUNT_BUCKETS = [0, 10, 25, 50, 100]    # discount:10-25 is 10 <= value < 25
+NO_DISCOUNT = 'none'
+
+_TOKENS = re.compile(r'\(|\)|[^\s()]+')
+
+
+def discount_bucket(value):
+    """ Returns the bucket label of a discount_value, e.g. '10-25' """
+    if value is None:
+        return NO_DISCOUNT
+    for low, high in zip(DISCOUNT_BUCKETS, DISCOUNT_BUCKETS[1:]):
+        if value < high:
+            return '{}-{}'.format(low, high)
+    return '{}+'.format(DISCOUNT_BUCKETS[-1])
+
+
+class Bitmap(object):
+    """ A set of ordinals stored as chunked bit strings """
+    __slots__ = ('chunks',)
+
+    def __init__(self, chunks=None):
+        self.chunks = chunks or {}     # chunk number -> long with the bits set
+
+    def add(self, ordinal):
+        """ Sets the bit of an ordinal """
+        key, bit = divmod(ordinal, CHUNK_BITS)
+        self.chunks[key] = self.chunks.get(key, 0) | (1 << bit)
+
+    def discard(self, ordinal):
+        """ Clears the bit of an ordinal """
+        key, bit = divmod(ordinal, CHUNK_BITS)
+        bits = self.chunks.get(key, 0) & ~(1 << bit)
+        if bits:
+            self.chunks[key] = bits
+        else:
+            self.chunks.pop(key, None)
+
+    def __contains__(self, ordinal):
+        key, bit = divmod(ordinal, CHUNK_BITS)
+        return bool(self.chunks.get(key, 0) >> bit & 1)
+
+    def __len__(self):
+        return sum(bin(bits).count('1') for bits in self.chunks.values())
+
+    def __iter__(self):
+        for key in sorted(self.chunks):
+            bits = self.chunks[key]
+            base = key * CHUNK_BITS
+            while bits:
+                lowest = bits & -bits
+                yield base + lowest.bit_length() - 1
+                bits ^= lowest
+
+    def __and__(self, other):
+        small, large = sorted((self.chunks, other.chunks), key=len)
+        chunks = {}
+        for key, bits in small.items():
+            both = bits & large.get(key, 0)
+            if both:
+                chunks[key] = both
+        return Bitmap(chunks)
+
+    def __or__(self, other):
+        chunks = dict(self.chunks)
+        for key, bits in other.chunks.items():
+            chunks[key] = chunks.get(key, 0) | bits
+        return Bitmap(chunks)
+
+    def __sub__(self, other):
+        chunks = {}
+        for key, bits in self.chunks.items():
+            rest = bits & ~other.chunks.get(key, 0)
+            if rest:
+                chunks[key] = rest
+        return Bitmap(chunks)
+
+
+def parse_filter(text):
+    """
+    Parses a filter expression into a tree of tuples
+
+        expression := term (OR term)*
+        term       := factor (AND factor)*
+        factor     := NOT factor | ( expression ) | field:value
+
+    :raises ValueError: if the expression is not valid
+    """
+    tokens = _TOKENS.findall(text or '')
+    if not tokens:
+        raise ValueError('filter is empty')
+    position = [0]
+
+    def peek():
+        """ Returns the next token in upper case or None """
+        return tokens[position[0]].upper() if position[0] < len(tokens) else None
+
+    def take():
+        """ Consumes and returns the next token """
+        position[0] += 1
+        return tokens[position[0] - 1]
+
+    def expression():
+        """ Parses terms joined by OR """
+        nodes = [term()]
+        while peek() == 'OR':
+            take()
+            nodes.append(term())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def term():
+        """ Parses factors joined by AND """
+        nodes = [factor()]
+        while peek() == 'AND':
+            take()
+            nodes.append(factor())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def factor():
+        """ Parses NOT, a bracketed expression or a field:value """
+        token = peek()
+        if token is None:
+            raise ValueError('filter ends too soon')
+        if token == 'NOT':
+            take()
+            return ('not', factor())
+        if token == '(':
+            take()
+            node = expression()
+            if peek() != ')':
+                raise ValueError('filter is missing a )')
+            take()
+            return node
+        field, _, value = take().partition(':')
+        field = field.lower()
+        if field not in FIELDS or not value:
+            raise ValueError('filter terms look like field:value where field is one of {}'
+                             .format(', '.join(FIELDS)))
+        return ('is', field, normalize_value(field, value))
+
+    node = expression()
+    if position[0] != len(tokens):
+        raise ValueError('unexpected {} in filter'.format(tokens[position[0]]))
+    return node
+
+
+def normalize_value(field, value):
+    """ Returns the indexed form of a filter value """
+    value = value.strip().lower()
+    if field == 'available':
+        if value not in ('true', 'false'):
+            raise ValueError('available must be true or false')
+        return value == 'true'
+    return value
+
+
+def document_values(document, discount_value):
+    """ Returns the indexed value of each field of a document """
+    return {
+        'available': bool(document.get('available')),
+        'category': (document.get('category') or '').strip().lower(),
+        'discount': discount_bucket(discount_value)
+    }
+
+
+def matches(node, values):
+    """ True if the indexed values of one document pass a parsed filter """
+    kind = node[0]
+    if kind == 'is':
+        return values[node[1]] == node[2]
+    if kind == 'not':
+        return not matches(node[1], values)
+    if kind == 'and':
+        return all(matches(child, values) for child in node[1])
+    return any(matches(child, values) for child in node[1])
+
+
+class BitmapIndex(object):
+    """ Bitmaps of the Promotions that have each field value """
+
+    def __init__(self):
+        self._ordinals = {}     # id -> ordinal
+        self._ids = []          # ordinal -> id, None when free
+        self._free = []         # ordinals of removed Promotions
+        self._values = {}       # ordinal -> indexed values
+        self._bitmaps = {}      # (field, value) -> Bitmap
+        self._live = Bitmap()   # every indexed ordinal
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ordinals)
+
+    def add(self, promotion_id, values):
+        """ Indexes (or reindexes) a Promotion with values from document_values() """
+        with self._lock:
+            ordinal = self._ordinals.get(promotion_id)
+            if ordinal is None:
+                ordinal = self._free.pop() if self._free else len(self._ids)
+                if ordinal == len(self._ids):
+                    self._ids.append(promotion_id)
+                else:
+                    self._ids[ordinal] = promotion_id
+                self._ordinals[promotion_id] = ordinal
+                self._live.add(ordinal)
+            else:
+                self._unset(ordinal)
+            self._values[ordinal] = values
+            for field, value in values.items():
+                self._bitmaps.setdefault((field, value), Bitmap()).add(ordinal)
+
+    def discard(self, promotion_id):
+        """ Removes a Promotion and frees its ordinal """
+        with self._lock:
+            ordinal = self._ordinals.pop(promotion_id, None)
+            if ordinal is None:
+                return
+            self._unset(ordinal)
+            self._values.pop(ordinal, None)
+            self._live.discard(ordinal)
+            self._ids[ordinal] = None
+            self._free.append(ordinal)
+
+    def clear(self):
+        """ Removes every Promotion """
+        with self._lock:
+            self._ordinals.clear()
+            self._ids = []
+            self._free = []
+            self._values.clear()
+            self._bitmaps.clear()
+            self._live = Bitmap()
+
+    def select(self, node):
+        """ Returns the ids of the Promotions that pass a parsed filter, in ordinal order """
+        with self._lock:
+            bitmap = self._evaluate(node)
+            return [self._ids[ordinal] for ordinal in bitmap]
+
+    def count(self, node):
+        """ Returns how many Promotions pass a parsed filter """
+        with self._lock:
+            return len(self._evaluate(node))
+
+    def _evaluate(self, node):
+        """ Works out the Bitmap of a parsed filter; the caller holds the lock """
+        kind = node[0]
+        if kind == 'is':
+            return self._bitmaps.get((node[1], node[2]), Bitmap())
+        if kind == 'not':
+            return self._live - self._evaluate(node[1])
+        bitmaps = [self._evaluate(child) for child in node[1]]
+        result = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            result = result & bitmap if kind == 'and' else result | bitmap
+        return result
+
+    def _unset(self, ordinal):
+        """ Clears an ordinal from the bitmaps of its values; the caller holds the lock """
+        for field, value in self._values.get(ordinal, {}).items():
+            bitmap = self._bitmaps.get((field, value))
+            if bitmap is not None:
+                bitmap.discard(ordinal)
+                if not bitmap.chunks:
+                    del self._bitmaps[(field, value)]
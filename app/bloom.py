@@ -0,0 +1,91 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Bloom filter of values that are known to exist
+
+Used by the Promotion model to answer "does this productid have any
+promotion?" without a Cloudant query. A miss is definite; a hit may be
+a false positive (about BLOOM_ERROR_RATE of the time) and has to be
+confirmed by the real query. Values are compared case insensitively.
+
+Until the first rebuild() finishes every value is reported as present,
+so the filter never hides a promotion while it is being loaded.
+"""
+
+import os
+import math
+import struct
+import hashlib
+import threading
+
+# get configruation from enviuronment (12-factor)
+BLOOM_CAPACITY = int(os.environ.get('BLOOM_CAPACITY', 1000000))
+BLOOM_ERROR_RATE = float(os.environ.get('BLOOM_ERROR_RATE', 0.01))
+
+
+class BloomFilter(object):
+    """ A thread safe Bloom filter that can be rebuilt while in use """
+
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.ready = False
+        self._bits = bytearray((self.size + 7) // 8)
+        self._building = None
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+    def _positions(self, value):
+        """ Returns the bit positions for a value using double hashing """
+        key = u'{}'.format(value).lower().encode('utf-8')
+        first, second = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    @staticmethod
+    def _set(bits, positions):
+        """ Turns on the bits at positions """
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def add(self, value):
+        """ Adds a value to the filter (and to one being rebuilt) """
+        if value is None:
+            return
+        positions = self._positions(value)
+        with self._lock:
+            self._set(self._bits, positions)
+            if self._building is not None:
+                self._set(self._building, positions)
+
+    def __contains__(self, value):
+        """ False only if the value has definitely never been added """
+        if not self.ready:
+            return True
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+    def rebuild(self, values):
+        """ Replaces the contents with values, keeping concurrent adds """
+        with self._rebuild_lock:
+            with self._lock:
+                self._building = bytearray(len(self._bits))
+            for value in values:
+                self.add(value)
+            with self._lock:
+                self._bits = self._building
+                self._building = None
+                self.ready = True
@@ -0,0 +1,297 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Streaming bulk import of Promotions from NDJSON or CSV
+
+Records are parsed one at a time, validated and written in batches with
+Cloudant ``_bulk_docs``. A few batches are written concurrently, and the
+reader blocks once IMPORT_WORKERS * 2 batches are in flight, so memory
+stays bounded no matter how large the input is.
+
+The checkpoint is the number of input records that have been written
+(the contiguous prefix, since batches can finish out of order). An
+interrupted import is resumed by skipping that many records.
+
+Each record's id is derived from its position and its content, so
+records that were written after the checkpoint are rejected as
+conflicts when the import is rerun rather than written twice.
+
+Command line usage:
+    python -m app.bulk_import promotions.ndjson --checkpoint promotions.ckpt
+    python -m app.bulk_import promotions.csv --format csv
+"""
+
+import os
+import csv
+import sys
+import json
+import uuid
+import logging
+import argparse
+import threading
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from app.models import Promotion, DataValidationError
+
+# get configruation from enviuronment (12-factor)
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 500))
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 2))
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', 100))
+
+# Content-Types accepted by POST /promotions/import
+IMPORT_FORMATS = {
+    'application/x-ndjson': 'ndjson',
+    'application/json': 'ndjson',
+    'text/csv': 'csv'
+}
+
+TRUE_VALUES = ['yes', 'y', 'true', 't', '1']
+
+# namespace of the ids given to imported records
+IMPORT_NAMESPACE = uuid.UUID('5b0c2f1e-8d43-4a57-9a3c-6f1d2e7b9c40')
+
+logger = logging.getLogger(__name__)
+
+
+class BulkImportError(Exception):
+    """ An import stopped part way; summary has the checkpoint to resume from """
+
+    def __init__(self, message, summary):
+        super(BulkImportError, self).__init__(message)
+        self.summary = summary
+
+
+######################################################################
+#  P A R S E R S
+######################################################################
+def read_ndjson(stream):
+    """ Yields one record per non blank line of newline delimited JSON """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield line  # rejected by validation so it's counted as an error
+
+
+def read_csv(stream):
+    """ Yields one record per CSV row, the first row being the header """
+    for row in csv.DictReader(stream):
+        if row.get('available') is not None:
+            row['available'] = row['available'].strip().lower() in TRUE_VALUES
+        yield row
+
+
+def read_records(stream, fmt='ndjson'):
+    """ Returns an iterator of records from a stream in the given format """
+    if fmt == 'csv':
+        return read_csv(stream)
+    return read_ndjson(stream)
+
+
+def record_id(position, promotion):
+    """ Returns the id of the record at a position, the same on every run """
+    content = json.dumps(promotion.serialize(), sort_keys=True)
+    return uuid.uuid5(IMPORT_NAMESPACE, '{}:{}'.format(position, content)).hex
+
+
+######################################################################
+#  C H E C K P O I N T S
+######################################################################
+def load_checkpoint(path):
+    """ Returns the number of records already imported """
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as checkpoint:
+        return json.load(checkpoint).get('committed', 0)
+
+
+def save_checkpoint(path, committed):
+    """ Atomically records the number of records imported """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as checkpoint:
+        json.dump({'committed': committed}, checkpoint)
+    os.rename(temp_path, path)
+
+
+######################################################################
+#  I M P O R T E R
+######################################################################
+class Importer(object):
+    """ Writes a stream of records to the database in pipelined batches """
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE, workers=IMPORT_WORKERS,
+                 checkpoint=None, progress=None, model=Promotion):
+        """
+        :param checkpoint: optional file to record progress in
+        :param progress: optional function called with summary() after each batch
+        :param model: the Promotion class of the storage backend
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.read = 0
+        self.imported = 0
+        self.existing = 0       # written by an earlier run of the same import
+        self.failed = 0
+        self.errors = []
+        self.committed = 0
+        self._finished = {}     # batch start -> batch end
+        self._error = None
+        self._lock = threading.Lock()
+
+    def summary(self):
+        """ Returns the progress of the import """
+        return {
+            'read': self.read,
+            'imported': self.imported,
+            'existing': self.existing,
+            'failed': self.failed,
+            'committed': self.committed,
+            'errors': list(self.errors)
+        }
+
+    def run(self, records, start=0):
+        """
+        Imports records, skipping the first start of them
+
+        :returns: the summary of the import
+        :raises BulkImportError: if a batch could not be written
+        """
+        self.committed = self.read = start
+        pool = ThreadPool(self.workers)
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        batch = []
+        batch_start = start
+        try:
+            for record in islice(records, start, None):
+                self.read += 1
+                promotion = self._validate(record)
+                if promotion:
+                    batch.append(promotion)
+                if len(batch) >= self.batch_size:
+                    self._submit(pool, slots, batch, batch_start, self.read)
+                    batch, batch_start = [], self.read
+                if self._error:
+                    break
+            if not self._error:
+                self._submit(pool, slots, batch, batch_start, self.read)
+        finally:
+            pool.close()
+            pool.join()
+        if self._error:
+            raise BulkImportError('Import failed: {}'.format(self._error), self.summary())
+        return self.summary()
+
+    def _validate(self, record):
+        """ Returns a Promotion for a valid record or records the error """
+        try:
+            promotion = self.model().deserialize(record)
+            if promotion.productid is None:
+                raise DataValidationError('productid attribute is not set')
+            promotion.id = record_id(self.read, promotion)
+            return promotion
+        except DataValidationError as error:
+            self._record_error(self.read, str(error))
+            return None
+
+    def _record_error(self, position, message):
+        """ Counts a failed record, keeping the first few messages """
+        with self._lock:
+            self.failed += 1
+            if len(self.errors) < IMPORT_MAX_ERRORS:
+                self.errors.append({'record': position, 'error': message})
+
+    def _submit(self, pool, slots, batch, start, end):
+        """ Writes a batch on the pool, blocking while too many are in flight """
+        slots.acquire()
+
+        def write_batch():
+            """ Writes the batch and records the outcome """
+            try:
+                errors = self.model.create_many(batch) if batch else []
+                existing = [error for error in errors if error.get('error') == 'conflict']
+                errors = [error for error in errors if error.get('error') != 'conflict']
+                with self._lock:
+                    self.imported += len(batch) - len(errors) - len(existing)
+                    self.existing += len(existing)
+                for error in errors:
+                    self._record_error(end, '{}: {}'.format(error.get('error'),
+                                                            error.get('reason')))
+                self._finish(start, end)
+            except Exception as err:    # pylint: disable=broad-except
+                logger.error('Import batch %s-%s failed: %s', start, end, err)
+                self._error = err
+            finally:
+                slots.release()
+
+        pool.apply_async(write_batch)
+
+    def _finish(self, start, end):
+        """ Advances the checkpoint over every contiguous finished batch """
+        with self._lock:
+            self._finished[start] = end
+            while self.committed in self._finished:
+                self.committed = self._finished.pop(self.committed)
+            if self.checkpoint:
+                save_checkpoint(self.checkpoint, self.committed)
+            summary = self.summary()
+        logger.info('Imported %s of %s records read', summary['imported'], summary['read'])
+        if self.progress:
+            self.progress(summary)
+
+
+######################################################################
+#   M A I N
+######################################################################
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description='Import promotions from NDJSON or CSV')
+    parser.add_argument('path', help='file to import, or - for stdin')
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default=None,
+                        help='defaults to the file extension')
+    parser.add_argument('--checkpoint', help='file used to resume an interrupted import')
+    parser.add_argument('--database', default='promotions')
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s in %(module)s: %(message)s')
+    fmt = args.format or ('csv' if args.path.endswith('.csv') else 'ndjson')
+    start = load_checkpoint(args.checkpoint)
+    if start:
+        logger.info('Resuming after record %s', start)
+
+    Promotion.init_db(args.database)
+    stream = sys.stdin if args.path == '-' else open(args.path)
+    importer = Importer(batch_size=args.batch_size, checkpoint=args.checkpoint)
+    try:
+        summary = importer.run(read_records(stream, fmt), start=start)
+    except BulkImportError as error:
+        logger.error('%s; rerun to resume after record %s', error, error.summary['committed'])
+        return 1
+    finally:
+        stream.close()
+    logger.info('Import finished: %s', json.dumps(summary))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
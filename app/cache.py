@@ -0,0 +1,275 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Tiered document cache for the Promotion model
+
+Reads are served from an in-process LRU first, then from Redis (which
+is shared by every gunicorn worker and every pod) and only then from
+Cloudant. Entries are the raw Cloudant documents, including their
+``_rev``, so a write that carries an older revision can never replace
+a newer one that is already in Redis.
+
+Redis is optional. It is used when VCAP_SERVICES has a ``rediscloud``
+binding or when REDIS_URL is set; otherwise only the local tier is used.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from redis import Redis
+from redis.exceptions import ConnectionError, RedisError
+
+# get configruation from enviuronment (12-factor)
+REDIS_URL = os.environ.get('REDIS_URL')
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 1024))
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 5))
+CACHE_BUS_TTL = int(os.environ.get('CACHE_BUS_TTL', 300))
+REDIS_CACHE_TTL = int(os.environ.get('REDIS_CACHE_TTL', 300))
+NEGATIVE_CACHE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', 5))
+REDIS_KEY_PREFIX = 'promotion:'
+
+logger = logging.getLogger(__name__)
+
+# Only store the document if it is at least as new as the cached one.
+# KEYS[1] = document key, ARGV[1] = revision number, ARGV[2] = document
+# json, ARGV[3] = ttl in seconds
+_CHECK_AND_SET = """
+local current = redis.call('GET', KEYS[1])
+if current then
+    local rev = cjson.decode(current)['_rev'] or '0-'
+    if tonumber(string.match(rev, '^(%d+)')) > tonumber(ARGV[1]) then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+def rev_number(rev):
+    """ Returns the generation number of a CouchDB revision like '3-abc' """
+    if not rev:
+        return 0
+    try:
+        return int(rev.split('-', 1)[0])
+    except ValueError:
+        return 0
+
+
+def is_tombstone(doc):
+    """ True if the cached document records a deletion """
+    return bool(doc) and doc.get('_deleted', False)
+
+
+######################################################################
+#  L O C A L   C A C H E
+######################################################################
+class LocalCache(object):
+    """ Thread safe in-process LRU cache with a time to live """
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the value for key or None if missing or expired """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            self._data[key] = entry     # move to most recently used
+            return value
+
+    def put(self, key, value, ttl=None):
+        """ Stores a value, evicting the least recently used if full """
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def evict(self, key):
+        """ Removes a key from the cache """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """ Removes everything from the cache """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+######################################################################
+#  R E D I S   C A C H E
+######################################################################
+class RedisCache(object):
+    """ Document cache shared across processes through Redis """
+
+    def __init__(self, redis, ttl=REDIS_CACHE_TTL, prefix=REDIS_KEY_PREFIX):
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+        self._check_and_set = redis.register_script(_CHECK_AND_SET)
+
+    def get(self, key):
+        """ Returns the cached document or None """
+        try:
+            data = self.redis.get(self.prefix + key)
+        except RedisError as err:
+            logger.warning('Redis get failed: %s', err)
+            return None
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def put(self, key, doc, ttl=None):
+        """ Stores a document unless Redis already has a newer revision """
+        if ttl is None:
+            ttl = self.ttl
+        try:
+            return bool(self._check_and_set(
+                keys=[self.prefix + key],
+                args=[rev_number(doc.get('_rev')), json.dumps(doc), ttl]))
+        except RedisError as err:
+            logger.warning('Redis put failed: %s', err)
+            return False
+
+    def evict(self, key):
+        """ Removes a document from Redis """
+        try:
+            self.redis.delete(self.prefix + key)
+        except RedisError as err:
+            logger.warning('Redis evict failed: %s', err)
+
+    def clear(self):
+        """ Removes every cached document from Redis """
+        try:
+            keys = list(self.redis.scan_iter(match=self.prefix + '*', count=500))
+            if keys:
+                self.redis.delete(*keys)
+        except RedisError as err:
+            logger.warning('Redis clear failed: %s', err)
+
+
+######################################################################
+#  T I E R E D   C A C H E
+######################################################################
+class TieredCache(object):
+    """ Looks in the local cache first and falls back to Redis """
+
+    def __init__(self, local, remote=None):
+        self.local = local
+        self.remote = remote
+
+    def get(self, key):
+        """ Returns the cached document or None """
+        doc = self.local.get(key)
+        if doc is None and self.remote:
+            doc = self.remote.get(key)
+            if doc is not None:
+                self.local.put(key, doc)
+        return doc
+
+    def put(self, key, doc, ttl=None):
+        """ Caches a document in every tier, for ttl seconds if given """
+        if self.remote and not self.remote.put(key, doc, ttl):
+            # Redis holds a newer revision so don't cache ours locally
+            self.local.evict(key)
+            return
+        self.local.put(key, doc, ttl)
+
+    def delete(self, key, rev, ttl=NEGATIVE_CACHE_TTL):
+        """
+        Records a short lived deletion so older revisions can't be cached again
+
+        The tombstone only has to outlast writes of older revisions that
+        are already in flight, so it expires like a cached miss.
+        """
+        tombstone = {'_id': key, '_rev': '{}-deleted'.format(rev_number(rev) + 1),
+                     '_deleted': True}
+        self.put(key, tombstone, ttl)
+
+    def put_missing(self, key, ttl=NEGATIVE_CACHE_TTL):
+        """ Remembers in this process for a short time that a key doesn't exist """
+        self.local.put(key, {'_id': key, '_rev': '0-missing', '_deleted': True}, ttl)
+
+    def evict(self, key):
+        """ Removes a key from every tier """
+        self.local.evict(key)
+        if self.remote:
+            self.remote.evict(key)
+
+    def clear(self):
+        """ Removes everything from every tier """
+        self.local.clear()
+        if self.remote:
+            self.remote.clear()
+
+
+######################################################################
+#  R E D I S   C O N N E C T I O N
+######################################################################
+def connect_to_redis():
+    """
+    Returns a Redis connection for the shared cache or None
+
+    Uses the same ``rediscloud`` binding as app.models_redis and falls
+    back to REDIS_URL. Redis is optional so failures are only logged.
+    """
+    redis = None
+    if 'VCAP_SERVICES' in os.environ:
+        services = json.loads(os.environ['VCAP_SERVICES'])
+        if 'rediscloud' in services:
+            creds = services['rediscloud'][0]['credentials']
+            redis = Redis(host=creds['hostname'], port=int(creds['port']),
+                          password=creds['password'])
+    if redis is None and REDIS_URL:
+        redis = Redis.from_url(REDIS_URL)
+    if redis is None:
+        logger.info('No Redis configured, using the local cache only')
+        return None
+    try:
+        redis.ping()
+    except ConnectionError:
+        logger.warning('Redis cache could not be reached, using the local cache only')
+        return None
+    logger.info('Redis cache connection established')
+    return redis
+
+
+def create_cache(redis=None):
+    """
+    Builds the tiered cache used by the Promotion model
+
+    With Redis the invalidation bus keeps the local tier fresh, so local
+    entries can live for CACHE_BUS_TTL instead of CACHE_TTL.
+    """
+    if redis:
+        return TieredCache(LocalCache(ttl=CACHE_BUS_TTL), RedisCache(redis))
+    return TieredCache(LocalCache())
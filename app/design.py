@@ -0,0 +1,368 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Zero downtime deployment of design documents and query indexes
+
+CouchDB builds a new or changed view the first time it is queried,
+which holds up requests for minutes on a large database. DesignManager
+deploys them without that stall:
+
+1. Every definition is hashed into a version. A design document whose
+   live copy already has that version is left alone.
+2. A changed design document is saved under a staging id
+   (_design/<name>-<version>) and built in the background, while the
+   live copy keeps answering with its old views.
+3. When the build finishes the staging copy is written over the live
+   one in a single update. View indexes are keyed by the signature of
+   their definitions, so the live copy picks up the built index at once.
+4. The staging copy is deleted and _view_cleanup drops the old indexes.
+
+A new design document, or one without views, has nothing to wait for
+and is saved in place. Query (Mango) indexes live in their own
+versioned design documents (_design/index-<name>-<version>); queries
+pin the active version with use_index() while the next one builds, and
+the other versions are deleted once it is ready. A new index has no
+active version, and so no hint, until its first build finishes.
+
+CouchDB picks an index itself for a query without use_index, and may
+pick one that is still building, so query_hint() also pins the queries
+a building index could answer to a built one (see query_hint).
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from requests import HTTPError, ConnectionError
+from requests.exceptions import Timeout
+
+# get configruation from enviuronment (12-factor)
+DESIGN_POLL_INTERVAL = int(os.environ.get('DESIGN_POLL_INTERVAL', 10))
+DESIGN_BUILD_TIMEOUT = int(os.environ.get('DESIGN_BUILD_TIMEOUT', 6 * 60 * 60))
+
+ACTIVE, BUILDING, FAILED = 'active', 'building', 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+def version_of(definition):
+    """ Returns a short hash that changes whenever the definition does """
+    text = json.dumps(definition, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:10]
+
+
+def index_fields(fields):
+    """ Returns the field names of an index definition like [{'a': 'asc'}] """
+    return [field.keys()[0] if isinstance(field, dict) else field for field in fields]
+
+
+class DesignManager(object):
+    """ Deploys versioned design documents and query indexes in the background """
+
+    def __init__(self, database, documents, indexes, poll=DESIGN_POLL_INTERVAL,
+                 timeout=DESIGN_BUILD_TIMEOUT):
+        """
+        :param database: cloudant.database.CloudantDatabase
+        :param documents: {name: {'views': {...}, 'updates': {...}}}
+        :param indexes: {name: [{'field': 'asc'}, ...]}
+        """
+        self.database = database
+        self.documents = documents
+        self.indexes = indexes
+        self.poll = poll
+        self.timeout = timeout
+        self._active = {}       # index name -> design document id
+        self._building = {}     # index name -> design document id not built yet
+        self._status = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def use_index(self, name):
+        """ Returns the design document of the active version of an index or None """
+        with self._lock:
+            return self._active.get(name)
+
+    def index_for(self, fields):
+        """ Returns the active design document of an index on exactly these fields """
+        for name, definition in self.indexes.items():
+            if index_fields(definition) == list(fields):
+                return self.use_index(name)
+        return None
+
+    def query_hint(self, fields, sort=None):
+        """
+        Returns the query parameters that keep a query off indexes still building
+
+        A query that a building index could answer is pinned with
+        use_index to a built index that answers it too, or else sorted
+        on _id, which only the primary index can do. Queries that no
+        building index could answer are pinned to the active index on
+        exactly their fields, as index_for() finds it.
+        :param fields: the fields of the selector
+        :param sort: the sort of the query, e.g. [{'expires': 'asc'}]
+        """
+        order = index_fields(sort or [])
+        exact = self.index_for(order or sorted(fields))
+        if exact:
+            return {'use_index': exact}
+        wanted = set(fields) | set(order)
+
+        def usable(name):
+            """ True if CouchDB could pick the index for the query """
+            columns = index_fields(self.indexes[name])
+            return set(columns) <= wanted and columns[:len(order)] == order
+
+        with self._lock:
+            if not any(usable(name) for name in self._building):
+                return {}
+            built = [(len(self.indexes[name]), ddoc) for name, ddoc in self._active.items()
+                     if name not in self._building and usable(name)]
+        if built:
+            return {'use_index': max(built)[1]}
+        return {} if order else {'sort': [{'_id': 'asc'}]}
+
+    def status(self):
+        """ Returns the version, state and build progress of everything deployed """
+        with self._lock:
+            return dict((name, dict(status)) for name, status in self._status.items())
+
+    def publish(self):
+        """
+        Saves everything that can be used straight away and returns what must be built
+
+        Quick enough to call at startup: it only writes design documents
+        that are new or have no views and the definitions of new indexes.
+        Indexes that already exist come first, as they are most likely
+        built already and are only hinted once deploy has checked.
+        """
+        pending = []
+        built = []
+        for name, definition in sorted(self.documents.items()):
+            version = version_of(definition)
+            doc_id = '_design/' + name
+            live = self._get(doc_id)
+            if live and live.get('version') == version:
+                self._set_status(name, version, ACTIVE)
+                continue
+            body = dict(definition, version=version)
+            if live is None or not definition.get('views'):
+                self._save(doc_id, body)
+                self._set_status(name, version, BUILDING if definition.get('views') else ACTIVE)
+                if definition.get('views'):
+                    pending.append(('view', name, doc_id, body))
+            else:
+                staging_id = '{}-{}'.format(doc_id, version)
+                self._save(staging_id, body)
+                self._set_status(name, version, BUILDING)
+                pending.append(('view', name, staging_id, body))
+
+        existing = self._query_indexes()
+        for name, fields in sorted(self.indexes.items()):
+            version = version_of(fields)
+            doc_id = '_design/index-{}-{}'.format(name, version)
+            others = [ddoc for ddoc, index in existing if index == name and ddoc != doc_id]
+            if (doc_id, name) not in existing:
+                self._create_index(doc_id, name, fields)
+            # a query hint to an index that is still building waits for the
+            # build, so a new index is only hinted once deploy has built it
+            with self._lock:
+                if self._active.get(name) != doc_id:
+                    self._building[name] = doc_id
+                    if others:
+                        self._active[name] = sorted(others)[-1]
+            self._set_status(name, version, BUILDING)
+            item = ('index', name, doc_id, fields)
+            if (doc_id, name) in existing:
+                built.append(item)
+            else:
+                pending.append(item)
+        return built + pending
+
+    def deploy(self, progress=None):
+        """
+        Publishes, builds and switches over every definition, then cleans up
+
+        Blocks until the builds are done, so it is run in the background.
+        :param progress: optional function called with the status while building
+        :returns: the status of every definition
+        """
+        for kind, name, doc_id, definition in self.publish():
+            if not self._build(kind, name, doc_id, definition, progress):
+                continue
+            if kind == 'view':
+                if doc_id != '_design/' + name:
+                    self._switch(name, doc_id, definition)
+            else:
+                with self._lock:
+                    self._active[name] = doc_id
+                    self._building.pop(name, None)
+                self._drop_other_indexes(name, doc_id)
+            self._set_status(name, self._status[name]['version'], ACTIVE)
+        self._cleanup()
+        return self.status()
+
+    def start(self):
+        """ Deploys in a background thread """
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._deploy_safely, name='design-deploy')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _deploy_safely(self):
+        """ Runs deploy() and logs rather than raises its errors """
+        try:
+            self.deploy()
+        except (HTTPError, ConnectionError) as error:
+            logger.error('Deploying the design documents failed: %s', error)
+
+    def _build(self, kind, name, doc_id, definition, progress):
+        """ Triggers the build of an index and waits for it, returning False on timeout """
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                self._trigger(kind, doc_id, definition, self.poll)
+                return True
+            except Timeout:
+                done = self._progress(doc_id)
+                self._set_status(name, self._status[name]['version'], BUILDING, progress=done)
+                logger.info('Building %s: %s%% done', doc_id, done)
+                if progress:
+                    progress(self.status())
+            if time.time() > deadline:
+                logger.error('Building %s did not finish in %s seconds', doc_id, self.timeout)
+                self._set_status(name, self._status[name]['version'], FAILED)
+                return False
+
+    def _switch(self, name, staging_id, body):
+        """ Writes a built staging copy over the live design document """
+        doc_id = '_design/' + name
+        live = self._get(doc_id)
+        if not live or live.get('version') != body['version']:
+            self._save(doc_id, body)
+        staging = self._get(staging_id)
+        if staging:
+            self._delete(staging_id, staging['_rev'])
+        logger.info('Switched %s to version %s', doc_id, body['version'])
+
+    def _drop_other_indexes(self, name, doc_id):
+        """ Deletes the other versions of a query index once doc_id is built """
+        for ddoc, index in self._query_indexes():
+            if index == name and ddoc != doc_id:
+                self._delete_index(ddoc, name)
+                logger.info('Dropped index %s from %s', name, ddoc)
+
+    def _set_status(self, name, version, state, progress=None):
+        """ Records the state of a definition """
+        with self._lock:
+            self._status[name] = {'version': version, 'state': state,
+                                  'progress': progress if state != ACTIVE else 100}
+
+    ##################################################
+    # Requests to the database
+    ##################################################
+
+    def _url(self, *parts):
+        """ Returns the url of a path in the database """
+        return '/'.join((self.database.database_url,) + parts)
+
+    def _get(self, doc_id):
+        """ Returns a document or None if it doesn't exist """
+        resp = self.database.r_session.get(self._url(doc_id))
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.json()
+
+    def _save(self, doc_id, body):
+        """ Creates or replaces a document, leaving a copy another worker saved """
+        current = self._get(doc_id)
+        if current and current.get('version') == body.get('version'):
+            return
+        body = dict(body, _id=doc_id)
+        if current:
+            body['_rev'] = current['_rev']
+        resp = self.database.r_session.put(self._url(doc_id), data=json.dumps(body),
+                                           headers={'Content-Type': 'application/json'})
+        if resp.status_code != 409:     # 409: another worker saved it first
+            resp.raise_for_status()
+
+    def _delete(self, doc_id, rev):
+        """ Deletes a document """
+        resp = self.database.r_session.delete(self._url(doc_id), params={'rev': rev})
+        if resp.status_code not in (404, 409):
+            resp.raise_for_status()
+
+    def _query_indexes(self):
+        """ Returns (design document, name) of every json query index """
+        result = self.database.get_query_indexes(raw_result=True)
+        return [(index['ddoc'], index['name']) for index in result.get('indexes', [])
+                if index.get('type') == 'json' and index.get('ddoc')]
+
+    def _create_index(self, doc_id, name, fields):
+        """ Saves the definition of a query index without building it """
+        self.database.create_query_index(design_document_id=doc_id, index_name=name,
+                                         fields=fields)
+
+    def _delete_index(self, doc_id, name):
+        """ Deletes a query index """
+        try:
+            self.database.delete_query_index(doc_id, 'json', name)
+        except HTTPError as error:
+            logger.warning('Dropping index %s from %s failed: %s', name, doc_id, error)
+
+    def _trigger(self, kind, doc_id, definition, timeout):
+        """
+        Queries an index so it is brought up to date
+
+        Returns once it is built or raises Timeout; the build carries on
+        in the database either way.
+        """
+        if kind == 'view':
+            view = sorted(definition['views'])[0]
+            resp = self.database.r_session.get(self._url(doc_id, '_view', view),
+                                               params={'limit': 0}, timeout=timeout)
+        else:
+            names = index_fields(definition)
+            query = {'selector': dict((field, {'$gt': None}) for field in names),
+                     'use_index': doc_id, 'limit': 1, 'fields': ['_id']}
+            resp = self.database.r_session.post(self._url('_find'), data=json.dumps(query),
+                                                headers={'Content-Type': 'application/json'},
+                                                timeout=timeout)
+        resp.raise_for_status()
+
+    def _progress(self, doc_id):
+        """ Returns the percent done of the build of a design document or None """
+        url = '/'.join((self.database.client.server_url, '_active_tasks'))
+        try:
+            resp = self.database.r_session.get(url)
+            resp.raise_for_status()
+        except (HTTPError, ConnectionError):
+            return None     # only admins can see the tasks
+        tasks = [task for task in resp.json() if task.get('type') == 'indexer' and
+                 task.get('design_document') == doc_id]
+        done = sum(task.get('changes_done', 0) for task in tasks)
+        total = sum(task.get('total_changes', 0) for task in tasks)
+        return int(100 * done / total) if total else None
+
+    def _cleanup(self):
+        """ Removes the index files that no design document uses any more """
+        resp = self.database.r_session.post(self._url('_view_cleanup'),
+                                            headers={'Content-Type': 'application/json'})
+        if resp.status_code >= 400:
+            logger.warning('View cleanup failed: %s', resp.status_code)
@@ -0,0 +1,100 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Parsing of the free form Promotion discount
+
+Promotion.discount is a free form string, so each one is parsed into a
+(kind, value) pair once and kept in a bounded cache:
+
+    "20%" or category "Percentage"  -> PERCENT off the line, value 20
+    "$5"  or category "Dollar"      -> AMOUNT off every unit, value 5
+    category "BOGO"                 -> every second unit value% off
+                                       (100 when there is no number)
+
+A discount that can't be parsed has no kind or value. The parsed value
+and type are stored next to the discount (discount_value and
+discount_type) so Cloudant Query and Redis can range over and sort by
+them.
+"""
+
+import os
+import re
+import threading
+
+# get configruation from enviuronment (12-factor)
+PRICING_CACHE_SIZE = int(os.environ.get('PRICING_CACHE_SIZE', 10000))
+
+PERCENT, AMOUNT, BOGO = 0, 1, 2
+DISCOUNT_TYPES = {PERCENT: 'percent', AMOUNT: 'amount', BOGO: 'bogo'}
+
+_NUMBER = re.compile(r'(\d+(?:\.\d+)?)')
+_parsed = {}
+_parsed_lock = threading.Lock()
+
+
+def parse_discount(category, discount):
+    """ Returns (kind, value) for a Promotion's discount or None """
+    key = (category, discount)
+    try:
+        return _parsed[key]
+    except KeyError:
+        pass
+    result = _parse(category, discount)
+    with _parsed_lock:
+        if len(_parsed) >= PRICING_CACHE_SIZE:
+            _parsed.clear()
+        _parsed[key] = result
+    return result
+
+
+def _parse(category, discount):
+    """ Parses a discount string using its category as a hint """
+    text = u'{}'.format(discount or '').strip().lower()
+    category = u'{}'.format(category or '').strip().lower()
+    match = _NUMBER.search(text)
+    value = float(match.group(1)) if match else None
+    if category == 'bogo' or 'bogo' in text or 'free' in text:
+        return BOGO, min(value if value is not None else 100.0, 100.0)
+    if value is None:
+        return None
+    if '%' in text or category.startswith('percent'):
+        return PERCENT, min(value, 100.0)
+    if '$' in text or category in ('dollar', 'amount', 'fixed'):
+        return AMOUNT, value
+    return PERCENT, min(value, 100.0)
+
+
+def discount_fields(category, discount):
+    """ Returns the stored discount_value and discount_type of a discount """
+    parsed = parse_discount(category, discount)
+    if parsed is None:
+        return {'discount_value': None, 'discount_type': None}
+    return {'discount_value': parsed[1], 'discount_type': DISCOUNT_TYPES[parsed[0]]}
+
+
+def discount_query(discount):
+    """
+    Returns the (discount_value, discount_type) that a discount filter matches
+
+    The type is None unless the filter says it with a % or a $, and the
+    value is None when the filter has no number in it.
+    """
+    text = u'{}'.format(discount or '')
+    match = _NUMBER.search(text)
+    if not match:
+        return None, None
+    discount_type = 'percent' if '%' in text else 'amount' if '$' in text else None
+    return float(match.group(1)), discount_type
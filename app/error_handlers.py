@@ -6,7 +6,8 @@ Handles all of the HTTP Error Codes as JSON
 
 from flask import jsonify, make_response
 from . import app
-from app.models import DataValidationError
+from app.models import DataValidationError, ConflictError
+from app.jobs import JobQueueFull
 
 ######################################################################
 # Error Handlers
@@ -16,6 +17,16 @@ def request_validation_error(error):
     """ Handles Value Errors from bad data """
     return bad_request(error)
 
+@app.errorhandler(ConflictError)
+def request_conflict_error(error):
+    """ Handles writes that kept conflicting """
+    return conflict(error)
+
+@app.errorhandler(JobQueueFull)
+def job_queue_full(error):
+    """ Handles jobs that can't be queued with 503_SERVICE_UNAVAILABLE """
+    return service_unavailable(error)
+
 @app.errorhandler(400)
 def bad_request(error):
     """ Handles bad reuests with 400_BAD_REQUEST """
@@ -37,6 +48,20 @@ def method_not_supported(error):
     app.logger.info(message)
     return make_response(jsonify(status=405, error='Method not Allowed', message=message), 405)
 
+@app.errorhandler(409)
+def conflict(error):
+    """ Handles concurrent write conflicts with 409_CONFLICT """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return make_response(jsonify(status=409, error='Conflict', message=message), 409)
+
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    """ Handles request bodies that are too large with 413_REQUEST_ENTITY_TOO_LARGE """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return make_response(jsonify(status=413, error='Request Entity Too Large', message=message), 413)
+
 @app.errorhandler(415)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
@@ -50,3 +75,10 @@ def internal_server_error(error):
     message = error.message or str(error)
     app.logger.info(message)
     return make_response(jsonify(status=500, error='Internal Server Error', message=message), 500)
+
+@app.errorhandler(503)
+def service_unavailable(error):
+    """ Handles requests that can't be served now with 503_SERVICE_UNAVAILABLE """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return make_response(jsonify(status=503, error='Service Unavailable', message=message), 503)
@@ -0,0 +1,140 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Streaming export of Promotions as NDJSON or CSV
+
+Turns an iterator of Cloudant documents into an iterator of output
+chunks of about EXPORT_CHUNK_SIZE bytes, optionally gzip compressed.
+Nothing is held in memory beyond the current chunk, so the whole
+collection can be sent with chunked transfer encoding.
+
+Deleted documents (from an incremental export) are written as
+``{"_id": ..., "_deleted": true}`` so consumers can remove them.
+The output is in the format accepted by app.bulk_import.
+"""
+
+import os
+import csv
+import json
+import zlib
+from StringIO import StringIO
+from app.models import selector_for, derived_fields
+
+# get configruation from enviuronment (12-factor)
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 64 * 1024))
+
+EXPORT_FIELDS = ['_id', 'productid', 'category', 'available', 'discount', 'start', 'end',
+                 'expires', '_deleted']
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def export_record(document):
+    """ Returns the exported fields of a document """
+    if document.get('_deleted'):
+        return {'_id': document['_id'], '_deleted': True}
+    return dict((field, document.get(field)) for field in EXPORT_FIELDS[:-1])
+
+
+def matches(document, selector):
+    """
+    True if the document passes a selector from selector_for (deletions always pass)
+
+    The derived fields are worked out from the document, so documents
+    that were never migrated match the way the finders match them.
+    """
+    if document.get('_deleted'):
+        return True
+    document = dict(document, **derived_fields(document.get('category'),
+                                               document.get('discount')))
+    return selector_matches(document, selector)
+
+
+def selector_matches(document, selector):
+    """ True if the document has every field value of a selector of equalities and $and """
+    for field, value in selector.items():
+        if field == '$and':
+            if not all(selector_matches(document, clause) for clause in value):
+                return False
+        elif document.get(field) != value:
+            return False
+    return True
+
+
+def ndjson_lines(records):
+    """ Yields one line of JSON per record """
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def csv_lines(records):
+    """ Yields a header line and then one CSV line per record """
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, EXPORT_FIELDS, lineterminator='\n')
+    writer.writeheader()
+    for record in records:
+        writer.writerow(dict((key, u'{}'.format(value).encode('utf-8'))
+                             for key, value in record.items() if value is not None))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def chunked(lines, size=EXPORT_CHUNK_SIZE):
+    """ Groups lines into chunks of about size bytes """
+    chunk = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def gzipped(chunks):
+    """ Gzip compresses a stream of chunks """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(documents, fmt='ndjson', filters=None, gzip=False):
+    """
+    Returns an iterator of export chunks
+
+    :param documents: iterator of Cloudant documents
+    :param fmt: 'ndjson' or 'csv'
+    :param filters: optional category, productid and discount filters,
+        matched like the finders match them (see app.models.selector_for)
+    :param gzip: True to gzip compress the output
+    """
+    selector = selector_for(filters or {})
+    records = (export_record(document) for document in documents
+               if matches(document, selector))
+    lines = csv_lines(records) if fmt == 'csv' else ndjson_lines(records)
+    chunks = chunked(lines)
+    if gzip:
+        chunks = gzipped(chunks)
+    return chunks
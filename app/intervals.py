@@ -0,0 +1,161 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Time windows and an interval index of when Promotions are active
+
+A Promotion is active at time T when start <= T < end; a missing start
+or end leaves that side of the window open. Times are stored as UTC
+ISO 8601 strings (2019-03-01T00:00:00Z) so they compare correctly as
+strings in Cloudant Query.
+
+IntervalIndex answers "which promotions are active at T for product P"
+from memory: each productid keeps its windows sorted by start, so a
+query is a binary search plus a check of the windows that started
+before T. Every window is also kept in one list sorted by start, so a
+query for all products is a single search rather than one per product.
+
+A query is linear in the windows that started before T, not in the
+answer. Windows that have ended are pruned as they are found, so for
+the present that is close to the active ones, but a query far in the
+future also checks every window that ends before it.
+"""
+
+import time
+import bisect
+import calendar
+import threading
+from datetime import datetime
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+_INPUT_FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%MZ',
+                  '%Y-%m-%dT%H:%M', '%Y-%m-%d']
+OPEN_START = ''         # sorts before every time
+OPEN_END = u'\ufff0'   # sorts after every time
+
+
+def parse_time(value):
+    """
+    Returns a time as a UTC ISO 8601 string, or None for an empty value
+
+    Accepts ISO 8601 dates and times in UTC or seconds since the epoch.
+    :raises ValueError: if the value is not a time
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return time.strftime(TIME_FORMAT, time.gmtime(value))
+    text = u'{}'.format(value).strip()
+    if '.' in text:     # drop fractions of a second
+        text = text.split('.')[0] + ('Z' if text.endswith('Z') else '')
+    for fmt in _INPUT_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime(TIME_FORMAT)
+        except ValueError:
+            pass
+    raise ValueError('{} is not an ISO 8601 UTC time'.format(value))
+
+
+def now():
+    """ Returns the current time as a UTC ISO 8601 string """
+    return time.strftime(TIME_FORMAT, time.gmtime())
+
+
+def to_epoch(value):
+    """ Returns the seconds since the epoch of a UTC ISO 8601 string """
+    return calendar.timegm(time.strptime(value, TIME_FORMAT))
+
+
+def is_active(start, end, at):
+    """ True if the window [start, end) contains the time at """
+    return (start or OPEN_START) <= at < (end or OPEN_END)
+
+
+class IntervalIndex(object):
+    """ In memory index of the active windows of documents by productid """
+
+    def __init__(self):
+        self._buckets = {}      # productid -> sorted [(start, end, id)]
+        self._all = []          # every window, sorted [(start, end, id)]
+        self._keys = {}         # id -> (productid, start, end)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, promotion_id, productid, start, end):
+        """ Indexes the window of a document, replacing any older one """
+        entry = (start or OPEN_START, end or OPEN_END, promotion_id)
+        with self._lock:
+            self._remove(promotion_id)
+            bisect.insort(self._buckets.setdefault(productid, []), entry)
+            bisect.insort(self._all, entry)
+            self._keys[promotion_id] = (productid, entry[0], entry[1])
+
+    def discard(self, promotion_id):
+        """ Removes a document from the index """
+        with self._lock:
+            self._remove(promotion_id)
+
+    def clear(self):
+        """ Removes every document """
+        with self._lock:
+            self._buckets.clear()
+            del self._all[:]
+            self._keys.clear()
+
+    def active(self, at, productid=None):
+        """ Returns the ids of the documents active at a time (a linear scan, see above) """
+        with self._lock:
+            if productid is None:
+                return self._active_in(self._all, at)
+            return self._active_in(self._buckets.get(productid), at)
+
+    def _active_in(self, bucket, at):
+        """ Returns the active ids of a sorted bucket, pruning ended windows """
+        if not bucket:
+            return []
+        # every window that starts after at is past this position
+        last = bisect.bisect_right(bucket, (at, OPEN_END, u'\uffff'))
+        active = []
+        ended = []
+        current = now()
+        for entry in bucket[:last]:
+            if at < entry[1]:
+                active.append(entry[2])
+            elif entry[1] <= current:
+                ended.append(entry)
+        for entry in ended:
+            self._remove(entry[2])
+        return active
+
+    def _remove(self, promotion_id):
+        """ Removes a document; the caller holds the lock """
+        key = self._keys.pop(promotion_id, None)
+        if key is None:
+            return
+        productid, start, end = key
+        bucket = self._buckets.get(productid, [])
+        _delete(bucket, (start, end, promotion_id))
+        if not bucket:
+            self._buckets.pop(productid, None)
+        _delete(self._all, (start, end, promotion_id))
+
+
+def _delete(bucket, entry):
+    """ Deletes an entry from a sorted bucket if it is there """
+    position = bisect.bisect_left(bucket, entry)
+    if position < len(bucket) and bucket[position] == entry:
+        del bucket[position]
@@ -0,0 +1,153 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Cross-worker cache invalidation over Redis pub/sub
+
+Every write publishes the ids it changed and the index keys it affected
+(e.g. ``category:BOGO``). Every worker listens on a background thread
+and evicts those entries from its own in-process caches, so the local
+caches can use long TTLs and still only be stale for milliseconds.
+
+The special key ``*`` means everything changed (e.g. after a reset).
+"""
+
+import json
+import time
+import uuid
+import logging
+import threading
+from redis.exceptions import RedisError
+from app.search import normalize
+
+CHANNEL = 'promotions:invalidate'
+FLUSH_ALL = '*'
+
+logger = logging.getLogger(__name__)
+
+
+def index_key(field, value):
+    """
+    Returns the list query key of a field value
+
+    Categories match trimmed and ignoring case, so their keys are made
+    from the normalized value; writes and filters both use this.
+    """
+    if field == 'category':
+        value = normalize(value)
+    return u'{}:{}'.format(field, value).lower()
+
+
+def index_keys(document):
+    """ Returns the list query keys a document belongs to """
+    if not document:
+        return []
+    keys = []
+    for field in ('productid', 'category', 'discount', 'available'):
+        if field in document:
+            keys.append(index_key(field, document[field]))
+    return keys
+
+
+class InvalidationBus(object):
+    """ Publishes and receives cache invalidations through Redis """
+
+    def __init__(self, redis, channel=CHANNEL):
+        self.redis = redis
+        self.channel = channel
+        self.node = uuid.uuid4().hex    # used to skip our own messages
+        self.connected = False          # True while subscribed, so no message is missed
+        self._handlers = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def subscribe(self, handler):
+        """ Registers handler(ids, keys) to be called for remote changes """
+        self._handlers.append(handler)
+
+    def publish(self, ids=(), keys=()):
+        """ Tells every other worker that these ids and keys changed """
+        message = json.dumps({'node': self.node, 'ids': list(ids), 'keys': list(keys)})
+        try:
+            self.redis.publish(self.channel, message)
+        except RedisError as err:
+            logger.warning('Invalidation publish failed: %s', err)
+
+    def start(self):
+        """ Starts listening on a daemon thread """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._listen, name='invalidation-bus')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops the listener thread """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+
+    def dispatch(self, data):
+        """ Calls the handlers for one raw pub/sub message """
+        try:
+            message = json.loads(data)
+        except ValueError:
+            logger.warning('Ignoring bad invalidation message: %s', data)
+            return
+        if message.get('node') == self.node:
+            return
+        for handler in self._handlers:
+            try:
+                handler(message.get('ids', []), message.get('keys', []))
+            except Exception:   # pylint: disable=broad-except
+                logger.exception('Invalidation handler failed')
+
+    def _listen(self):
+        """
+        Receives invalidations until stopped, reconnecting on errors
+
+        The handlers get a FLUSH_ALL when the connection drops and again
+        once it is back, since messages sent in between were never seen.
+        """
+        missed = False
+        while not self._stopped.is_set():
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                self.connected = True
+                if missed:
+                    missed = False
+                    self._flush_all()
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message['type'] == 'message':
+                        self.dispatch(message['data'])
+            except RedisError as err:
+                logger.warning('Invalidation bus disconnected: %s', err)
+                self.connected = False
+                missed = True
+                self._flush_all()
+                time.sleep(1)
+            finally:
+                pubsub.close()
+        self.connected = False
+
+    def _flush_all(self):
+        """ Tells the handlers that anything may have changed """
+        for handler in self._handlers:
+            try:
+                handler([], [FLUSH_ALL])
+            except Exception:   # pylint: disable=broad-except
+                logger.exception('Invalidation handler failed')
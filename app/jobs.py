@@ -0,0 +1,305 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Background jobs for long running requests
+
+Jobs run on a fixed pool of JOB_WORKERS threads fed by a queue of at
+most JOB_QUEUE_SIZE waiting jobs, so maintenance work can't take over
+the process. A request submits a job and returns 202 Accepted; the
+caller polls GET /jobs/<id> for its state (queued, running, finished
+or failed), progress, throughput and error.
+
+A job reports progress with job.step(processed=n, ...), which also
+pauses for JOB_PAUSE seconds so interactive requests get their turn.
+Job records are saved to a JobStore (a Cloudant database) when one is
+set, so any worker can report on a job and the record outlives the
+process. Only the last JOB_HISTORY jobs are kept in memory.
+
+While a job is queued or running its record is saved at least every
+JOB_HEARTBEAT_INTERVAL seconds. A record that has not been saved for
+JOB_LEASE seconds belongs to a process that died: it is reported as
+failed, and JobStore.fail_stale() marks such records failed at startup.
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from Queue import Queue, Full
+from requests import HTTPError, ConnectionError
+from cloudant.document import Document
+
+# get configruation from enviuronment (12-factor)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 10))
+JOB_HISTORY = int(os.environ.get('JOB_HISTORY', 100))
+JOB_PAUSE = float(os.environ.get('JOB_PAUSE', 0.01))
+JOB_SAVE_INTERVAL = float(os.environ.get('JOB_SAVE_INTERVAL', 2))
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', 30))
+JOB_LEASE = float(os.environ.get('JOB_LEASE', 120))
+
+QUEUED, RUNNING, FINISHED, FAILED = 'queued', 'running', 'finished', 'failed'
+STOPPED_ERROR = 'The process running the job stopped'
+
+logger = logging.getLogger(__name__)
+
+
+def is_stale(record, lease=JOB_LEASE):
+    """ True if a queued or running job record has missed its heartbeats """
+    if record.get('state') not in (QUEUED, RUNNING):
+        return False
+    return (record.get('heartbeat') or record.get('created') or 0) < time.time() - lease
+
+
+class JobQueueFull(Exception):
+    """ Too many jobs are already waiting to run """
+    pass
+
+
+class Job(object):
+    """ The state of one background job """
+
+    def __init__(self, name, params=None, runner=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.params = params or {}
+        self.state = QUEUED
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._runner = runner
+        self._saved = 0
+
+    @property
+    def throughput(self):
+        """ Items processed per second while running """
+        if not self.started:
+            return 0.0
+        elapsed = (self.finished or time.time()) - self.started
+        return round(self.progress.get('processed', 0) / max(elapsed, 0.001), 2)
+
+    def step(self, **progress):
+        """ Records progress and briefly yields to interactive requests """
+        self.progress.update(progress)
+        if self._runner and time.time() - self._saved >= JOB_SAVE_INTERVAL:
+            self._runner.save(self)
+        time.sleep(JOB_PAUSE)
+
+    def serialize(self):
+        """ Returns the job as a dictionary """
+        return {
+            'id': self.id,
+            'name': self.name,
+            'params': self.params,
+            'state': self.state,
+            'progress': dict(self.progress),
+            'throughput': self.throughput,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'heartbeat': self._saved
+        }
+
+
+class JobStore(object):
+    """ Keeps job records in a Cloudant database """
+
+    def __init__(self, database):
+        self.database = database
+        self._revs = {}
+
+    @classmethod
+    def connect(cls, client, dbname):
+        """ Returns a store using dbname, creating the database if needed """
+        try:
+            database = client[dbname]
+        except KeyError:
+            database = client.create_database(dbname)
+        return cls(database)
+
+    def save(self, record):
+        """ Writes a job record, logging rather than failing the job """
+        document = Document(self.database, record['id'])
+        document.update(record)
+        if record['id'] in self._revs:
+            document['_rev'] = self._revs[record['id']]
+        try:
+            document.save()
+            if record['state'] in (FINISHED, FAILED):
+                self._revs.pop(record['id'], None)
+            else:
+                self._revs[record['id']] = document['_rev']
+        except (HTTPError, ConnectionError) as err:
+            logger.warning('Saving job %s failed: %s', record['id'], err)
+
+    def get(self, job_id):
+        """ Returns a job record, or None if there is no such job """
+        document = Document(self.database, job_id)
+        try:
+            document.fetch()
+        except HTTPError as err:
+            if err.response is not None and err.response.status_code == 404:
+                return None
+            raise
+        record = dict(document)
+        record.pop('_id', None)
+        record.pop('_rev', None)
+        if is_stale(record):
+            record.update(state=FAILED, error=STOPPED_ERROR)
+        return record
+
+    def fail_stale(self, lease=JOB_LEASE):
+        """ Marks the queued and running jobs that missed their heartbeats as failed """
+        try:
+            result = self.database.get_query_result(
+                {'state': {'$in': [QUEUED, RUNNING]}}, raw_result=True, limit=1000)
+            stale = [record for record in result.get('docs', []) if is_stale(record, lease)]
+            for record in stale:
+                document = Document(self.database, record['_id'])
+                document.update(record, state=FAILED, error=STOPPED_ERROR,
+                                finished=time.time())
+                document.save()
+                logger.warning('Job %s (%s) was left %s by a stopped process',
+                               record['_id'], record.get('name'), record['state'])
+        except (HTTPError, ConnectionError) as err:
+            logger.warning('Failing stale jobs failed: %s', err)
+            return 0
+        return len(stale)
+
+
+class JobRunner(object):
+    """ Runs jobs on a bounded pool of threads and remembers recent ones """
+
+    def __init__(self, workers=JOB_WORKERS, queue_size=JOB_QUEUE_SIZE,
+                 history=JOB_HISTORY, store=None):
+        self.workers = workers
+        self.history = history
+        self.store = store
+        self._queue = Queue(maxsize=queue_size)
+        self._jobs = OrderedDict()
+        self._live = {}         # id -> queued or running job, kept beyond the history
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, name, func, params=None):
+        """
+        Queues func(job) to run in the background and returns the Job
+
+        func can report progress with job.step(); its return value
+        becomes the job result.
+
+        :raises JobQueueFull: if JOB_QUEUE_SIZE jobs are already waiting
+        """
+        self._start_workers()
+        if self._queue.full():
+            raise JobQueueFull('Too many jobs are waiting to run, try again later')
+        job = Job(name, params, self)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._live[job.id] = job
+            while len(self._jobs) > self.history:
+                self._jobs.popitem(last=False)
+        self.save(job)
+        try:
+            self._queue.put_nowait((job, func))
+        except Full:
+            job.state = FAILED
+            job.error = 'Too many jobs are waiting to run'
+            self._done(job)
+            raise JobQueueFull('Too many jobs are waiting to run, try again later')
+        return job
+
+    def get(self, job_id):
+        """ Returns the record of a job or None """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job:
+            return job.serialize()
+        if self.store:
+            return self.store.get(job_id)
+        return None
+
+    def save(self, job):
+        """ Writes the job record to the store if there is one """
+        job._saved = time.time()    # pylint: disable=protected-access
+        if self.store:
+            self.store.save(job.serialize())
+
+    def _done(self, job):
+        """ Saves the final record of a job and stops its heartbeats """
+        with self._lock:
+            self._live.pop(job.id, None)
+        self.save(job)
+
+    def _start_workers(self):
+        """ Starts the worker threads and the heartbeat the first time a job is submitted """
+        with self._lock:
+            if not self._threads:
+                thread = threading.Thread(target=self._beat, name='job-heartbeat')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            while len(self._threads) < self.workers + 1:
+                thread = threading.Thread(target=self._work,
+                                          name='job-worker-{}'.format(len(self._threads) - 1))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _beat(self, interval=JOB_HEARTBEAT_INTERVAL):
+        """ Saves the queued and running jobs that haven't been saved for an interval """
+        while True:
+            time.sleep(interval)
+            self.heartbeat(interval)
+
+    def heartbeat(self, interval=JOB_HEARTBEAT_INTERVAL):
+        """ Saves every queued or running job last saved more than interval seconds ago """
+        with self._lock:
+            live = list(self._live.values())
+        for job in live:
+            if time.time() - job._saved >= interval:   # pylint: disable=protected-access
+                self.save(job)
+
+    def _work(self):
+        """ Runs queued jobs one after the other """
+        while True:
+            job, func = self._queue.get()
+            self._run(job, func)
+
+    def _run(self, job, func):
+        """ Runs a job and records how it ended """
+        job.state = RUNNING
+        job.started = time.time()
+        self.save(job)
+        try:
+            job.result = func(job)
+            job.state = FINISHED
+        except Exception as err:    # pylint: disable=broad-except
+            logger.error('Job %s (%s) failed: %s', job.id, job.name, err)
+            job.error = str(err)
+            job.state = FAILED
+        job.finished = time.time()
+        self._done(job)
+
+
+jobs = JobRunner()
@@ -0,0 +1,60 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+In-process service metrics
+
+A small thread safe registry of named counters and gauges. They are
+per worker process and are reported by ``GET /metrics``.
+"""
+
+import threading
+
+
+class Metrics(object):
+    """ Thread safe registry of named counters """
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        """ Adds value to the named counter """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """ Sets a gauge to its latest value """
+        with self._lock:
+            self._counters[name] = value
+
+    def get(self, name):
+        """ Returns the value of a counter """
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self):
+        """ Returns a copy of every counter """
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        """ Sets every counter back to zero """
+        with self._lock:
+            self._counters.clear()
+
+
+# the registry used by the whole service
+metrics = Metrics()
@@ -33,11 +33,33 @@ Docker Note:
 
 import os
 import json
+import time
+import uuid
 import logging
-from retry import retry
+import threading
 from cloudant.client import Cloudant
-from cloudant.query import Query
+from cloudant.document import Document
+from cloudant.design_document import DesignDocument
+from cloudant.view import View
 from requests import HTTPError, ConnectionError
+from requests.utils import quote
+from app.cache import connect_to_redis, create_cache, is_tombstone
+from app.invalidation import InvalidationBus, index_keys, FLUSH_ALL
+from app.result_cache import ResultCache
+from app.retries import retry
+from app.singleflight import SingleFlight
+from app.metrics import metrics
+from app.bloom import BloomFilter
+from app.scan import ParallelScanner
+from app.intervals import IntervalIndex, parse_time, now, is_active
+from app.sweeper import Sweeper
+from app.discounts import discount_fields, discount_query
+from app.search import PrefixTrie, normalize, prefix_range
+from app.top import TopIndex
+from app.bitmaps import BitmapIndex, parse_filter, document_values, matches
+from app.design import DesignManager
+from app.profiler import QueryProfiler
+from app.replica import SQLiteReplica, UnsupportedQuery, REPLICA_MODE
 
 # get configruation from enviuronment (12-factor)
 ADMIN_PARTY = os.environ.get('ADMIN_PARTY', 'False').lower() == 'true'
@@ -50,24 +72,221 @@ RETRY_COUNT = int(os.environ.get('RETRY_COUNT', 10))
 RETRY_DELAY = int(os.environ.get('RETRY_DELAY', 1))
 RETRY_BACKOFF = int(os.environ.get('RETRY_BACKOFF', 2))
 
+# page size of bulk updates by filter
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 200))
+
+# seconds between rebuilds of the in memory indexes and the productid filter,
+# which pick up any write the invalidation bus didn't deliver
+INDEX_REBUILD_INTERVAL = int(os.environ.get('INDEX_REBUILD_INTERVAL', 900))
+
+# page size of the queries behind the finders
+QUERY_PAGE_SIZE = int(os.environ.get('QUERY_PAGE_SIZE', 200))
+
+# fields that a bulk update may change
+UPDATABLE_FIELDS = ['productid', 'category', 'available', 'discount', 'start', 'end',
+                    'expires']
+
+# sort orders of the list queries (a leading - sorts descending)
+SORT_FIELDS = {'discount': 'discount_value'}
+
+# view options of the count and stats queries: by default they answer
+# from the index as it is and never wait for it to be brought up to date
+STATS_STABLE = os.environ.get('STATS_STABLE', 'False').lower() == 'true'
+STATS_UPDATE = os.environ.get('STATS_UPDATE', 'lazy')
+
+# attempts at a write that keeps conflicting with other writers
+CONFLICT_RETRIES = int(os.environ.get('CONFLICT_RETRIES', 5))
+
+# design document with the server side update functions
+DESIGN_DOC = '_design/promotions'
+PATCH_MISSING = 'promotion_missing'
+PATCH_FUNCTION = '''function(doc, req) {
+  if (!doc) {
+    return [null, {code: 404, json: {error: 'not_found', reason: 'promotion_missing'}}];
+  }
+  var changes = JSON.parse(req.body);
+  var previous = {};
+  for (var field in changes) {
+    if (field.charAt(0) !== '_') {
+      previous[field] = doc[field];
+      doc[field] = changes[field];
+    }
+  }
+  return [doc, {json: {doc: doc, previous: previous}}];
+}'''
+
+# design document with the map/reduce views behind the counts and stats
+STATS_DOC = '_design/stats'
+STATS_GROUPS = {
+    'category': 'doc.category_key',
+    'available': 'doc.available',
+    'discount_type': 'doc.discount_type'
+}
+COUNT_MAP = '''function(doc) {
+  if (doc.productid !== undefined) {
+    emit(%s, null);
+  }
+}'''
+DISCOUNT_MAP = '''function(doc) {
+  if (doc.productid !== undefined && typeof doc.discount_value === 'number') {
+    emit(%s, doc.discount_value);
+  }
+}'''
+STATS_VIEWS = dict(('count_by_' + group, {'map': COUNT_MAP % key, 'reduce': '_count'})
+                   for group, key in STATS_GROUPS.items())
+STATS_VIEWS.update(('discount_by_' + group, {'map': DISCOUNT_MAP % key, 'reduce': '_stats'})
+                   for group, key in STATS_GROUPS.items())
+
+# design documents and query indexes, deployed by app.design.DesignManager
+DESIGN_DOCUMENTS = {
+    'promotions': {'updates': {'patch': PATCH_FUNCTION}},
+    'stats': {'views': STATS_VIEWS}
+}
+QUERY_INDEXES = {
+    'productid': [{'productid': 'asc'}],
+    'category': [{'category': 'asc'}],
+    'window': [{'productid': 'asc'}, {'start': 'asc'}],
+    'expires': [{'expires': 'asc'}],
+    'discount_value': [{'discount_value': 'asc'}],
+    'discount_type_value': [{'discount_type': 'asc'}, {'discount_value': 'asc'}],
+    'category_discount': [{'category_key': 'asc'}, {'discount_value': 'asc'}],
+    'category_key': [{'category_key': 'asc'}]
+}
+
+def derived_fields(category, discount):
+    """ Returns the fields stored for searching that are worked out from others """
+    fields = discount_fields(category, discount)
+    fields['category_key'] = normalize(category)
+    return fields
+
+# fields that derived_fields() adds to every document
+DERIVED_FIELDS = ['discount_value', 'discount_type', 'category_key']
+
+def selector_for(filters, migrated=True):
+    """
+    Returns the selector that matches category, productid and discount
+    filters the way the finders do: category ignoring case and discount
+    on its number (see discount_query).
+
+    Unless migrated, documents that don't have the derived fields yet are
+    matched on category and discount as they were written.
+    """
+    clauses = []
+    if filters.get('productid'):
+        clauses.append({'productid': filters['productid']})
+    if filters.get('category'):
+        clauses.append({'category_key': normalize(filters['category'])})
+        if not migrated:
+            clauses[-1] = {'$or': [clauses[-1], {'category_key': {'$exists': False},
+                                                 'category': filters['category']}]}
+    if filters.get('discount'):
+        value, discount_type = discount_query(filters['discount'])
+        if value is None:
+            clauses.append({'discount': filters['discount']})
+        else:
+            clauses.append({'discount_value': value})
+            if discount_type:
+                clauses[-1]['discount_type'] = discount_type
+            if not migrated:
+                clauses[-1] = {'$or': [clauses[-1], {'discount_value': {'$exists': False},
+                                                     'discount': filters['discount']}]}
+    selector = {}
+    for clause in clauses:
+        if set(clause) & set(selector):
+            return {'$and': clauses}
+        selector.update(clause)
+    return selector
+
 class DataValidationError(Exception):
     """ Custom Exception with data validation fails """
     pass
 
+class ConflictError(Exception):
+    """ A write kept conflicting with other writers and was given up """
+    pass
+
+def check_changes(changes, updatable=UPDATABLE_FIELDS):
+    """
+    Returns changes with the times normalized
+
+    :param updatable: the fields that may be changed
+    :raises DataValidationError: if changes can't be applied to a Promotion
+    """
+    unknown = set(changes) - set(updatable)
+    if unknown:
+        raise DataValidationError('Fields cannot be updated: {}'.format(', '.join(sorted(unknown))))
+    if 'productid' in changes and changes['productid'] is None:
+        raise DataValidationError('productid attribute is not set')
+    if 'available' in changes and not isinstance(changes['available'], bool):
+        raise DataValidationError('available must be true or false')
+    changes = dict(changes)
+    try:
+        for field in ('start', 'end', 'expires'):
+            if field in changes:
+                changes[field] = parse_time(changes[field])
+    except ValueError as error:
+        raise DataValidationError(str(error))
+    if changes.get('start') and changes.get('end') and changes['end'] <= changes['start']:
+        raise DataValidationError('end must be after start')
+    return changes
+
+
+def is_conflict(error):
+    """ True if an HTTPError is a 409 Conflict rather than a transient failure """
+    return error.response is not None and error.response.status_code == 409
+
 class Promotion(object):
     """ Promotion interface to database """
 
     logger = logging.getLogger(__name__)
     client = None   # cloudant.client.Cloudant
     database = None # cloudant.database.CloudantDatabase
+    cache = None    # app.cache.TieredCache
+    bus = None      # app.invalidation.InvalidationBus
+    sweeper = None  # app.sweeper.Sweeper
+    design = None   # app.design.DesignManager
+    replica = None  # app.replica.SQLiteReplica, when REPLICA_MODE is on
+    results = None  # app.result_cache.ResultCache
+    find_flight = SingleFlight('find')
+    query_flight = SingleFlight('find_by')
+    profiler = QueryProfiler()  # times the finder queries
+    productids = BloomFilter()  # productids that have promotions
+    windows = IntervalIndex()   # when each promotion is active
+    indexes_ready = False
+    fields_migrated = False     # every document has the derived fields, as of the last scan
+    rebuild_lock = threading.Lock()
+    rebuild_thread = None       # the thread rebuilding the indexes
+    rebuild_pending = False     # another rebuild was asked for while one ran
+    refresh_thread = None       # the thread that rebuilds every INDEX_REBUILD_INTERVAL
+    windows_building = None     # the index being rebuilt, which also gets new writes
+    stale_ids = set()           # ids other workers changed since they were indexed
+    categories = PrefixTrie()   # every category, for autocomplete
+    categories_building = None  # the trie being rebuilt, which also gets new writes
+    top_discounts = TopIndex()  # the best discounts of each category
+    bitmaps = BitmapIndex()     # the Promotions with each available, category and discount
+    bitmaps_building = None     # the bitmaps being rebuilt, which also get new writes
 
-    def __init__(self, productid=None, category=None, available=True, discount=None):
+    def __init__(self, productid=None, category=None, available=True, discount=None,
+                 start=None, end=None, expires=None):
         """ Constructor """
         self.id = None
         self.productid = productid
         self.category = category
         self.available = available
         self.discount = discount
+        self.start = start
+        self.end = end
+        self.expires = expires
+
+    @property
+    def discount_value(self):
+        """ The number in the discount, e.g. 20 for '20%' """
+        return discount_fields(self.category, self.discount)['discount_value']
+
+    @property
+    def discount_type(self):
+        """ What the discount_value is: percent, amount or bogo """
+        return discount_fields(self.category, self.discount)['discount_type']
 
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
@@ -77,7 +296,9 @@ class Promotion(object):
         """
         if self.productid is None:   # productid is the only required field
             raise DataValidationError('productid attribute is not set')
+        self.check_window()
 
+        Promotion.productids.add(self.productid)
         try:
             document = self.database.create_document(self.serialize())
         except HTTPError as err:
@@ -86,20 +307,238 @@ class Promotion(object):
 
         if document.exists():
             self.id = document['_id']
+            Promotion.cache_document(document)
+
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def create_many(cls, promotions):
+        """
+        Creates many Promotions with a single _bulk_docs request
+
+        Ids are assigned before the request so a retry can't create
+        duplicates. Returns the per document errors from Cloudant.
+        """
+        for promotion in promotions:
+            if promotion.productid is None:
+                raise DataValidationError('productid attribute is not set')
+            promotion.check_window()
+            if not promotion.id:
+                promotion.id = uuid.uuid4().hex
+            cls.productids.add(promotion.productid)
+
+        results = cls.database.bulk_docs([promotion.serialize() for promotion in promotions])
+        errors = []
+        keys = set()
+        for promotion, result in zip(promotions, results):
+            if 'error' in result:
+                errors.append(result)
+            else:
+                keys.update(index_keys(promotion.serialize()))
+                cls.index_document(promotion.serialize())
+                cls.replicate(dict(promotion.serialize(), _rev=result['rev']))
+        cls.publish_keys([promotion.id for promotion in promotions], keys)
+        return errors
+
+
+    @classmethod
+    def update_where(cls, selector, changes, batch_size=BULK_BATCH_SIZE, progress=None):
+        """
+        Applies changes to every Promotion that matches a selector
+
+        Matches are read a page at a time and written back with one
+        _bulk_docs request per page, so memory stays bounded. Documents
+        that already have the changes are skipped.
+
+        :param selector: Cloudant Query selector, e.g. {'category': 'BOGO'}
+        :param changes: dictionary of field values to set
+        :param progress: optional function called with the summary after each page
+        :returns: {'matched': n, 'updated': n, 'failed': n}
+        """
+        changes = cls.check_changes(changes)
+        summary = {'matched': 0, 'updated': 0, 'failed': 0}
+        for page in cls.pages_where(selector, batch_size):
+            summary['matched'] += len(page)
+            previous = [document for document in page
+                        if any(document.get(name) != value for name, value in changes.items())]
+            documents = [dict(document, **changes) for document in previous]
+            if 'discount' in changes or 'category' in changes:
+                for document in documents:
+                    document.update(derived_fields(document.get('category'),
+                                                   document.get('discount')))
+            if documents:
+                updated = cls.write_page(documents, previous)
+                summary['updated'] += updated
+                summary['failed'] += len(documents) - updated
+            if progress:
+                progress(dict(summary))
+        return summary
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def query_page(cls, selector, limit, bookmark=None, fields=None):
+        """ Returns one page of a query as (documents, bookmark) """
+        params = {'bookmark': bookmark} if bookmark else {}
+        params.update(cls.index_hint(selector=selector))
+        result = cls.database.get_query_result(selector, fields=fields, raw_result=True,
+                                               limit=limit, **params)
+        return result.get('docs', []), result.get('bookmark')
+
+    @classmethod
+    def count_where(cls, selector, limit):
+        """ Returns how many Promotions match a selector, counting up to limit """
+        documents, _ = cls.query_page(selector or {'_id': {'$gt': None}}, limit, fields=['_id'])
+        return len(documents)
+
+    @classmethod
+    def pages_where(cls, selector, batch_size=BULK_BATCH_SIZE):
+        """ Yields the documents matching a selector a page at a time """
+        bookmark = None
+        while True:
+            documents, bookmark = cls.query_page(selector or {'_id': {'$gt': None}},
+                                                 batch_size, bookmark)
+            if documents:
+                yield documents
+            if len(documents) < batch_size or not bookmark:
+                return
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def write_page(cls, documents, previous):
+        """ Writes changed documents with _bulk_docs and returns how many were saved """
+        results = cls.database.bulk_docs(documents)
+        keys = set()
+        saved = 0
+        for document, result in zip(documents, results):
+            if 'error' in result:
+                if result['error'] == 'conflict':
+                    metrics.increment('writes.bulk.conflicts')
+                cls.logger.warning('Bulk update of %s failed: %s', document['_id'], result['error'])
+                continue
+            saved += 1
+            document['_rev'] = result['rev']
+            cls.productids.add(document.get('productid'))
+            cls.index_document(document)
+            cls.replicate(document)
+            if cls.cache:
+                cls.cache.put(document['_id'], document)
+            keys.update(index_keys(document))
+        for document in previous:
+            keys.update(index_keys(document))
+        cls.publish_keys([document['_id'] for document in documents], keys)
+        return saved
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_expired(cls, at, limit=BULK_BATCH_SIZE):
+        """ Returns up to limit documents that expired by a time, oldest first """
+        selector = {'expires': {'$type': 'string', '$lte': at}}
+        sort = [{'expires': 'asc'}]
+        result = cls.database.get_query_result(selector, raw_result=True, limit=limit, sort=sort,
+                                               fields=['_id', '_rev', 'productid', 'category',
+                                                       'available', 'discount'],
+                                               **cls.index_hint('expires', selector, sort))
+        return result.get('docs', [])
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def delete_many(cls, documents):
+        """ Deletes documents with _bulk_docs and returns how many were deleted """
+        results = cls.database.bulk_docs([{'_id': document['_id'], '_rev': document['_rev'],
+                                           '_deleted': True} for document in documents])
+        keys = set()
+        deleted = []
+        for document, result in zip(documents, results):
+            if 'error' in result:   # changed since it was read, the next sweep retries
+                cls.logger.warning('Bulk delete of %s failed: %s', document['_id'], result['error'])
+                continue
+            deleted.append(document['_id'])
+            if cls.cache:
+                cls.cache.delete(document['_id'], result['rev'])
+            cls.unindex_document(document['_id'])
+            cls.replicate({'_id': document['_id'], '_rev': result['rev'], '_deleted': True})
+            keys.update(index_keys(document))
+        if deleted:
+            cls.publish_keys(deleted, keys)
+        return len(deleted)
+
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def patch(cls, promotion_id, changes):
+        """
+        Changes some fields of a Promotion with a single request
+
+        The read-modify-write happens inside the database in the patch
+        update function of DESIGN_DOC, which is called again straight
+        away if another writer got in first (409 Conflict).
+        Returns the updated Promotion or None if it doesn't exist.
+        """
+        if not changes:
+            return cls.find(promotion_id)
+        changes = cls.check_changes(changes)
+        if 'discount' in changes or 'category' in changes:
+            current = {} if 'discount' in changes and 'category' in changes else \
+                cls.fetch_document(promotion_id) or {}
+            changes.update(derived_fields(changes.get('category', current.get('category')),
+                                          changes.get('discount', current.get('discount'))))
+        url = '/'.join([DesignDocument(cls.database, DESIGN_DOC).document_url,
+                        '_update', 'patch', quote(promotion_id, safe='')])
+        metrics.increment('writes.patch')
+        for _ in range(CONFLICT_RETRIES):
+            resp = cls.database.r_session.put(url, data=json.dumps(changes),
+                                              headers={'Content-Type': 'application/json'})
+            if resp.status_code == 409:
+                metrics.increment('writes.patch.conflicts')
+                continue
+            if resp.status_code == 404:
+                if resp.json().get('reason') == PATCH_MISSING:
+                    return None
+                cls.design.publish()    # someone removed the update function
+                continue
+            break
+        else:
+            metrics.increment('writes.patch.exhausted')
+            raise ConflictError("Promotion '{}' is being changed by too many writers".format(promotion_id))
+        resp.raise_for_status()
+        result = resp.json()
+        document = result['doc']
+        document['_rev'] = resp.headers['X-Couch-Update-NewRev']
+        previous = dict(document, **result['previous'])
+        cls.productids.add(document.get('productid'))
+        cls.cache_document(document, previous)
+        promotion = Promotion().deserialize(document)
+        promotion.id = document['_id']
+        return promotion
+
+    @staticmethod
+    def check_changes(changes):
+        """ Returns changes with the times normalized (see check_changes) """
+        return check_changes(changes)
 
 
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def update(self):
         """ Updates a Promotion in the database """
-        try:
-            document = self.database[self.id]
-        except KeyError:
-            document = None
-        if document:
+        self.check_window()
+        Promotion.productids.add(self.productid)
+
+        def apply_update(document):
+            """ Puts this Promotion's fields onto the latest revision """
             document.update(self.serialize())
             document.save()
 
+        document, previous = Promotion.merge_write(self.id, 'update', apply_update)
+        if document:
+            Promotion.cache_document(document, previous)
+
 
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
@@ -117,13 +556,58 @@ class Promotion(object):
            logger=logger)
     def delete(self):
         """ Deletes a Promotion from the database """
+        document, previous = Promotion.merge_write(self.id, 'delete', Document.delete)
+        if document is not None:
+            Promotion.uncache_document(previous)
+
+    @classmethod
+    def merge_write(cls, promotion_id, operation, write):
+        """
+        Runs write(document) on the latest revision of a document
+
+        A 409 Conflict means another writer saved first, so the latest
+        revision is read again and the write is reapplied straight away,
+        up to CONFLICT_RETRIES times, without the backoff that @retry uses
+        for transient errors.
+
+        :returns: (document, previous contents) or (None, None) if missing
+        :raises ConflictError: if every attempt conflicted
+        """
+        metrics.increment('writes.' + operation)
+        for _ in range(CONFLICT_RETRIES):
+            document = Document(cls.database, promotion_id)
+            try:
+                document.fetch()
+            except HTTPError as err:
+                if err.response is not None and err.response.status_code == 404:
+                    return None, None
+                raise
+            previous = dict(document)
+            try:
+                write(document)
+                return document, previous
+            except HTTPError as err:
+                if not is_conflict(err):
+                    raise
+                metrics.increment('writes.{}.conflicts'.format(operation))
+        metrics.increment('writes.{}.exhausted'.format(operation))
+        raise ConflictError("Promotion '{}' is being changed by too many writers".format(promotion_id))
+
+
+    def check_window(self):
+        """ Normalizes start, end and expires to UTC ISO 8601 and checks the order """
         try:
-            document = self.database[self.id]
-        except KeyError:
-            document = None
-        if document:
-            document.delete()
+            self.start = parse_time(self.start)
+            self.end = parse_time(self.end)
+            self.expires = parse_time(self.expires)
+        except ValueError as error:
+            raise DataValidationError('Invalid promotion: {}'.format(error))
+        if self.start and self.end and self.end <= self.start:
+            raise DataValidationError('Invalid promotion: end must be after start')
 
+    def is_active(self, at=None):
+        """ True if the window of the Promotion contains a time, by default now """
+        return is_active(self.start, self.end, at or now())
 
     def serialize(self):
         """ serializes a Promotion into a dictionary """
@@ -131,8 +615,12 @@ class Promotion(object):
             "productid": self.productid,
             "category": self.category,
             "available": self.available,
-            "discount": self.discount
+            "discount": self.discount,
+            "start": self.start,
+            "end": self.end,
+            "expires": self.expires
         }
+        promotion.update(derived_fields(self.category, self.discount))
         if self.id:
             promotion['_id'] = self.id
         return promotion
@@ -149,10 +637,14 @@ class Promotion(object):
             self.category = data['category']
             self.available = data['available']
             self.discount = data['discount']
+            self.start = data.get('start')
+            self.end = data.get('end')
+            self.expires = data.get('expires')
         except KeyError as error:
             raise DataValidationError('Invalid promotion: missing ' + error.args[0])
-        except TypeError as error:
+        except (TypeError, AttributeError) as error:
             raise DataValidationError('Invalid promotion: body of request contained bad or no data')
+        self.check_window()
 
         # if there is no id and the data has one, assign it
         if not self.id and '_id' in data:
@@ -165,6 +657,11 @@ class Promotion(object):
 #  S T A T I C   D A T A B S E   M E T H O D S
 ######################################################################
 
+    @classmethod
+    def doc_count(cls):
+        """ Returns the number of documents in the database """
+        return cls.database.doc_count()
+
     @classmethod
     def connect(cls):
         """ Connect to the server """
@@ -182,13 +679,42 @@ class Promotion(object):
         """ Creates a new query index for searching """
         cls.database.create_query_index(index_name=field_name, fields=[{field_name: order}])
 
+    @classmethod
+    def index_hint(cls, name=None, selector=None, sort=None):
+        """
+        Returns the query parameters that pin a query to a built index
+
+        The named index if it is built, otherwise what DesignManager.query_hint
+        returns for the selector and sort so no query waits on an index build.
+        """
+        if not cls.design:
+            return {}
+        ddoc = cls.design.use_index(name) if name else None
+        if ddoc:
+            return {'use_index': ddoc}
+        return cls.design.query_hint(sorted(selector or {}), sort)
+
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def remove_all(cls):
         """ Removes all documents from the database (use for testing)  """
         for document in cls.database:
-            document.delete()
+            if not document['_id'].startswith('_design/'):
+                document.delete()
+        if cls.cache:
+            cls.cache.clear()
+        if cls.results:
+            cls.results.clear()
+        cls.productids.rebuild([])
+        cls.windows.clear()
+        cls.categories.clear()
+        cls.top_discounts.clear()
+        cls.bitmaps.clear()
+        if cls.replica:
+            cls.replica.clear()
+        if cls.bus:
+            cls.bus.publish(keys=[FLUSH_ALL])
 
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
@@ -196,12 +722,33 @@ class Promotion(object):
     def all(cls):
         """ Query that returns all Promotions """
         results = []
-        for doc in cls.database:
+        for doc in cls.replica.all() if cls.use_replica() else cls.scan():
             promotion = Promotion().deserialize(doc)
             promotion.id = doc['_id']
             results.append(promotion)
         return results
 
+    @classmethod
+    def scan(cls, ordered=True):
+        """
+        Yields every promotion document using concurrent key range reads
+
+        :param ordered: False to get documents as soon as any range has them
+        """
+        return ParallelScanner(cls.database).scan(ordered)
+
+    @classmethod
+    def changes_since(cls, since):
+        """ Yields the documents changed after a sequence token, deletions included """
+        for change in cls.database.changes(since=since, include_docs=True, style='main_only'):
+            if 'id' in change and not change['id'].startswith('_design/'):
+                yield change.get('doc') or {'_id': change['id'], '_deleted': True}
+
+    @classmethod
+    def update_seq(cls):
+        """ Returns the sequence token of the latest change to the database """
+        return cls.database.metadata()['update_seq']
+
 ######################################################################
 #  F I N D E R   M E T H O D S
 ######################################################################
@@ -211,38 +758,423 @@ class Promotion(object):
            logger=logger)
     def find_by(cls, **kwargs):
         """ Find records using selector """
-        query = Query(cls.database, selector=kwargs)
+        return cls.find_where(kwargs)
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_where(cls, selector, sort=None):
+        """
+        Find records using a Cloudant Query selector and optional sort
+
+        Every query is timed by the profiler, which logs the slow ones
+        with their plan (see app.profiler).
+        """
+        def run_query():
+            """ Runs the query once for every caller waiting on it """
+            return cls.run_find(selector, sort)
+
+        if cls.profiler.capturing:     # explaining: run it here to capture the plan
+            documents = run_query()
+        else:
+            documents = cls.select_replica(selector, sort)
+        if documents is None:
+            key = json.dumps([selector, sort], sort_keys=True)
+            documents = cls.query_flight.do(key, run_query)
         results = []
-        for doc in query.result:
+        for doc in documents:
             promotion = Promotion()
             promotion.deserialize(doc)
             results.append(promotion)
         return results
 
+    @classmethod
+    def select_replica(cls, selector, sort=None):
+        """ Runs a query on the local replica, or returns None if it must go to Cloudant """
+        if not cls.use_replica():
+            return None
+        try:
+            return cls.replica.select(selector, sort)
+        except UnsupportedQuery:
+            metrics.increment('replica.unsupported')
+            return None
+
+    @classmethod
+    def run_find(cls, selector, sort=None, page_size=QUERY_PAGE_SIZE):
+        """ Runs a query a page at a time, records its timing and returns its documents """
+        query = {'selector': selector, 'limit': page_size, 'execution_stats': True}
+        if sort:
+            query['sort'] = sort
+        query.update(cls.index_hint(selector=selector, sort=sort))
+        documents = []
+        stats = {}
+        started = time.time()
+        while True:
+            result = cls.post_query('_find', query)
+            documents.extend(result.get('docs', []))
+            for name, value in result.get('execution_stats', {}).items():
+                stats[name] = stats.get(name, 0) + value
+            if len(result.get('docs', [])) < page_size or not result.get('bookmark'):
+                break
+            query['bookmark'] = result['bookmark']
+        query.pop('bookmark', None)
+        cls.profiler.record(selector, sort, (time.time() - started) * 1000, stats,
+                            lambda: cls.post_query('_explain', query))
+        return documents
+
+    @classmethod
+    def post_query(cls, endpoint, query):
+        """ Posts a query to _find or _explain and returns the response """
+        resp = cls.database.r_session.post('/'.join((cls.database.database_url, endpoint)),
+                                           data=json.dumps(query),
+                                           headers={'Content-Type': 'application/json'})
+        resp.raise_for_status()
+        return resp.json()
+
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def find(cls, promotion_id):
         """ Query that finds Promotions by their id """
-        try:
-            document = cls.database[promotion_id]
-            return Promotion().deserialize(document)
-        except KeyError:
+        def load_document():
+            """ Fetches and caches the document once for every caller waiting on it """
+            if cls.use_replica():
+                document = cls.replica.get(promotion_id)
+            else:
+                document = cls.fetch_document(promotion_id)
+            if cls.cache:
+                if document is None:
+                    cls.cache.put_missing(promotion_id)
+                else:
+                    cls.cache.put(promotion_id, document)
+            return document
+
+        document = cls.cache.get(promotion_id) if cls.cache else None
+        if document is None:
+            metrics.increment('cache.find.miss')
+            document = cls.find_flight.do(promotion_id, load_document)
+            if document is None:
+                return None
+        else:
+            metrics.increment('cache.find.hit')
+        if is_tombstone(document):
+            metrics.increment('cache.find.negative')
             return None
+        return Promotion().deserialize(document)
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_many(cls, promotion_ids):
+        """
+        Query that finds many Promotions by their ids
+
+        Ids that aren't cached are read with one _all_docs keys request.
+        Returns a dictionary of id to Promotion, or None if not found.
+        """
+        results = {}
+        missing = []
+        for promotion_id in set(promotion_ids):
+            document = cls.cache.get(promotion_id) if cls.cache else None
+            if document is None:
+                missing.append(promotion_id)
+            elif is_tombstone(document):
+                results[promotion_id] = None
+            else:
+                results[promotion_id] = Promotion().deserialize(document)
+        if missing and cls.use_replica():
+            rows = [{'key': key, 'doc': document}
+                    for key, document in cls.replica.get_many(missing).items()]
+        elif missing:
+            rows = cls.database.all_docs(keys=missing, include_docs=True).get('rows', [])
+        if missing:
+            for row in rows:
+                document = row.get('doc')
+                if document:
+                    if cls.cache:
+                        cls.cache.put(row['key'], document)
+                    results[row['key']] = Promotion().deserialize(document)
+                else:
+                    if cls.cache:
+                        cls.cache.put_missing(row['key'])
+                    results[row['key']] = None
+        return results
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_by_productids(cls, productids):
+        """
+        Query that finds the Promotions for many productids
+
+        Uses one $in query on the productid index. Returns a dictionary of
+        productid to the list of its Promotions.
+        """
+        results = dict((productid, []) for productid in productids)
+        wanted = sorted(productid for productid in results if cls.may_have_productid(productid))
+        if wanted:
+            for promotion in cls.find_by(productid={'$in': wanted}):
+                if promotion.productid in results:
+                    results[promotion.productid].append(promotion)
+        return results
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_active(cls, at=None, productid=None):
+        """
+        Query that finds the available Promotions active at a time
+
+        Uses the in memory interval index for the present and future (it
+        prunes windows that have ended) and a Cloudant Query for the past
+        or while the index is still loading.
+
+        :param at: ISO 8601 UTC time, defaults to now
+        :param productid: optional productid to limit the Promotions to
+        """
+        try:
+            at = parse_time(at) or now()
+        except ValueError as error:
+            raise DataValidationError(str(error))
+        if not cls.indexes_ready or at < now():
+            return cls.query_active(at, productid)
+        metrics.increment('windows.index.queries')
+        cls.refresh_indexes()
+        ids = cls.windows.active(at, productid)
+        promotions = cls.find_many(ids).values() if ids else []
+        return [promotion for promotion in promotions
+                if promotion and promotion.available]
+
+    @classmethod
+    def query_active(cls, at, productid=None):
+        """
+        Finds the available Promotions active at a time with Cloudant Query
+
+        Open starts and started windows are two range queries on the
+        (productid, start) index; an $or on start could not use it. Until
+        every document has been migrated the ones written without a start
+        or end are matched too, which needs a full scan.
+        """
+        if not cls.fields_migrated:
+            selector = {
+                'available': True,
+                '$and': [
+                    {'$or': [{'start': {'$exists': False}}, {'start': None},
+                             {'start': {'$lte': at}}]},
+                    {'$or': [{'end': {'$exists': False}}, {'end': None}, {'end': {'$gt': at}}]}
+                ]
+            }
+            if productid is not None:
+                selector['productid'] = productid
+            return cls.find_by(**selector)
+        results = []
+        for start in (None, {'$gt': None, '$lte': at}):
+            results.extend(cls.find_by(**{
+                'productid': productid if productid is not None else {'$gt': None},
+                'start': start,
+                'available': True,
+                '$or': [{'end': None}, {'end': {'$gt': at}}]
+            }))
+        return results
+
+    @classmethod
+    def refresh_indexes(cls):
+        """ Reindexes the documents other workers changed """
+        if not cls.stale_ids:
+            return
+        ids = list(cls.stale_ids)
+        cls.stale_ids.difference_update(ids)
+        for promotion_id, promotion in cls.find_many(ids).items():
+            if promotion is None:
+                cls.unindex_document(promotion_id)
+            else:
+                cls.index_document(promotion.serialize())
 
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def find_by_productid(cls, productid):
         """ Query that finds Promotions by their productid """
+        if not cls.may_have_productid(productid):
+            metrics.increment('bloom.productid.skipped')
+            return []
         return cls.find_by(productid=productid)
 
+    @classmethod
+    def may_have_productid(cls, productid):
+        """
+        False only if productid definitely has no Promotions
+
+        The productid filter only learns of other workers' writes through
+        the invalidation bus, so a miss is trusted only while the filter
+        is built and the bus is connected. Otherwise the query is made.
+        """
+        if not cls.indexes_ready or cls.bus is None or not cls.bus.connected:
+            return True
+        return productid in cls.productids
+
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def find_by_category(cls, category):
-        """ Query that finds Promotions by their category """
-        return cls.find_by(category=category)
+        """ Query that finds Promotions by their category, ignoring case """
+        return cls.find_where(cls.filter_selector({'category': category}))
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_by_category_prefix(cls, prefix):
+        """ Query that finds Promotions whose category starts with prefix, ignoring case """
+        return cls.find_where({'category_key': prefix_range(prefix)})
+
+    @classmethod
+    def query_view(cls, name, stable=None, update=None, **kwargs):
+        """ Returns the rows of a stats view, by default without waiting on its index """
+        stable = STATS_STABLE if stable is None else stable
+        update = STATS_UPDATE if update is None else update
+        if update not in ('true', 'false', 'lazy'):
+            raise DataValidationError('update must be true, false or lazy')
+        view = View(DesignDocument(cls.database, STATS_DOC), name)
+        return view(stable=stable, update=update, **kwargs).get('rows', [])
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def count(cls, field=None, value=None, stable=None, update=None):
+        """
+        Returns the number of Promotions, or of those with a field value
+
+        :param field: optional field in STATS_GROUPS to count by
+        :param value: the value of field to count
+        """
+        if field is None:
+            rows = cls.query_view('count_by_available', stable, update)
+        elif field in STATS_GROUPS:
+            if field == 'category':
+                value = normalize(value)
+            rows = cls.query_view('count_by_' + field, stable, update, key=value)
+        else:
+            raise DataValidationError('Promotions can not be counted by {}'.format(field))
+        return rows[0]['value'] if rows else 0
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def stats(cls, group=None, stable=None, update=None):
+        """
+        Returns the count and discount statistics of the Promotions
+
+        With a group (category, available or discount_type) there is one
+        row per value of that field, otherwise a single row for them all.
+        The discount sum, count, min, max and avg only cover the
+        Promotions whose discount is a number.
+        """
+        if group is not None and group not in STATS_GROUPS:
+            raise DataValidationError('group must be one of {}'.format(
+                ', '.join(sorted(STATS_GROUPS))))
+        view = group or 'available'
+        options = {'group': True} if group else {}
+        counts = cls.query_view('count_by_' + view, stable, update, **options)
+        discounts = dict((row['key'], row['value']) for row in
+                         cls.query_view('discount_by_' + view, stable, update, **options))
+        results = []
+        for row in counts:
+            discount = discounts.get(row['key'], {'sum': 0, 'count': 0, 'min': None, 'max': None})
+            discount = dict((name, discount.get(name)) for name in ('sum', 'count', 'min', 'max'))
+            discount['avg'] = (round(float(discount['sum']) / discount['count'], 2)
+                               if discount['count'] else None)
+            result = {'count': row['value'], 'discount': discount}
+            if group:
+                result[group] = row['key']
+            results.append(result)
+        if not group:
+            return results[0] if results else {'count': 0, 'discount': {
+                'sum': 0, 'count': 0, 'min': None, 'max': None, 'avg': None}}
+        return results
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_top(cls, category, n=10):
+        """
+        Query that finds the n available Promotions of a category with the
+        highest discount_value that are active now, best first
+
+        The answer comes from the in memory top list of the category,
+        which is read from the database the first time it is needed.
+        Promotions outside their window are skipped, so the list is read
+        n at a time until n active ones are found.
+        :raises DataValidationError: if n is more than TOP_CAPACITY
+        """
+        if n < 1 or n > cls.top_discounts.capacity:
+            raise DataValidationError('n must be between 1 and {}'.format(cls.top_discounts.capacity))
+        key = normalize(category)
+        at = now()
+        ranked = cls.top_discounts.ranked(key, n)
+        if ranked is None:
+            metrics.increment('top.loads')
+            return [promotion for promotion in cls.load_top(key) if promotion.is_active(at)][:n]
+        results = []
+        for position in range(0, len(ranked), n):
+            ids = ranked[position:position + n]
+            found = cls.find_many(ids)
+            for promotion_id in ids:
+                if found.get(promotion_id) is None:
+                    cls.top_discounts.discard(promotion_id)   # deleted by another worker
+                elif found[promotion_id].is_active(at):
+                    results.append(found[promotion_id])
+            if len(results) >= n:
+                break
+        return results[:n]
+
+    @classmethod
+    def load_top(cls, key):
+        """ Reads the best Promotions of a category into its top list """
+        version = cls.top_discounts.version(key)
+        selector = {'category_key': key, 'discount_value': {'$type': 'number'}, 'available': True}
+        sort = [{'category_key': 'desc'}, {'discount_value': 'desc'}]
+        result = cls.database.get_query_result(
+            selector, raw_result=True, limit=cls.top_discounts.capacity, sort=sort,
+            **cls.index_hint('category_discount', selector, sort))
+        promotions = [Promotion().deserialize(doc) for doc in result.get('docs', [])]
+        cls.top_discounts.load(key, [(promotion.id, promotion.discount_value)
+                                     for promotion in promotions], version)
+        return promotions
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_by_filter(cls, expression, limit=None):
+        """
+        Query that finds Promotions with a filter expression such as
+        'category:bogo AND NOT (available:false OR discount:0-10)'
+
+        The expression is worked out on the bitmap indexes (see
+        app.bitmaps) and only the matches are read. While the indexes
+        are loading every Promotion is read and checked instead.
+        :raises DataValidationError: if the expression is not valid
+        """
+        try:
+            node = parse_filter(expression)
+        except ValueError as error:
+            raise DataValidationError(str(error))
+        if not cls.indexes_ready:
+            results = [promotion for promotion in cls.all()
+                       if matches(node, document_values(promotion.serialize(),
+                                                        promotion.discount_value))]
+            return results[:limit] if limit else results
+        metrics.increment('bitmaps.queries')
+        cls.refresh_indexes()
+        ids = cls.bitmaps.select(node)
+        if limit:
+            ids = ids[:limit]
+        found = cls.find_many(ids) if ids else {}
+        return [found[promotion_id] for promotion_id in ids if found.get(promotion_id)]
+
+    @classmethod
+    def complete_category(cls, prefix, limit=10):
+        """ Returns up to limit known categories that start with prefix """
+        return cls.categories.complete(prefix, limit)
 
     @classmethod
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
@@ -255,8 +1187,286 @@ class Promotion(object):
     @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
            logger=logger)
     def find_by_discount(cls, discount):
-        """ Query that finds Promotions by their productid """
-        return cls.find_by(discount=discount)
+        """
+        Query that finds Promotions by their discount
+
+        A discount with a number matches on the number, so '10' finds
+        '10.0' and '10%' too; '10%' or '$10' also match on the type.
+        """
+        return cls.find_where(cls.filter_selector({'discount': discount}))
+
+    @classmethod
+    def filter_selector(cls, filters):
+        """
+        Returns the selector of the Promotions matching category, productid
+        and discount filters (see selector_for)
+
+        Documents written before the derived fields existed are matched
+        too until a scan finds that every document has them.
+        """
+        return selector_for(filters, cls.fields_migrated)
+
+    @classmethod
+    @retry(HTTPError, delay=RETRY_DELAY, backoff=RETRY_BACKOFF, tries=RETRY_COUNT,
+           logger=logger)
+    def find_by_discount_range(cls, discount_min=None, discount_max=None, discount_type=None,
+                               sort=None):
+        """
+        Query that finds Promotions whose discount is within a range
+
+        :param discount_min: smallest discount_value, or None for no limit
+        :param discount_max: largest discount_value, or None for no limit
+        :param discount_type: only Promotions of this type (percent, amount or bogo)
+        :param sort: 'discount' or '-discount' to sort by discount_value
+        """
+        bounds = {'$type': 'number'}
+        if discount_min is not None:
+            bounds['$gte'] = discount_min
+        if discount_max is not None:
+            bounds['$lte'] = discount_max
+        selector = {'discount_value': bounds}
+        fields = ['discount_value']
+        if discount_type:
+            selector['discount_type'] = discount_type
+            fields = ['discount_type', 'discount_value']    # the order of the index
+        order = None
+        if sort:
+            direction = cls.parse_sort(sort)[1]
+            order = [{name: direction} for name in fields]
+        return cls.find_where(selector, order)
+
+    @staticmethod
+    def parse_sort(sort):
+        """
+        Returns the (field, 'asc' or 'desc') of a sort order such as '-discount'
+
+        :raises DataValidationError: if the field can't be sorted on
+        """
+        name = sort.lstrip('-')
+        if name not in SORT_FIELDS:
+            raise DataValidationError('Cannot sort by {}, use one of: {}'.format(
+                name, ', '.join(sorted(SORT_FIELDS))))
+        return SORT_FIELDS[name], 'desc' if sort.startswith('-') else 'asc'
+
+    @classmethod
+    def migrate_fields(cls, batch_size=BULK_BATCH_SIZE, progress=None):
+        """
+        Backfills the derived fields (see derived_fields) on older documents
+
+        The first page of documents without them is read and written back
+        until there are none left, or until a page can't be written.
+        :returns: {'matched': n, 'updated': n, 'failed': n}
+        """
+        summary = {'matched': 0, 'updated': 0, 'failed': 0}
+        while True:
+            page, _ = cls.query_page({'$or': [{field: {'$exists': False}}
+                                              for field in DERIVED_FIELDS]}, batch_size)
+            if not page:
+                cls.fields_migrated = True
+                break
+            summary['matched'] += len(page)
+            documents = [dict(document, start=document.get('start'), end=document.get('end'),
+                              **derived_fields(document.get('category'),
+                                               document.get('discount')))
+                         for document in page]
+            updated = cls.write_page(documents, page)
+            summary['updated'] += updated
+            summary['failed'] += len(documents) - updated
+            if progress:
+                progress(dict(summary))
+            if updated == 0:
+                break   # every write failed, don't read the same page again
+        return summary
+
+######################################################################
+#  C A C H E   M E T H O D S
+######################################################################
+
+    @classmethod
+    def fetch_document(cls, promotion_id):
+        """ Reads a document from Cloudant bypassing every cache """
+        document = Document(cls.database, promotion_id)
+        try:
+            document.fetch()
+        except HTTPError as err:
+            if err.response is not None and err.response.status_code == 404:
+                return None
+            raise
+        return dict(document)
+
+    @classmethod
+    def cache_document(cls, document, previous=None):
+        """ Puts a saved document into the cache and tells the other workers """
+        if cls.cache:
+            cls.cache.put(document['_id'], dict(document))
+        cls.index_document(document)
+        cls.replicate(document)
+        cls.publish_change(document['_id'], document, previous)
+
+    @classmethod
+    def uncache_document(cls, document):
+        """ Records a deleted document in the cache and tells the other workers """
+        if cls.cache:
+            cls.cache.delete(document['_id'], document.get('_rev'))
+        cls.unindex_document(document['_id'])
+        if cls.replica:
+            cls.replica.delete(document['_id'])
+        cls.publish_change(document['_id'], document)
+
+    @classmethod
+    def replicate(cls, document):
+        """ Applies a write to the local replica so this worker reads its own writes """
+        if cls.replica:
+            cls.replica.put(dict(document))
+
+    @classmethod
+    def use_replica(cls):
+        """ True if reads can go to the local replica, which must be within its lag bound """
+        if cls.replica is None:
+            return False
+        if cls.replica.usable():
+            return True
+        metrics.increment('replica.fallbacks')
+        return False
+
+    @classmethod
+    def publish_change(cls, promotion_id, *documents):
+        """ Invalidates the list results a write touched and tells the other workers """
+        keys = set()
+        for document in documents:
+            keys.update(index_keys(document))
+        cls.publish_keys([promotion_id], keys)
+
+    @classmethod
+    def publish_keys(cls, ids, keys):
+        """ Invalidates the list results for keys and tells the other workers """
+        if cls.results:
+            cls.results.bump(keys)
+        if cls.bus:
+            cls.bus.publish(ids, sorted(keys))
+
+    @classmethod
+    def invalidate(cls, ids, keys):
+        """ Evicts documents another worker changed from the local caches """
+        cls.results.bump(keys)
+        for key in keys:
+            if key.startswith('productid:'):
+                cls.productids.add(key.split(':', 1)[1])
+            elif key.startswith('category:'):
+                cls.categories.add(key.split(':', 1)[1])
+                cls.top_discounts.forget([normalize(key.split(':', 1)[1])])
+        if FLUSH_ALL in keys:
+            # anything may have changed, so the finders query Cloudant while the
+            # indexes are rebuilt rather than answer from indexes that miss writes
+            cls.indexes_ready = False
+            cls.cache.local.clear()
+            cls.top_discounts.clear()
+            cls.start_rebuild()
+            return
+        for promotion_id in ids:
+            cls.cache.local.evict(promotion_id)
+        cls.stale_ids.update(ids)
+
+    @classmethod
+    def start_rebuild(cls):
+        """ Rebuilds the indexes on a background thread, again after the one running """
+        with cls.rebuild_lock:
+            cls.rebuild_pending = True
+            if cls.rebuild_thread is not None:
+                return
+            cls.rebuild_thread = threading.Thread(target=cls.run_rebuilds, name='index-rebuild')
+            cls.rebuild_thread.daemon = True
+            cls.rebuild_thread.start()
+
+    @classmethod
+    def start_refresh(cls, interval=INDEX_REBUILD_INTERVAL):
+        """ Rebuilds the indexes every interval seconds on a background thread """
+        if cls.refresh_thread is not None:
+            return
+
+        def refresh():
+            """ Asks for a rebuild every interval """
+            while True:
+                time.sleep(interval)
+                cls.start_rebuild()
+        cls.refresh_thread = threading.Thread(target=refresh, name='index-refresh')
+        cls.refresh_thread.daemon = True
+        cls.refresh_thread.start()
+
+    @classmethod
+    def run_rebuilds(cls):
+        """ Rebuilds the indexes until no more rebuilds have been asked for """
+        while True:
+            with cls.rebuild_lock:
+                if not cls.rebuild_pending:
+                    cls.rebuild_thread = None
+                    return
+                cls.rebuild_pending = False
+            cls.rebuild_indexes()
+
+    @classmethod
+    def rebuild_indexes(cls):
+        """ Reloads the productid Bloom filter and the in memory indexes in one scan """
+        windows = cls.windows_building = IntervalIndex()
+        categories = cls.categories_building = PrefixTrie()
+        bitmaps = cls.bitmaps_building = BitmapIndex()
+        unmigrated = []
+
+        def productids():
+            """ Yields the productid of every document, indexing it on the way """
+            for doc in cls.scan(ordered=False):
+                if not unmigrated and any(field not in doc for field in DERIVED_FIELDS):
+                    unmigrated.append(doc['_id'])
+                windows.add(doc['_id'], doc.get('productid'), doc.get('start'), doc.get('end'))
+                categories.add(doc.get('category'))
+                value = discount_fields(doc.get('category'), doc.get('discount'))['discount_value']
+                bitmaps.add(doc['_id'], document_values(doc, value))
+                yield doc.get('productid')
+        try:
+            cls.productids.rebuild(productids())
+        except (HTTPError, ConnectionError) as err:
+            Promotion.logger.warning('Rebuilding the productid filter failed: %s', err)
+            return
+        finally:
+            cls.windows_building = None
+            cls.categories_building = None
+            cls.bitmaps_building = None
+        cls.windows = windows
+        cls.categories = categories
+        cls.bitmaps = bitmaps
+        cls.indexes_ready = True
+        cls.fields_migrated = not unmigrated
+        if unmigrated:
+            Promotion.logger.warning('Some Promotions lack the derived search fields, '
+                                     'POST /jobs/migrate to backfill them')
+
+    @classmethod
+    def index_document(cls, document):
+        """ Records when a saved document is active and its category """
+        for windows in (cls.windows, cls.windows_building):
+            if windows is not None:
+                windows.add(document['_id'], document.get('productid'),
+                            document.get('start'), document.get('end'))
+        for categories in (cls.categories, cls.categories_building):
+            if categories is not None:
+                categories.add(document.get('category'))
+        value = discount_fields(document.get('category'), document.get('discount'))['discount_value']
+        cls.top_discounts.add(document['_id'], normalize(document.get('category')),
+                              value if document.get('available') else None)
+        for bitmaps in (cls.bitmaps, cls.bitmaps_building):
+            if bitmaps is not None:
+                bitmaps.add(document['_id'], document_values(document, value))
+
+    @classmethod
+    def unindex_document(cls, promotion_id):
+        """ Removes a deleted document from the in memory indexes """
+        for windows in (cls.windows, cls.windows_building):
+            if windows is not None:
+                windows.discard(promotion_id)
+        cls.top_discounts.discard(promotion_id)
+        for bitmaps in (cls.bitmaps, cls.bitmaps_building):
+            if bitmaps is not None:
+                bitmaps.discard(promotion_id)
 
 ############################################################
 #  C L O U D A N T   D A T A B A S E   C O N N E C T I O N
@@ -327,3 +1537,38 @@ class Promotion(object):
         # check for success
         if not Promotion.database.exists():
             raise AssertionError('Database [{}] could not be obtained'.format(dbname))
+
+        # Publish the design documents and build new indexes in the background,
+        # so the first requests after a deploy don't wait on an index build
+        Promotion.design = DesignManager(Promotion.database, DESIGN_DOCUMENTS, QUERY_INDEXES)
+        Promotion.design.publish()
+        Promotion.design.start()
+
+        # Set up the in-process and Redis read cache
+        redis = connect_to_redis()
+        Promotion.cache = create_cache(redis)
+        Promotion.results = ResultCache()
+        # Listen for writes made by the other workers
+        if Promotion.bus:
+            Promotion.bus.stop()
+        Promotion.bus = None
+        if redis:
+            Promotion.bus = InvalidationBus(redis)
+            Promotion.bus.subscribe(Promotion.invalidate)
+            Promotion.bus.start()
+        # Keep a local read replica in sync from the changes feed
+        if Promotion.replica:
+            Promotion.replica.stop()
+        Promotion.replica = None
+        if REPLICA_MODE:
+            Promotion.replica = SQLiteReplica(Promotion.database, redis=redis)
+            Promotion.replica.start()
+        # Purge expired promotions in the background
+        if Promotion.sweeper:
+            Promotion.sweeper.stop()
+        Promotion.sweeper = Sweeper(Promotion, redis=redis)
+        Promotion.sweeper.start()
+        # Load the productid filter without holding up startup, and reload it
+        # now and then in case the bus missed a write
+        Promotion.start_rebuild()
+        Promotion.start_refresh()
@@ -16,6 +16,12 @@
 """
 Promotion Model that uses Redis
 
+A Promotion with an expires time is saved with EXPIREAT, so Redis
+removes it by itself once it has expired. The discount_value of every
+Promotion is kept in sorted sets (all of them and one per type) for
+range queries sorted by discount, and the available ones in a sorted
+set per category for the top discounts.
+
 You must initlaize this class before use by calling inititlize().
 This class looks for an environment variable called VCAP_SERVICES
 to get it's database credentials from. If it cannot find one, it
@@ -31,6 +37,21 @@ from cerberus import Validator
 from redis import Redis
 from redis.exceptions import ConnectionError
 from app.custom_exceptions import DataValidationError
+from app.intervals import parse_time, to_epoch, now, is_active
+from app.discounts import discount_fields, discount_query, DISCOUNT_TYPES
+from app.search import normalize
+from app.bitmaps import parse_filter, document_values, matches
+
+# sorted sets of window starts and ends by productid ('*' for every product)
+WINDOW_START = 'window:start:{}'
+WINDOW_END = 'window:end:{}'
+# sorted sets of discount values by discount type ('*' for every type)
+DISCOUNT_VALUES = 'discount:value:{}'
+# sorted sets of the discount values of available Promotions by category_key
+TOP_DISCOUNTS = 'discount:top:{}'
+
+# fields that the counts and stats can be grouped by
+STATS_GROUPS = ('category', 'available', 'discount_type')
 
 ######################################################################
 # Promotion Model for database
@@ -47,17 +68,27 @@ class Promotion(object):
         'productid': {'type': 'string', 'required': True},
         'category': {'type': 'string', 'required': True},
         'available': {'type': 'boolean', 'required': True},
-        'discount': {'type': 'string', 'required': True}
+        'discount': {'type': 'string', 'required': True},
+        'start': {'type': 'string', 'nullable': True},
+        'end': {'type': 'string', 'nullable': True},
+        'expires': {'type': 'string', 'nullable': True},
+        'discount_value': {'type': 'number', 'nullable': True},
+        'discount_type': {'type': 'string', 'nullable': True},
+        'category_key': {'type': 'string', 'nullable': True}
         }
     __validator = Validator(schema)
 
-    def __init__(self, id=0, productid=None, category=None, available=True, discount=None):
+    def __init__(self, id=0, productid=None, category=None, available=True, discount=None,
+                 start=None, end=None, expires=None):
         """ Constructor """
         self.id = int(id)
         self.productid = productid
         self.category = category
         self.available = available
         self.discount = discount
+        self.start = start
+        self.end = end
+        self.expires = expires
 
     def save(self):
         """ Saves a Promotion in the database """
@@ -65,21 +96,72 @@ class Promotion(object):
             raise DataValidationError('productid attribute is not set')
         if self.id == 0:
             self.id = Promotion.__next_index()
-        Promotion.redis.set(self.id, pickle.dumps(self.serialize()))
+        previous = Promotion.__load(self.id)
+        pipeline = Promotion.redis.pipeline()
+        if previous:
+            pipeline.zrem(TOP_DISCOUNTS.format(normalize(previous['category'])), self.id)
+            if previous['productid'] != self.productid:
+                pipeline.zrem(WINDOW_START.format(previous['productid']), self.id)
+                pipeline.zrem(WINDOW_END.format(previous['productid']), self.id)
+        pipeline.set(self.id, pickle.dumps(self.serialize()))
+        if self.expires:
+            pipeline.expireat(self.id, to_epoch(self.expires))
+        start = to_epoch(self.start) if self.start else float('-inf')
+        end = to_epoch(self.end) if self.end else float('inf')
+        for productid in ('*', self.productid):
+            pipeline.zadd(WINDOW_START.format(productid), {self.id: start})
+            pipeline.zadd(WINDOW_END.format(productid), {self.id: end})
+        for discount_type in ['*'] + DISCOUNT_TYPES.values():
+            pipeline.zrem(DISCOUNT_VALUES.format(discount_type), self.id)
+        fields = discount_fields(self.category, self.discount)
+        if fields['discount_value'] is not None:
+            for discount_type in ('*', fields['discount_type']):
+                pipeline.zadd(DISCOUNT_VALUES.format(discount_type),
+                              {self.id: fields['discount_value']})
+            if self.available:
+                pipeline.zadd(TOP_DISCOUNTS.format(normalize(self.category)),
+                              {self.id: fields['discount_value']})
+        pipeline.execute()
 
     def delete(self):
         """ Deletes a Promotion from the database """
-        Promotion.redis.delete(self.id)
+        pipeline = Promotion.redis.pipeline()
+        pipeline.delete(self.id)
+        for productid in ('*', self.productid):
+            pipeline.zrem(WINDOW_START.format(productid), self.id)
+            pipeline.zrem(WINDOW_END.format(productid), self.id)
+        for discount_type in ['*'] + DISCOUNT_TYPES.values():
+            pipeline.zrem(DISCOUNT_VALUES.format(discount_type), self.id)
+        pipeline.zrem(TOP_DISCOUNTS.format(normalize(self.category)), self.id)
+        pipeline.execute()
+
+    @property
+    def discount_value(self):
+        """ The number in the discount, e.g. 20 for '20%' """
+        return discount_fields(self.category, self.discount)['discount_value']
+
+    @property
+    def discount_type(self):
+        """ What the discount_value is: percent, amount or bogo """
+        return discount_fields(self.category, self.discount)['discount_type']
+
+    def is_active(self, at=None):
+        """ True if the window of the Promotion contains a time, by default now """
+        return is_active(self.start, self.end, at or now())
 
     def serialize(self):
         """ serializes a Promotion into a dictionary """
-        return {
+        return dict({
             "id": self.id,
             "productid": self.productid,
             "category": self.category,
             "available": self.available,
-            "discount": self.discount
-        }
+            "discount": self.discount,
+            "start": self.start,
+            "end": self.end,
+            "expires": self.expires,
+            "category_key": normalize(self.category)
+        }, **discount_fields(self.category, self.discount))
 
     def deserialize(self, data):
         """ deserializes a Promotion my marshalling the data """
@@ -88,6 +170,12 @@ class Promotion(object):
             self.category = data['category']
             self.available = data['available']
             self.discount = data['discount']
+            try:
+                self.start = parse_time(data.get('start'))
+                self.end = parse_time(data.get('end'))
+                self.expires = parse_time(data.get('expires'))
+            except ValueError as error:
+                raise DataValidationError('Invalid promotion data: ' + str(error))
         else:
             raise DataValidationError('Invalid promotion data: ' + str(Promotion.__validator.errors))
         return self
@@ -117,12 +205,23 @@ class Promotion(object):
         # results = [Promotion.from_dict(redis.hgetall(key)) for key in redis.keys() if key != 'index']
         results = []
         for key in Promotion.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Promotion.redis.get(key))
+            data = Promotion.__load(key) if Promotion.__is_promotion(key) else None
+            if data:
                 promotion = Promotion(data['id']).deserialize(data)
                 results.append(promotion)
         return results
 
+    @staticmethod
+    def __is_promotion(key):
+        """ True unless the key is the id index or a window index """
+        return key != 'index' and not key.startswith(('window:', 'discount:'))
+
+    @staticmethod
+    def __load(key):
+        """ Returns the data of a Promotion or None if it has gone (or expired) """
+        data = Promotion.redis.get(key)
+        return pickle.loads(data) if data is not None else None
+
 ######################################################################
 #  F I N D E R   M E T H O D S
 ######################################################################
@@ -130,8 +229,8 @@ class Promotion(object):
     @staticmethod
     def find(promotion_id):
         """ Query that finds Promotions by their id """
-        if Promotion.redis.exists(promotion_id):
-            data = pickle.loads(Promotion.redis.get(promotion_id))
+        data = Promotion.__load(promotion_id)
+        if data:
             promotion = Promotion(data['id']).deserialize(data)
             return promotion
         return None
@@ -147,8 +246,8 @@ class Promotion(object):
             search_criteria = value
         results = []
         for key in Promotion.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Promotion.redis.get(key))
+            data = Promotion.__load(key) if Promotion.__is_promotion(key) else None
+            if data:
                 # perform case insensitive search on strings
                 if isinstance(data[attribute], str):
                     test_value = data[attribute].lower()
@@ -158,6 +257,44 @@ class Promotion(object):
                     results.append(Promotion(data['id']).deserialize(data))
         return results
 
+    @staticmethod
+    def find_active(at=None, productid=None):
+        """
+        Query that finds the available Promotions active at a time
+
+        Intersects the ids whose window started by then with the ids whose
+        window ends after then, using the sorted sets. Windows that have
+        ended are removed from the sets first.
+        """
+        try:
+            at = to_epoch(parse_time(at) or now())
+        except ValueError as error:
+            raise DataValidationError(str(error))
+        starts = WINDOW_START.format('*' if productid is None else productid)
+        ends = WINDOW_END.format('*' if productid is None else productid)
+        ended = Promotion.redis.zrangebyscore(ends, '-inf', to_epoch(now()))
+        if ended:
+            pipeline = Promotion.redis.pipeline()
+            for key in (starts, ends):
+                pipeline.zrem(key, *ended)
+            pipeline.execute()
+        started = set(Promotion.redis.zrangebyscore(starts, '-inf', at))
+        running = set(Promotion.redis.zrangebyscore(ends, '({}'.format(at), '+inf'))
+        results = []
+        expired = []
+        for promotion_id in started & running:
+            promotion = Promotion.find(promotion_id)
+            if promotion is None:
+                expired.append(promotion_id)
+            elif promotion.available:
+                results.append(promotion)
+        if expired:     # the keys expired, so drop them from the window sets
+            pipeline = Promotion.redis.pipeline()
+            for key in (starts, ends):
+                pipeline.zrem(key, *expired)
+            pipeline.execute()
+        return results
+
     @staticmethod
     def find_by_productid(productid):
         """ Query that finds Promotions by their productid """
@@ -168,6 +305,103 @@ class Promotion(object):
         """ Query that finds Promotions by their category """
         return Promotion.__find_by('category', category)
 
+    @staticmethod
+    def find_by_category_prefix(prefix):
+        """ Query that finds Promotions whose category starts with prefix, ignoring case """
+        prefix = normalize(prefix) or ''
+        return [promotion for promotion in Promotion.all()
+                if (normalize(promotion.category) or '').startswith(prefix)]
+
+    @staticmethod
+    def find_top(category, n=10):
+        """
+        Query that finds the n available Promotions of a category with the
+        highest discount that are active now
+
+        The ranking is read n at a time, skipping Promotions outside their window.
+        """
+        if n < 1:
+            raise DataValidationError('n must be at least 1')
+        key = TOP_DISCOUNTS.format(normalize(category))
+        at = now()
+        results = []
+        expired = []
+        position = 0
+        while len(results) < n:
+            ids = Promotion.redis.zrevrange(key, position, position + n - 1)
+            if not ids:
+                break
+            position += n
+            for promotion_id in ids:
+                promotion = Promotion.find(promotion_id)
+                if promotion is None:
+                    expired.append(promotion_id)
+                elif promotion.is_active(at):
+                    results.append(promotion)
+        if expired:     # the keys expired, so drop them
+            Promotion.redis.zrem(key, *expired)
+        return results[:n]
+
+    @staticmethod
+    def find_by_filter(expression, limit=None):
+        """ Query that finds Promotions with an AND/OR/NOT filter expression """
+        try:
+            node = parse_filter(expression)
+        except ValueError as error:
+            raise DataValidationError(str(error))
+        results = [promotion for promotion in Promotion.all()
+                   if matches(node, document_values(promotion.serialize(),
+                                                    promotion.discount_value))]
+        return results[:limit] if limit else results
+
+    @staticmethod
+    def count(field=None, value=None, stable=None, update=None):
+        """ Returns the number of Promotions, or of those with a field value """
+        if field not in (None,) + STATS_GROUPS:
+            raise DataValidationError('Promotions can not be counted by {}'.format(field))
+        promotions = Promotion.all()
+        if field is None:
+            return len(promotions)
+        if field == 'category':
+            value = normalize(value)
+        return len([promotion for promotion in promotions
+                    if Promotion.__group_key(promotion, field) == value])
+
+    @staticmethod
+    def stats(group=None, stable=None, update=None):
+        """ Returns the count and discount statistics of the Promotions (see models) """
+        if group is not None and group not in STATS_GROUPS:
+            raise DataValidationError('group must be one of {}'.format(
+                ', '.join(sorted(STATS_GROUPS))))
+        groups = {}
+        for promotion in Promotion.all():
+            key = Promotion.__group_key(promotion, group) if group else None
+            groups.setdefault(key, []).append(promotion.discount_value)
+        results = []
+        for key in sorted(groups):
+            values = [value for value in groups[key] if value is not None]
+            discount = {'sum': sum(values), 'count': len(values),
+                        'min': min(values) if values else None,
+                        'max': max(values) if values else None,
+                        'avg': round(float(sum(values)) / len(values), 2) if values else None}
+            result = {'count': len(groups[key]), 'discount': discount}
+            if group:
+                result[group] = key
+            results.append(result)
+        if not group:
+            return results[0] if results else {'count': 0, 'discount': {
+                'sum': 0, 'count': 0, 'min': None, 'max': None, 'avg': None}}
+        return results
+
+    @staticmethod
+    def __group_key(promotion, field):
+        """ Returns the value of a Promotion that the stats are grouped by """
+        if field == 'category':
+            return normalize(promotion.category)
+        if field == 'discount_type':
+            return promotion.discount_type
+        return promotion.available
+
     @staticmethod
     def find_by_availability(available=True):
         """ Query that finds Promotions by their availability """
@@ -175,8 +409,55 @@ class Promotion(object):
 
     @staticmethod
     def find_by_discount(discount):
-        """ Query that finds Promotions by their availability """
-        return Promotion.__find_by('discount', discount)
+        """ Query that finds Promotions by the number (and type) of their discount """
+        value, discount_type = discount_query(discount)
+        if value is None:
+            return Promotion.__find_by('discount', discount)
+        return Promotion.__find_in_range(DISCOUNT_VALUES.format(discount_type or '*'),
+                                         value, value)
+
+    @staticmethod
+    def find_by_discount_range(discount_min=None, discount_max=None, discount_type=None,
+                               sort=None):
+        """
+        Query that finds Promotions whose discount is within a range
+
+        :param sort: 'discount' or '-discount' to sort by discount_value
+        """
+        if sort and sort.lstrip('-') != 'discount':
+            raise DataValidationError('Cannot sort by {}, use one of: discount'.format(sort))
+        return Promotion.__find_in_range(DISCOUNT_VALUES.format(discount_type or '*'),
+                                         discount_min, discount_max,
+                                         descending=bool(sort) and sort.startswith('-'))
+
+    @staticmethod
+    def __find_in_range(key, minimum, maximum, descending=False):
+        """ Returns the Promotions whose score in a sorted set is in [minimum, maximum] """
+        minimum = '-inf' if minimum is None else minimum
+        maximum = '+inf' if maximum is None else maximum
+        if descending:
+            ids = Promotion.redis.zrevrangebyscore(key, maximum, minimum)
+        else:
+            ids = Promotion.redis.zrangebyscore(key, minimum, maximum)
+        results = []
+        expired = []
+        for promotion_id in ids:
+            promotion = Promotion.find(promotion_id)
+            if promotion is None:
+                expired.append(promotion_id)
+            else:
+                results.append(promotion)
+        if expired:
+            Promotion.redis.zrem(key, *expired)
+        return results
+
+    @staticmethod
+    def migrate_fields():
+        """ Saves every Promotion again to fill in the derived fields and sorted sets """
+        promotions = Promotion.all()
+        for promotion in promotions:
+            promotion.save()
+        return {'matched': len(promotions), 'updated': len(promotions), 'failed': 0}
 
 ######################################################################
 #  R E D I S   D A T A B A S E   C O N N E C T I O N   M E T H O D S
@@ -0,0 +1,909 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Promotion Model that uses SQLite
+
+For single hosts that don't want to run CouchDB or Redis. Set
+STORAGE_BACKEND=sqlite and the service keeps its Promotions in the
+file SQLITE_PATH instead of Cloudant, with the same API as app.models.
+
+Each document is stored as JSON next to the columns the finders query
+on (see app.replica.COLUMNS), which have indexes for every finder, so
+the Cloudant Query selectors of app.models run as SQL (where_clause).
+Every thread has its own connection in WAL mode, so readers never wait
+on the writer. Writes run in BEGIN IMMEDIATE transactions, one per
+bulk batch, and every statement has ? parameters so the connection's
+statement cache reuses its prepared statements.
+
+Documents keep a CouchDB style _rev: bulk writes and deletes with a
+stale _rev are refused as conflicts, like _bulk_docs. Deletes leave a
+tombstone row, and every write takes the next seq, which is what
+changes_since() and update_seq() use for incremental exports.
+
+Lists are read in pages of SQLITE_PAGE_SIZE by keyset on id, so
+streaming a large table never holds a read snapshot open between pages.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from app.models import DataValidationError, derived_fields, selector_for, check_changes, \
+    DERIVED_FIELDS, SORT_FIELDS, BULK_BATCH_SIZE
+from app.replica import COLUMNS, UnsupportedQuery, where_clause, column_name, row_values
+from app.invalidation import index_keys, FLUSH_ALL
+from app.result_cache import ResultCache
+from app.singleflight import SingleFlight
+from app.metrics import metrics
+from app.profiler import QueryProfiler, FULL_SCAN
+from app.intervals import parse_time, now, is_active
+from app.sweeper import Sweeper
+from app.discounts import discount_fields
+from app.top import TOP_CAPACITY
+from app.search import normalize, prefix_range
+from app.bitmaps import parse_filter, document_values, matches
+
+# get configruation from enviuronment (12-factor)
+SQLITE_PATH = os.environ.get('SQLITE_PATH')
+SQLITE_PAGE_SIZE = int(os.environ.get('SQLITE_PAGE_SIZE', 500))
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 30))
+SQLITE_STATEMENT_CACHE = int(os.environ.get('SQLITE_STATEMENT_CACHE', 256))
+
+# indexes of the finders (all of them only cover the live rows)
+INDEXES = {
+    'window': ['productid', 'start'],
+    'category_discount': ['category_key', 'discount_value'],
+    'discount_type_value': ['discount_type', 'discount_value'],
+    'discount_value': ['discount_value'],
+    'available': ['available'],
+    'expires': ['expires']
+}
+
+SCHEMA = ['''CREATE TABLE IF NOT EXISTS promotions (
+    id TEXT PRIMARY KEY,
+    rev TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    doc TEXT,
+    {})'''.format(',\n    '.join('"{}"'.format(column) for column in COLUMNS)),
+          'CREATE UNIQUE INDEX IF NOT EXISTS promotions_seq ON promotions (seq)'] + \
+    ['CREATE INDEX IF NOT EXISTS promotions_{} ON promotions ({}) WHERE deleted = 0'.format(
+        name, ', '.join('"{}"'.format(column) for column in columns))
+     for name, columns in sorted(INDEXES.items())]
+
+SELECT_LIVE = 'SELECT rev, deleted FROM promotions WHERE id = ?'
+SELECT_DOC = 'SELECT doc FROM promotions WHERE id = ? AND deleted = 0'
+UPSERT = 'INSERT OR REPLACE INTO promotions (id, rev, seq, deleted, doc, {}) VALUES ' \
+    '(?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM promotions), ?, ?, {})'.format(
+        ', '.join('"{}"'.format(column) for column in COLUMNS), ', '.join('?' * len(COLUMNS)))
+
+# columns that the counts and stats can be grouped by
+STATS_GROUPS = {'category': 'category_key', 'available': 'available',
+                'discount_type': 'discount_type'}
+
+# the index named in a line of EXPLAIN QUERY PLAN
+PLAN_INDEX = re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+
+
+def next_rev(rev, body):
+    """ Returns the revision after rev for a document body, CouchDB style """
+    generation = int(rev.split('-')[0]) if rev else 0
+    digest = hashlib.md5(json.dumps(body, sort_keys=True)).hexdigest()
+    return '{}-{}'.format(generation + 1, digest)
+
+
+def query_plan(statement, rows):
+    """ Returns an EXPLAIN QUERY PLAN in the shape of a Cloudant _explain (see app.profiler) """
+    steps = [row[-1] for row in rows]
+    names = PLAN_INDEX.findall(' '.join(steps))
+    if names:
+        name = names[0][len('promotions_'):] if names[0].startswith('promotions_') else names[0]
+        index = {'ddoc': None, 'name': name, 'type': 'json'}
+    else:
+        index = {'ddoc': None, 'name': FULL_SCAN, 'type': 'special'}
+    return {'index': index, 'sql': statement, 'steps': steps}
+
+
+class Promotion(object):
+    """ Promotion interface to database """
+
+    logger = logging.getLogger(__name__)
+    path = None     # the database file
+    client = None   # no Cloudant client, so jobs are only kept in memory
+    design = None   # no design documents, the indexes are made by init_db
+    replica = None  # the database is local already
+    results = None  # app.result_cache.ResultCache
+    sweeper = None  # app.sweeper.Sweeper
+    find_flight = SingleFlight('find')      # kept for the /metrics counters
+    query_flight = SingleFlight('find_by')
+    profiler = QueryProfiler()  # times the finder queries
+    _local = threading.local()  # the connection of each thread
+
+    def __init__(self, productid=None, category=None, available=True, discount=None,
+                 start=None, end=None, expires=None):
+        """ Constructor """
+        self.id = None
+        self.productid = productid
+        self.category = category
+        self.available = available
+        self.discount = discount
+        self.start = start
+        self.end = end
+        self.expires = expires
+
+    @property
+    def discount_value(self):
+        """ The number in the discount, e.g. 20 for '20%' """
+        return discount_fields(self.category, self.discount)['discount_value']
+
+    @property
+    def discount_type(self):
+        """ What the discount_value is: percent, amount or bogo """
+        return discount_fields(self.category, self.discount)['discount_type']
+
+    def create(self):
+        """
+        Creates a new Promotion in the database
+        """
+        if self.productid is None:   # productid is the only required field
+            raise DataValidationError('productid attribute is not set')
+        self.check_window()
+        self.id = uuid.uuid4().hex
+        with Promotion.transaction() as connection:
+            document = Promotion.put_document(connection, self.serialize())
+        Promotion.publish_keys(index_keys(document))
+
+    @classmethod
+    def create_many(cls, promotions):
+        """
+        Creates many Promotions in one transaction
+
+        Returns the per document errors, like app.models does for _bulk_docs.
+        """
+        for promotion in promotions:
+            if promotion.productid is None:
+                raise DataValidationError('productid attribute is not set')
+            promotion.check_window()
+            if not promotion.id:
+                promotion.id = uuid.uuid4().hex
+        errors = []
+        keys = set()
+        with cls.transaction() as connection:
+            for promotion in promotions:
+                document = cls.put_document(connection, promotion.serialize())
+                if document is None:
+                    errors.append({'id': promotion.id, 'error': 'conflict',
+                                   'reason': 'Document update conflict.'})
+                else:
+                    keys.update(index_keys(document))
+        cls.publish_keys(keys)
+        return errors
+
+    @classmethod
+    def update_where(cls, selector, changes, batch_size=BULK_BATCH_SIZE, progress=None):
+        """
+        Applies changes to every Promotion that matches a selector
+
+        Matches are read a page at a time and written back in one
+        transaction per page. Documents that already have the changes
+        are skipped.
+
+        :param selector: Cloudant Query selector, e.g. {'category': 'BOGO'}
+        :param changes: dictionary of field values to set
+        :param progress: optional function called with the summary after each page
+        :returns: {'matched': n, 'updated': n, 'failed': n}
+        """
+        changes = cls.check_changes(changes)
+        summary = {'matched': 0, 'updated': 0, 'failed': 0}
+        for page in cls.pages_where(selector, batch_size):
+            summary['matched'] += len(page)
+            previous = [document for document in page
+                        if any(document.get(name) != value for name, value in changes.items())]
+            documents = [dict(document, **changes) for document in previous]
+            if documents:
+                updated = cls.write_page(documents, previous)
+                summary['updated'] += updated
+                summary['failed'] += len(documents) - updated
+            if progress:
+                progress(dict(summary))
+        return summary
+
+    @classmethod
+    def query_page(cls, selector, limit, bookmark=None, fields=None):
+        """ Returns one page of a query as (documents, bookmark), the bookmark being the last id """
+        sql, params = cls.where(selector)
+        if bookmark:
+            sql += ' AND id > ?'
+            params.append(bookmark)
+        rows = cls.connection().execute(
+            'SELECT id, doc FROM promotions WHERE deleted = 0 AND {} ORDER BY id LIMIT ?'.format(sql),
+            params + [limit]).fetchall()
+        documents = [json.loads(doc) for _, doc in rows]
+        if fields:
+            documents = [dict((field, document[field]) for field in fields if field in document)
+                         for document in documents]
+        return documents, rows[-1][0] if rows else None
+
+    @classmethod
+    def count_where(cls, selector, limit):
+        """ Returns how many Promotions match a selector, counting up to limit """
+        sql, params = cls.where(selector)
+        return cls.connection().execute(
+            'SELECT COUNT(*) FROM (SELECT 1 FROM promotions WHERE deleted = 0 AND {} LIMIT ?)'.format(
+                sql), params + [limit]).fetchone()[0]
+
+    @classmethod
+    def pages_where(cls, selector, batch_size=BULK_BATCH_SIZE):
+        """ Yields the documents matching a selector a page at a time """
+        bookmark = None
+        while True:
+            documents, bookmark = cls.query_page(selector, batch_size, bookmark)
+            if documents:
+                yield documents
+            if len(documents) < batch_size:
+                return
+
+    @classmethod
+    def write_page(cls, documents, previous):
+        """ Writes changed documents in one transaction and returns how many were saved """
+        keys = set()
+        saved = 0
+        with cls.transaction() as connection:
+            for document in documents:
+                written = cls.put_document(connection, document)
+                if written is None:
+                    metrics.increment('writes.bulk.conflicts')
+                    cls.logger.warning('Bulk update of %s failed: conflict', document['_id'])
+                    continue
+                saved += 1
+                keys.update(index_keys(written))
+        for document in previous:
+            keys.update(index_keys(document))
+        cls.publish_keys(keys)
+        return saved
+
+    @classmethod
+    def find_expired(cls, at, limit=BULK_BATCH_SIZE):
+        """ Returns up to limit documents that expired by a time, oldest first """
+        return cls.select({'expires': {'$type': 'string', '$lte': at}}, [{'expires': 'asc'}],
+                          limit)
+
+    @classmethod
+    def delete_many(cls, documents):
+        """ Deletes documents in one transaction and returns how many were deleted """
+        keys = set()
+        deleted = 0
+        with cls.transaction() as connection:
+            for document in documents:
+                if not cls.delete_document(connection, document['_id'], document['_rev']):
+                    cls.logger.warning('Bulk delete of %s failed: conflict', document['_id'])
+                    continue    # changed since it was read, the next sweep retries
+                deleted += 1
+                keys.update(index_keys(document))
+        if deleted:
+            cls.publish_keys(keys)
+        return deleted
+
+    @classmethod
+    def patch(cls, promotion_id, changes):
+        """
+        Changes some fields of a Promotion in one transaction
+
+        Returns the updated Promotion or None if it doesn't exist.
+        """
+        if not changes:
+            return cls.find(promotion_id)
+        changes = cls.check_changes(changes)
+        metrics.increment('writes.patch')
+        with cls.transaction() as connection:
+            previous = cls.get_document(connection, promotion_id)
+            document = cls.put_document(connection, dict(previous, **changes)) \
+                if previous else None
+        if document is None:
+            return None
+        cls.publish_keys(index_keys(previous) + index_keys(document))
+        return Promotion().deserialize(document)
+
+    @staticmethod
+    def check_changes(changes):
+        """ Returns changes with the times normalized (see app.models.check_changes) """
+        return check_changes(changes)
+
+    def update(self):
+        """ Updates a Promotion in the database """
+        self.check_window()
+        metrics.increment('writes.update')
+        with Promotion.transaction() as connection:
+            previous = Promotion.get_document(connection, self.id)
+            document = Promotion.put_document(connection, dict(previous, **self.serialize())) \
+                if previous else None
+        if document is not None:
+            Promotion.publish_keys(index_keys(previous) + index_keys(document))
+
+    def save(self):
+        """ Saves a Promotion in the database """
+        if self.productid is None:   # productid is the only required field
+            raise DataValidationError('productid attribute is not set')
+        if self.id:
+            self.update()
+        else:
+            self.create()
+
+    def delete(self):
+        """ Deletes a Promotion from the database """
+        metrics.increment('writes.delete')
+        with Promotion.transaction() as connection:
+            previous = Promotion.get_document(connection, self.id)
+            if previous:
+                Promotion.delete_document(connection, self.id)
+        if previous:
+            Promotion.publish_keys(index_keys(previous))
+
+    def check_window(self):
+        """ Normalizes start, end and expires to UTC ISO 8601 and checks the order """
+        try:
+            self.start = parse_time(self.start)
+            self.end = parse_time(self.end)
+            self.expires = parse_time(self.expires)
+        except ValueError as error:
+            raise DataValidationError('Invalid promotion: {}'.format(error))
+        if self.start and self.end and self.end <= self.start:
+            raise DataValidationError('Invalid promotion: end must be after start')
+
+    def is_active(self, at=None):
+        """ True if the window of the Promotion contains a time, by default now """
+        return is_active(self.start, self.end, at or now())
+
+    def serialize(self):
+        """ serializes a Promotion into a dictionary """
+        promotion = {
+            "productid": self.productid,
+            "category": self.category,
+            "available": self.available,
+            "discount": self.discount,
+            "start": self.start,
+            "end": self.end,
+            "expires": self.expires
+        }
+        promotion.update(derived_fields(self.category, self.discount))
+        if self.id:
+            promotion['_id'] = self.id
+        return promotion
+
+    def deserialize(self, data):
+        """ deserializes a Promotion my marshalling the data.
+
+        :param data: a Python dictionary representing a Promotion.
+        """
+        try:
+            self.productid = data['productid']
+            self.category = data['category']
+            self.available = data['available']
+            self.discount = data['discount']
+            self.start = data.get('start')
+            self.end = data.get('end')
+            self.expires = data.get('expires')
+        except KeyError as error:
+            raise DataValidationError('Invalid promotion: missing ' + error.args[0])
+        except (TypeError, AttributeError) as error:
+            raise DataValidationError('Invalid promotion: body of request contained bad or no data')
+        self.check_window()
+
+        # if there is no id and the data has one, assign it
+        if not self.id and '_id' in data:
+            self.id = data['_id']
+
+        return self
+
+
+######################################################################
+#  S T A T I C   D A T A B S E   M E T H O D S
+######################################################################
+
+    @classmethod
+    def connection(cls):
+        """ Returns the connection of the current thread, opening it if needed """
+        connection = getattr(cls._local, 'connection', None)
+        if connection is None or cls._local.path != cls.path:
+            connection = sqlite3.connect(cls.path, timeout=SQLITE_BUSY_TIMEOUT,
+                                         isolation_level=None, check_same_thread=False,
+                                         cached_statements=SQLITE_STATEMENT_CACHE)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            cls._local.connection = connection
+            cls._local.path = cls.path
+        return connection
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        """ Runs a block in a write transaction that is taken before its first read """
+        connection = cls.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    @classmethod
+    def get_document(cls, connection, promotion_id):
+        """ Returns a live document or None """
+        row = connection.execute(SELECT_DOC, (promotion_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @classmethod
+    def put_document(cls, connection, document):
+        """
+        Writes the next revision of a document inside a transaction
+
+        The document's _rev must be the live revision (or absent for a new
+        document), as with CouchDB. Returns the saved document, or None if
+        that was a conflict.
+        """
+        row = connection.execute(SELECT_LIVE, (document['_id'],)).fetchone()
+        live = row[0] if row and not row[1] else None
+        if document.get('_rev') != live:
+            return None
+        body = dict((name, value) for name, value in document.items() if not name.startswith('_'))
+        body.update(derived_fields(body.get('category'), body.get('discount')))
+        saved = dict(body, _id=document['_id'], _rev=next_rev(row[0] if row else None, body))
+        connection.execute(UPSERT, [saved['_id'], saved['_rev'], 0, json.dumps(saved)] +
+                           row_values(saved))
+        return saved
+
+    @classmethod
+    def delete_document(cls, connection, promotion_id, rev=None):
+        """ Replaces a live document with a tombstone, if it is still at rev when one is given """
+        row = connection.execute(SELECT_LIVE, (promotion_id,)).fetchone()
+        if not row or row[1] or (rev is not None and rev != row[0]):
+            return False
+        connection.execute(UPSERT, [promotion_id, next_rev(row[0], None), 1, None] +
+                           [None] * len(COLUMNS))
+        return True
+
+    @classmethod
+    def publish_keys(cls, keys):
+        """ Invalidates the list results for the index keys a write touched """
+        if cls.results:
+            cls.results.bump(keys)
+
+    @classmethod
+    def fetch_document(cls, promotion_id):
+        """ Reads a document, with its _rev """
+        return cls.get_document(cls.connection(), promotion_id)
+
+    @classmethod
+    def doc_count(cls):
+        """ Returns the number of Promotions """
+        return cls.connection().execute(
+            'SELECT COUNT(*) FROM promotions WHERE deleted = 0').fetchone()[0]
+
+    @classmethod
+    def connect(cls):
+        """ Opens the connection of the current thread """
+        cls.connection()
+
+    @classmethod
+    def disconnect(cls):
+        """ Closes the connection of the current thread """
+        connection = getattr(cls._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            cls._local.connection = None
+
+    @classmethod
+    def remove_all(cls):
+        """
+        Removes all documents from the database (use for testing)
+
+        Every document is replaced by a tombstone, so the seq keeps going up
+        and an incremental export sees the deletions.
+        """
+        with cls.transaction() as connection:
+            live = connection.execute('SELECT id FROM promotions WHERE deleted = 0').fetchall()
+            for (promotion_id,) in live:
+                cls.delete_document(connection, promotion_id)
+        if cls.results:
+            cls.results.clear()
+        cls.publish_keys([FLUSH_ALL])
+
+    @classmethod
+    def all(cls):
+        """ Query that returns all Promotions """
+        return [Promotion().deserialize(doc) for doc in cls.scan()]
+
+    @classmethod
+    def scan(cls, ordered=True, batch_size=SQLITE_PAGE_SIZE):
+        """
+        Yields every promotion document in id order, a page at a time
+
+        :param ordered: accepted for app.models compatibility, pages are always in order
+        """
+        for page in cls.pages_where({}, batch_size):
+            for document in page:
+                yield document
+
+    @classmethod
+    def changes_since(cls, since):
+        """ Yields the documents changed after a sequence number, deletions included """
+        try:
+            since = int(since)
+        except (TypeError, ValueError):
+            raise DataValidationError('since must be a sequence number')
+        while True:
+            rows = cls.connection().execute(
+                'SELECT id, seq, deleted, doc FROM promotions WHERE seq > ? ORDER BY seq LIMIT ?',
+                (since, SQLITE_PAGE_SIZE)).fetchall()
+            for promotion_id, seq, deleted, doc in rows:
+                yield {'_id': promotion_id, '_deleted': True} if deleted else json.loads(doc)
+                since = seq
+            if len(rows) < SQLITE_PAGE_SIZE:
+                return
+
+    @classmethod
+    def update_seq(cls):
+        """ Returns the sequence number of the latest change to the database """
+        return cls.connection().execute('SELECT COALESCE(MAX(seq), 0) FROM promotions').fetchone()[0]
+
+    @classmethod
+    def rebuild_indexes(cls):
+        """ Rebuilds the indexes and refreshes the statistics the query planner uses """
+        connection = cls.connection()
+        connection.execute('REINDEX promotions')
+        connection.execute('ANALYZE promotions')
+
+######################################################################
+#  F I N D E R   M E T H O D S
+######################################################################
+
+    @staticmethod
+    def where(selector):
+        """
+        Returns the (sql, params) of a Cloudant Query selector
+
+        :raises DataValidationError: if the selector can't be run as SQL
+        """
+        try:
+            sql, params = where_clause(selector or {})
+        except UnsupportedQuery as error:
+            raise DataValidationError(str(error))
+        return sql, list(params)
+
+    @classmethod
+    def select(cls, selector, sort=None, limit=None):
+        """
+        Returns the documents that match a selector, timed by the profiler
+
+        Like Cloudant, a sort leaves out documents without the sort fields.
+        """
+        sql, params = cls.where(selector)
+        order = []
+        for item in sort or []:
+            field, direction = item.items()[0] if isinstance(item, dict) else (item, 'asc')
+            try:
+                column = column_name(field)
+            except UnsupportedQuery as error:
+                raise DataValidationError(str(error))
+            sql += ' AND {} IS NOT NULL'.format(column)
+            order.append('{} {}'.format(column, 'DESC' if direction == 'desc' else 'ASC'))
+        statement = 'SELECT doc FROM promotions WHERE deleted = 0 AND ' + sql
+        if order:
+            statement += ' ORDER BY ' + ', '.join(order)
+        if limit:
+            statement += ' LIMIT ?'
+            params.append(limit)
+        connection = cls.connection()
+        started = time.time()
+        documents = [json.loads(row[0]) for row in connection.execute(statement, params)]
+        cls.profiler.record(selector, sort, (time.time() - started) * 1000,
+                            {'results_returned': len(documents)},
+                            lambda: query_plan(statement, connection.execute(
+                                'EXPLAIN QUERY PLAN ' + statement, params).fetchall()))
+        return documents
+
+    @classmethod
+    def find_by(cls, **kwargs):
+        """ Find records using selector """
+        return cls.find_where(kwargs)
+
+    @classmethod
+    def find_where(cls, selector, sort=None):
+        """ Find records using a Cloudant Query selector and optional sort """
+        return [Promotion().deserialize(doc) for doc in cls.select(selector, sort)]
+
+    @classmethod
+    def find(cls, promotion_id):
+        """ Query that finds Promotions by their id """
+        document = cls.fetch_document(promotion_id)
+        return Promotion().deserialize(document) if document else None
+
+    @classmethod
+    def find_many(cls, promotion_ids):
+        """
+        Query that finds many Promotions by their ids
+
+        Returns a dictionary of id to Promotion, or None if not found.
+        """
+        results = dict((promotion_id, None) for promotion_id in promotion_ids)
+        ids = list(results)
+        for start in range(0, len(ids), SQLITE_PAGE_SIZE):
+            for document in cls.select({'_id': {'$in': ids[start:start + SQLITE_PAGE_SIZE]}}):
+                results[document['_id']] = Promotion().deserialize(document)
+        return results
+
+    @classmethod
+    def find_by_productids(cls, productids):
+        """
+        Query that finds the Promotions for many productids
+
+        Returns a dictionary of productid to the list of its Promotions.
+        """
+        results = dict((productid, []) for productid in productids)
+        if results:
+            for promotion in cls.find_by(productid={'$in': sorted(results)}):
+                results[promotion.productid].append(promotion)
+        return results
+
+    @classmethod
+    def find_active(cls, at=None, productid=None):
+        """
+        Query that finds the available Promotions active at a time
+
+        :param at: ISO 8601 UTC time, defaults to now
+        :param productid: optional productid to limit the Promotions to
+        """
+        try:
+            at = parse_time(at) or now()
+        except ValueError as error:
+            raise DataValidationError(str(error))
+        selector = {
+            'available': True,
+            '$and': [
+                {'$or': [{'start': None}, {'start': {'$lte': at}}]},
+                {'$or': [{'end': None}, {'end': {'$gt': at}}]}
+            ]
+        }
+        if productid is not None:
+            selector['productid'] = productid
+        return cls.find_where(selector)
+
+    @classmethod
+    def find_by_productid(cls, productid):
+        """ Query that finds Promotions by their productid """
+        return cls.find_by(productid=productid)
+
+    @classmethod
+    def find_by_category(cls, category):
+        """ Query that finds Promotions by their category, ignoring case """
+        return cls.find_where(cls.filter_selector({'category': category}))
+
+    @classmethod
+    def find_by_category_prefix(cls, prefix):
+        """ Query that finds Promotions whose category starts with prefix, ignoring case """
+        return cls.find_where({'category_key': prefix_range(prefix)})
+
+    @classmethod
+    def count(cls, field=None, value=None, stable=None, update=None):
+        """
+        Returns the number of Promotions, or of those with a field value
+
+        stable and update are accepted for app.models compatibility, the
+        count is always up to date.
+        """
+        if field is None:
+            return cls.doc_count()
+        if field not in STATS_GROUPS:
+            raise DataValidationError('Promotions can not be counted by {}'.format(field))
+        if field == 'category':
+            value = normalize(value)
+        return cls.connection().execute(
+            'SELECT COUNT(*) FROM promotions WHERE deleted = 0 AND "{}" IS ?'.format(
+                STATS_GROUPS[field]), (value,)).fetchone()[0]
+
+    @classmethod
+    def stats(cls, group=None, stable=None, update=None):
+        """ Returns the count and discount statistics of the Promotions (see app.models) """
+        if group is not None and group not in STATS_GROUPS:
+            raise DataValidationError('group must be one of {}'.format(
+                ', '.join(sorted(STATS_GROUPS))))
+        column = '"{}"'.format(STATS_GROUPS[group]) if group else 'NULL'
+        rows = cls.connection().execute(
+            'SELECT {0}, COUNT(*), TOTAL(discount_value), COUNT(discount_value), '
+            'MIN(discount_value), MAX(discount_value) FROM promotions WHERE deleted = 0 '
+            'GROUP BY {0} ORDER BY {0}'.format(column)).fetchall()
+        results = []
+        for key, count, total, values, smallest, largest in rows:
+            if values == 0:
+                total = 0
+            elif total == int(total):
+                total = int(total)
+            discount = {'sum': total, 'count': values, 'min': smallest, 'max': largest,
+                        'avg': round(float(total) / values, 2) if values else None}
+            result = {'count': count, 'discount': discount}
+            if group:
+                result[group] = bool(key) if group == 'available' else key
+            results.append(result)
+        if not group:
+            return results[0] if results else {'count': 0, 'discount': {
+                'sum': 0, 'count': 0, 'min': None, 'max': None, 'avg': None}}
+        return results
+
+    @classmethod
+    def find_top(cls, category, n=10):
+        """
+        Query that finds the n available Promotions of a category with the
+        highest discount that are active now
+
+        :raises DataValidationError: if n is more than TOP_CAPACITY, as in app.models
+        """
+        if n < 1 or n > TOP_CAPACITY:
+            raise DataValidationError('n must be between 1 and {}'.format(TOP_CAPACITY))
+        at = now()
+        selector = {
+            'category_key': normalize(category),
+            'available': True,
+            '$and': [{'$or': [{'start': None}, {'start': {'$lte': at}}]},
+                     {'$or': [{'end': None}, {'end': {'$gt': at}}]}]
+        }
+        documents = cls.select(selector, [{'category_key': 'desc'}, {'discount_value': 'desc'}], n)
+        return [Promotion().deserialize(doc) for doc in documents]
+
+    @classmethod
+    def find_by_filter(cls, expression, limit=None):
+        """
+        Query that finds Promotions with a filter expression such as
+        'category:bogo AND NOT (available:false OR discount:0-10)'
+
+        Every Promotion is streamed and checked, stopping at limit.
+        :raises DataValidationError: if the expression is not valid
+        """
+        try:
+            node = parse_filter(expression)
+        except ValueError as error:
+            raise DataValidationError(str(error))
+        results = []
+        for document in cls.scan():
+            value = discount_fields(document.get('category'), document.get('discount'))['discount_value']
+            if matches(node, document_values(document, value)):
+                results.append(Promotion().deserialize(document))
+                if limit and len(results) >= limit:
+                    break
+        return results
+
+    @classmethod
+    def complete_category(cls, prefix, limit=10):
+        """ Returns up to limit known categories that start with prefix """
+        bounds = prefix_range(prefix)
+        rows = cls.connection().execute(
+            'SELECT MIN(category) FROM promotions WHERE deleted = 0 AND category_key >= ? '
+            'AND category_key < ? GROUP BY category_key ORDER BY category_key LIMIT ?',
+            (bounds['$gte'], bounds['$lt'], limit))
+        return [row[0].strip() for row in rows]
+
+    @classmethod
+    def find_by_availability(cls, available=True):
+        """ Query that finds Promotions by their availability """
+        return cls.find_by(available=available)
+
+    @classmethod
+    def find_by_discount(cls, discount):
+        """
+        Query that finds Promotions by their discount
+
+        A discount with a number matches on the number, so '10' finds
+        '10.0' and '10%' too; '10%' or '$10' also match on the type.
+        """
+        return cls.find_where(cls.filter_selector({'discount': discount}))
+
+    @staticmethod
+    def filter_selector(filters):
+        """
+        Returns the selector of the Promotions matching category, productid
+        and discount filters (see app.models.selector_for)
+
+        Every row gets its derived columns when it is written, so there is
+        nothing to fall back on.
+        """
+        return selector_for(filters)
+
+    @classmethod
+    def find_by_discount_range(cls, discount_min=None, discount_max=None, discount_type=None,
+                               sort=None):
+        """
+        Query that finds Promotions whose discount is within a range
+
+        :param discount_min: smallest discount_value, or None for no limit
+        :param discount_max: largest discount_value, or None for no limit
+        :param discount_type: only Promotions of this type (percent, amount or bogo)
+        :param sort: 'discount' or '-discount' to sort by discount_value
+        """
+        bounds = {'$type': 'number'}
+        if discount_min is not None:
+            bounds['$gte'] = discount_min
+        if discount_max is not None:
+            bounds['$lte'] = discount_max
+        selector = {'discount_value': bounds}
+        if discount_type:
+            selector['discount_type'] = discount_type
+        order = None
+        if sort:
+            field, direction = cls.parse_sort(sort)
+            order = [{field: direction}]
+        return cls.find_where(selector, order)
+
+    @staticmethod
+    def parse_sort(sort):
+        """
+        Returns the (field, 'asc' or 'desc') of a sort order such as '-discount'
+
+        :raises DataValidationError: if the field can't be sorted on
+        """
+        name = sort.lstrip('-')
+        if name not in SORT_FIELDS:
+            raise DataValidationError('Cannot sort by {}, use one of: {}'.format(
+                name, ', '.join(sorted(SORT_FIELDS))))
+        return SORT_FIELDS[name], 'desc' if sort.startswith('-') else 'asc'
+
+    @classmethod
+    def migrate_fields(cls, batch_size=BULK_BATCH_SIZE, progress=None):
+        """
+        Backfills the derived fields (see app.models.derived_fields) on older documents
+
+        :returns: {'matched': n, 'updated': n, 'failed': n}
+        """
+        summary = {'matched': 0, 'updated': 0, 'failed': 0}
+        for page in cls.pages_where({}, batch_size):
+            documents = [document for document in page
+                         if any(field not in document for field in DERIVED_FIELDS)]
+            summary['matched'] += len(documents)
+            if documents:
+                updated = cls.write_page(documents, documents)
+                summary['updated'] += updated
+                summary['failed'] += len(documents) - updated
+            if progress:
+                progress(dict(summary))
+        return summary
+
+######################################################################
+#  S Q L I T E   D A T A B A S E   C O N N E C T I O N
+######################################################################
+
+    @staticmethod
+    def init_db(dbname='promotions'):
+        """
+        Opens the SQLite database SQLITE_PATH, or <dbname>.db, and creates
+        its table and indexes
+        """
+        Promotion.path = SQLITE_PATH or dbname + '.db'
+        Promotion.logger.info('SQLite database: %s', Promotion.path)
+        connection = Promotion.connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        with Promotion.transaction() as connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+        Promotion.results = ResultCache()
+        # Purge expired promotions in the background
+        if Promotion.sweeper:
+            Promotion.sweeper.stop()
+        Promotion.sweeper = Sweeper(Promotion)
+        Promotion.sweeper.start()
@@ -0,0 +1,132 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Vectorized price evaluation of cart lines against Promotions
+
+Each Promotion's discount is parsed into a (kind, value) pair by
+app.discounts and a discount that can't be parsed is ignored. Every
+(line, promotion) pair is then priced in one NumPy pass and the best
+saving is kept for each line.
+"""
+
+import os
+import math
+import numpy as np
+from app.models import DataValidationError
+from app.discounts import parse_discount, PERCENT, AMOUNT, BOGO
+
+# get configruation from enviuronment (12-factor)
+EVALUATE_MAX_LINES = int(os.environ.get('EVALUATE_MAX_LINES', 500))
+
+LINE_FIELDS = ['productid', 'promotion', 'subtotal', 'savings', 'total']
+
+# fields a cart line may have; Promotions are matched by productid alone,
+# so the category of a line is accepted but not used
+CART_FIELDS = ['productid', 'category', 'price', 'qty']
+
+
+def parse_lines(lines):
+    """
+    Validates cart lines and returns them as dictionaries
+
+    :raises DataValidationError: if a line is not an object of CART_FIELDS
+        with a string productid, a finite price and a positive qty
+    """
+    if not isinstance(lines, list) or not lines:
+        raise DataValidationError('lines must be a non empty list')
+    if len(lines) > EVALUATE_MAX_LINES:
+        raise DataValidationError('At most {} lines can be evaluated'.format(EVALUATE_MAX_LINES))
+    parsed = []
+    for number, line in enumerate(lines):
+        if not isinstance(line, dict):
+            raise DataValidationError('Line {} must be an object'.format(number))
+        unknown = set(line) - set(CART_FIELDS)
+        if unknown:
+            raise DataValidationError('Line {} has unknown fields: {}'.format(
+                number, ', '.join(sorted(unknown))))
+        try:
+            productid = line['productid']
+            price = float(line['price'])
+            qty = int(line.get('qty', 1))
+        except (KeyError, TypeError, ValueError, OverflowError):
+            raise DataValidationError('Line {} needs a productid, a price and a qty'.format(number))
+        if not isinstance(productid, basestring):
+            raise DataValidationError('Line {} productid must be a string'.format(number))
+        if math.isnan(price) or math.isinf(price):
+            raise DataValidationError('Line {} price must be a finite number'.format(number))
+        if price < 0 or qty < 1:
+            raise DataValidationError('Line {} has a negative price or qty'.format(number))
+        parsed.append({'productid': productid, 'price': price, 'qty': qty})
+    return parsed
+
+
+def evaluate(lines, promotions):
+    """
+    Returns the best discount for each cart line
+
+    :param lines: validated cart lines from parse_lines()
+    :param promotions: dictionary of productid to its available Promotions
+    :returns: dictionary with one compact row per line (see LINE_FIELDS)
+        and the cart subtotal, savings and total
+    """
+    prices = np.array([line['price'] for line in lines], dtype=np.float64)
+    qtys = np.array([line['qty'] for line in lines], dtype=np.float64)
+    subtotals = prices * qtys
+
+    pair_lines, kinds, values, ids = [], [], [], []
+    for index, line in enumerate(lines):
+        for promotion in promotions.get(line['productid'], []):
+            parsed = parse_discount(promotion.category, promotion.discount)
+            if parsed:
+                pair_lines.append(index)
+                kinds.append(parsed[0])
+                values.append(parsed[1])
+                ids.append(promotion.id)
+
+    savings = np.zeros(len(lines))
+    best = np.full(len(lines), -1, dtype=np.int64)
+    if pair_lines:
+        pair_lines = np.array(pair_lines, dtype=np.int64)
+        kinds = np.array(kinds, dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        price, qty = prices[pair_lines], qtys[pair_lines]
+        pair_savings = np.select(
+            [kinds == PERCENT, kinds == AMOUNT, kinds == BOGO],
+            [price * qty * values / 100.0,
+             np.minimum(values, price) * qty,
+             np.floor(qty / 2.0) * price * values / 100.0])
+        pair_savings = np.minimum(pair_savings, subtotals[pair_lines])
+        # sort by line then saving, the last pair of each line is its best
+        order = np.lexsort((pair_savings, pair_lines))
+        last = np.append(pair_lines[order][1:] != pair_lines[order][:-1], True)
+        winners = order[last]
+        savings[pair_lines[winners]] = pair_savings[winners]
+        best[pair_lines[winners]] = winners
+
+    savings = np.round(savings, 2)
+    totals = np.round(subtotals - savings, 2)
+    rows = []
+    for index, line in enumerate(lines):
+        promotion_id = ids[best[index]] if best[index] >= 0 and savings[index] > 0 else None
+        rows.append([line['productid'], promotion_id, round(float(subtotals[index]), 2),
+                     float(savings[index]), float(totals[index])])
+    return {
+        'fields': LINE_FIELDS,
+        'lines': rows,
+        'subtotal': round(float(subtotals.sum()), 2),
+        'savings': round(float(savings.sum()), 2),
+        'total': round(float(totals.sum()), 2)
+    }
@@ -0,0 +1,214 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Timing of Mango queries, a slow query log and an index advisor
+
+Every query is timed with the execution_stats CouchDB returns. A query
+slower than SLOW_QUERY_MS is logged with its _explain plan and kept in
+a short history, and its selector is counted by shape (which fields it
+matches exactly, which by range and which it sorts on).
+
+The advisor turns those shapes into index suggestions: equality fields
+first, then sort fields, then range fields, which is the order a json
+index can serve them in. Shapes already answered by an index that
+examines about as many documents as it returns are left out.
+
+capture() makes the queries of the current thread keep their plan and
+stats, which is how ?explain=1 shows what a request did.
+"""
+
+import os
+import json
+import logging
+import threading
+from collections import deque, OrderedDict
+from app.metrics import metrics
+
+# get configruation from enviuronment (12-factor)
+SLOW_QUERY_MS = int(os.environ.get('SLOW_QUERY_MS', 500))
+SLOW_QUERY_HISTORY = int(os.environ.get('SLOW_QUERY_HISTORY', 100))
+
+EQUALITY_OPERATORS = ('$eq',)
+FULL_SCAN = '_all_docs'
+
+logger = logging.getLogger(__name__)
+
+
+def selector_shape(selector, sort=None):
+    """
+    Returns (equality fields, range fields, sort fields) of a selector
+
+    Fields under $or, $and or $not are counted as range fields, since an
+    index on them can narrow the query but not answer it alone.
+    """
+    equality, ranges = set(), set()
+    for field, condition in selector.items():
+        if field.startswith('$'):
+            for nested in condition if isinstance(condition, list) else [condition]:
+                if isinstance(nested, dict):
+                    inner = selector_shape(nested)
+                    ranges.update(inner[0] + inner[1])
+        elif not isinstance(condition, dict) or \
+                all(operator in EQUALITY_OPERATORS for operator in condition):
+            equality.add(field)
+        else:
+            ranges.add(field)
+    sort_fields = [item.keys()[0] if isinstance(item, dict) else item for item in sort or []]
+    ranges -= equality
+    return sorted(equality), sorted(ranges - set(sort_fields)), sort_fields
+
+
+def suggest_index(shape):
+    """ Returns the fields of an index for a selector shape (equality, sort, range) """
+    equality, ranges, sort_fields = shape
+    fields = list(equality)
+    fields += [field for field in sort_fields if field not in fields]
+    fields += [field for field in ranges if field not in fields]
+    return fields
+
+
+def plan_index(plan):
+    """ Returns the name of the index a query plan uses """
+    index = (plan or {}).get('index') or {}
+    if index.get('type') == 'special':
+        return FULL_SCAN
+    return index.get('name') or FULL_SCAN
+
+
+class QueryProfiler(object):
+    """ Times queries, logs the slow ones and advises on indexes """
+
+    def __init__(self, threshold=SLOW_QUERY_MS, history=SLOW_QUERY_HISTORY):
+        self.threshold = threshold
+        self._recent = deque(maxlen=history)
+        self._shapes = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def capture(self):
+        """ Returns a context in which this thread's queries keep their plans """
+        return _Capture(self)
+
+    @property
+    def capturing(self):
+        """ True if the queries of this thread are being captured """
+        return getattr(self._local, 'captured', None) is not None
+
+    def record(self, selector, sort, elapsed_ms, stats, explain):
+        """
+        Records one query
+
+        :param stats: the execution_stats of the query
+        :param explain: function that returns the _explain plan, only
+            called for slow or captured queries
+        """
+        metrics.increment('query.count')
+        metrics.increment('query.time_ms', int(elapsed_ms))
+        slow = elapsed_ms >= self.threshold
+        captured = getattr(self._local, 'captured', None)
+        if not slow and captured is None:
+            return
+        plan = self._explain(explain)
+        entry = {
+            'selector': selector,
+            'sort': sort,
+            'elapsed_ms': round(elapsed_ms, 1),
+            'index': plan_index(plan),
+            'docs_examined': stats.get('total_docs_examined', 0),
+            'results_returned': stats.get('results_returned', 0),
+            'execution_stats': stats
+        }
+        if captured is not None:
+            captured.append(dict(entry, plan=plan))
+        if slow:
+            metrics.increment('query.slow')
+            logger.warning('Slow query (%sms) using %s examined %s docs for %s results: %s sort=%s',
+                           entry['elapsed_ms'], entry['index'], entry['docs_examined'],
+                           entry['results_returned'], json.dumps(selector), json.dumps(sort))
+            self._remember(entry, selector, sort)
+
+    def slow_queries(self):
+        """ Returns the most recent slow queries, newest first """
+        with self._lock:
+            return list(reversed(self._recent))
+
+    def advise(self):
+        """
+        Returns the suggested indexes for the slow query shapes, worst first
+
+        Each suggestion has the index fields, the number of slow queries
+        of that shape, their average time and docs examined per result.
+        """
+        suggestions = []
+        with self._lock:
+            shapes = list(self._shapes.items())
+        for fields, shape in shapes:
+            ratio = float(shape['examined']) / max(shape['returned'], 1)
+            if shape['indexes'] - set([FULL_SCAN]) and ratio <= 2:
+                continue    # an index already answers it, it is just a big result
+            suggestions.append({
+                'fields': list(fields),
+                'index': {'fields': [{field: 'asc'} for field in fields]},
+                'queries': shape['count'],
+                'avg_ms': round(shape['time_ms'] / shape['count'], 1),
+                'examined_per_result': round(ratio, 1),
+                'indexes_used': sorted(shape['indexes'])
+            })
+        suggestions.sort(key=lambda suggestion: -suggestion['avg_ms'] * suggestion['queries'])
+        return suggestions
+
+    def reset(self):
+        """ Forgets every recorded query """
+        with self._lock:
+            self._recent.clear()
+            self._shapes.clear()
+
+    def _remember(self, entry, selector, sort):
+        """ Adds a slow query to the history and its shape to the advisor """
+        fields = tuple(suggest_index(selector_shape(selector, sort)))
+        with self._lock:
+            self._recent.append(entry)
+            shape = self._shapes.setdefault(fields, {'count': 0, 'time_ms': 0.0, 'examined': 0,
+                                                     'returned': 0, 'indexes': set()})
+            shape['count'] += 1
+            shape['time_ms'] += entry['elapsed_ms']
+            shape['examined'] += entry['docs_examined']
+            shape['returned'] += entry['results_returned']
+            shape['indexes'].add(entry['index'])
+
+    @staticmethod
+    def _explain(explain):
+        """ Returns the query plan, or None if it can't be had """
+        try:
+            return explain()
+        except Exception as error:     # pylint: disable=broad-except
+            logger.warning('Explaining a query failed: %s', error)
+            return None
+
+
+class _Capture(object):
+    """ Context that collects the queries of the current thread """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.queries = []
+
+    def __enter__(self):
+        self.profiler._local.captured = self.queries     # pylint: disable=protected-access
+        return self.queries
+
+    def __exit__(self, *args):
+        self.profiler._local.captured = None     # pylint: disable=protected-access
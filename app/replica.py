@@ -0,0 +1,421 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Local SQLite read replica of the Promotions in Cloudant
+
+With REPLICA_MODE on, every worker keeps a copy of the database in a
+SQLite file (WAL mode, so readers never wait on the writer) with the
+fields the finders query on as indexed columns. A background thread
+follows the Cloudant _changes feed and applies each batch in one
+transaction together with its sequence checkpoint, so a restart carries
+on where it stopped.
+
+The finders read from the replica while it is no more than
+REPLICA_MAX_LAG seconds behind and go to Cloudant otherwise. Writes go
+to Cloudant and are also applied here straight away, so a worker reads
+its own writes. Rows keep the generation of their revision, so an
+older change arriving late from the feed never replaces a newer one.
+
+select() turns a Cloudant Query selector into SQL; selectors on fields
+without a column raise UnsupportedQuery and are run by Cloudant.
+
+With Redis, the workers that share REPLICA_PATH elect one syncer with a
+SET NX lock that it renews every batch and another worker takes over
+when it lapses. The others only read: their connections are query only,
+and after one of their own writes they read from Cloudant until the
+syncer has caught up past it.
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from requests import HTTPError, ConnectionError
+from requests.exceptions import Timeout
+from redis.exceptions import RedisError
+from app.discounts import discount_fields
+from app.search import normalize
+from app.metrics import metrics
+
+# get configruation from enviuronment (12-factor)
+REPLICA_MODE = os.environ.get('REPLICA_MODE', 'False').lower() == 'true'
+REPLICA_PATH = os.environ.get('REPLICA_PATH', 'promotions-replica.db')
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 10))
+REPLICA_BATCH_SIZE = int(os.environ.get('REPLICA_BATCH_SIZE', 500))
+REPLICA_POLL_TIMEOUT = float(os.environ.get('REPLICA_POLL_TIMEOUT', 2))
+REPLICA_LOCK_TTL = int(os.environ.get('REPLICA_LOCK_TTL', 30))
+
+LOCK_KEY = 'promotions:replica:{}:{}'     # host and path: each host has its own file
+
+# fields kept in their own column (everything else is only in the doc column)
+COLUMNS = ['productid', 'category', 'category_key', 'available', 'discount',
+           'discount_value', 'discount_type', 'start', 'end', 'expires']
+INDEXED_COLUMNS = ['productid', 'category_key', 'available', 'discount_value']
+
+OPERATORS = {'$eq': '=', '$ne': '!=', '$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+TYPES = {'number': "('integer', 'real')", 'string': "('text')", 'null': "('null')"}
+
+SCHEMA = ['''CREATE TABLE IF NOT EXISTS promotions (
+    id TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    doc TEXT,
+    {})'''.format(',\n    '.join('"{}"'.format(column) for column in COLUMNS)),
+          '''CREATE TABLE IF NOT EXISTS checkpoint (
+    name TEXT PRIMARY KEY,
+    seq TEXT,
+    updated REAL)'''] + \
+    ['CREATE INDEX IF NOT EXISTS promotions_{0} ON promotions ("{0}")'.format(column)
+     for column in INDEXED_COLUMNS]
+
+logger = logging.getLogger(__name__)
+
+
+class UnsupportedQuery(ValueError):
+    """ The selector uses a field or operator the replica can't query """
+    pass
+
+
+def generation(rev):
+    """ Returns the generation number of a revision like 3-abc """
+    try:
+        return int(str(rev).split('-')[0])
+    except ValueError:
+        return 0
+
+
+def row_values(document):
+    """ Returns the column values of a document """
+    values = dict((column, document.get(column)) for column in COLUMNS)
+    values.update(discount_fields(document.get('category'), document.get('discount')))
+    values['category_key'] = normalize(document.get('category'))
+    return [values[column] for column in COLUMNS]
+
+
+def column_name(field):
+    """ Returns the quoted column of a selector field """
+    if field == '_id':
+        return 'id'
+    if field not in COLUMNS:
+        raise UnsupportedQuery('{} is not a replica column'.format(field))
+    return '"{}"'.format(field)
+
+
+def where_clause(selector):
+    """
+    Returns (sql, params) for a Cloudant Query selector
+
+    :raises UnsupportedQuery: for fields without a column and operators
+        other than $eq, $ne, $gt, $gte, $lt, $lte, $in, $exists, $type,
+        $and, $or and $not
+    """
+    parts, params = [], []
+    for field, condition in sorted(selector.items()):
+        if field in ('$and', '$or'):
+            clauses = [where_clause(nested) for nested in condition]
+            parts.append('(' + (' AND ' if field == '$and' else ' OR ').join(
+                sql for sql, _ in clauses) + ')')
+            for _, nested_params in clauses:
+                params.extend(nested_params)
+            continue
+        if field == '$not':
+            sql, nested_params = where_clause(condition)
+            parts.append('NOT ' + sql)
+            params.extend(nested_params)
+            continue
+        column = column_name(field)
+        if not isinstance(condition, dict):
+            condition = {'$eq': condition}
+        for operator, value in sorted(condition.items()):
+            if operator in OPERATORS and value is None:
+                parts.append('{} IS {}NULL'.format(column, '' if operator == '$eq' else 'NOT '))
+            elif operator in OPERATORS:
+                parts.append('{} {} ?'.format(column, OPERATORS[operator]))
+                params.append(value)
+            elif operator == '$in':
+                parts.append('{} IN ({})'.format(column, ', '.join('?' * len(value))))
+                params.extend(value)
+            elif operator == '$exists':
+                parts.append('{} IS {}NULL'.format(column, 'NOT ' if value else ''))
+            elif operator == '$type' and value in TYPES:
+                parts.append('typeof({}) IN {}'.format(column, TYPES[value]))
+            else:
+                raise UnsupportedQuery('{} is not supported by the replica'.format(operator))
+    return '(' + (' AND '.join(parts) or '1') + ')', params
+
+
+class SQLiteReplica(object):
+    """ A SQLite copy of a Cloudant database kept up to date from its changes feed """
+
+    def __init__(self, database, path=REPLICA_PATH, max_lag=REPLICA_MAX_LAG,
+                 batch_size=REPLICA_BATCH_SIZE, poll=REPLICA_POLL_TIMEOUT, redis=None):
+        """
+        :param redis: optional Redis client used to elect the one worker
+            that syncs the file; without it every replica syncs and writes
+        """
+        self.database = database
+        self.path = path
+        self.max_lag = max_lag
+        self.batch_size = batch_size
+        self.poll = poll
+        self.redis = redis
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lock_key = LOCK_KEY.format(socket.gethostname(), os.path.abspath(path))
+        self.caught_up = None   # when the feed last had nothing more to send
+        self.pending = None
+        self.written = None     # when this worker last wrote, if it only reads
+        self._local = threading.local()
+        self._stopped = threading.Event()
+        self._thread = None
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+        connection.close()
+
+    @property
+    def read_only(self):
+        """ True on the threads that must not write because a syncer is elected """
+        return self.redis is not None and threading.current_thread() is not self._thread
+
+    def connection(self):
+        """ Returns the connection of the current thread """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            if self.read_only:
+                connection.execute('PRAGMA query_only=ON')
+            self._local.connection = connection
+        return connection
+
+    ##################################################
+    # Reads
+    ##################################################
+
+    def last_caught_up(self):
+        """ When the replica was last known to be current, or None before that """
+        if self.redis is None:
+            return self.caught_up
+        row = self.connection().execute(
+            "SELECT updated FROM checkpoint WHERE name = 'caught_up'").fetchone()
+        return row[0] if row else None
+
+    def lag(self):
+        """ Seconds since the replica was last known to be current, or None before that """
+        caught_up = self.last_caught_up()
+        if caught_up is None:
+            return None
+        return max(0.0, time.time() - caught_up)
+
+    def usable(self):
+        """
+        True if the replica is within REPLICA_MAX_LAG of Cloudant and, on a
+        worker that only reads, has caught up past its last write
+        """
+        caught_up = self.last_caught_up()
+        if caught_up is None or time.time() - caught_up > self.max_lag:
+            return False
+        return self.written is None or caught_up > self.written
+
+    def get(self, promotion_id):
+        """ Returns a document or None """
+        row = self.connection().execute(
+            'SELECT doc FROM promotions WHERE id = ? AND deleted = 0', (promotion_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, promotion_ids):
+        """ Returns a dictionary of id to document, or None if not found """
+        results = dict((promotion_id, None) for promotion_id in promotion_ids)
+        ids = list(results)
+        for start in range(0, len(ids), 500):   # SQLite limits the number of parameters
+            batch = ids[start:start + 500]
+            rows = self.connection().execute(
+                'SELECT id, doc FROM promotions WHERE deleted = 0 AND id IN ({})'.format(
+                    ', '.join('?' * len(batch))), batch)
+            for promotion_id, doc in rows:
+                results[promotion_id] = json.loads(doc)
+        return results
+
+    def select(self, selector, sort=None):
+        """
+        Returns the documents that match a Cloudant Query selector
+
+        Like Cloudant, a sort leaves out documents without the sort fields.
+        :raises UnsupportedQuery: if the selector can't be run as SQL
+        """
+        sql, params = where_clause(selector)
+        order = []
+        for item in sort or []:
+            field, direction = item.items()[0] if isinstance(item, dict) else (item, 'asc')
+            column = column_name(field)
+            sql += ' AND {} IS NOT NULL'.format(column)
+            order.append('{} {}'.format(column, 'DESC' if direction == 'desc' else 'ASC'))
+        statement = 'SELECT doc FROM promotions WHERE deleted = 0 AND ' + sql
+        if order:
+            statement += ' ORDER BY ' + ', '.join(order)
+        metrics.increment('replica.reads')
+        return [json.loads(row[0]) for row in self.connection().execute(statement, params)]
+
+    def all(self):
+        """ Returns every document in id order """
+        metrics.increment('replica.reads')
+        rows = self.connection().execute('SELECT doc FROM promotions WHERE deleted = 0 ORDER BY id')
+        return [json.loads(row[0]) for row in rows]
+
+    def checkpoint(self):
+        """ Returns the sequence of the last change applied, or None """
+        row = self.connection().execute(
+            "SELECT seq FROM checkpoint WHERE name = 'changes'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    ##################################################
+    # Writes
+    ##################################################
+
+    def put(self, document):
+        """ Applies one saved document (a write made by this worker) """
+        if self.read_only:
+            self.written = time.time()
+            return
+        with self.connection() as connection:
+            self._apply(connection, document)
+
+    def delete(self, promotion_id):
+        """ Applies a delete made by this worker """
+        if self.read_only:
+            self.written = time.time()
+            return
+        with self.connection() as connection:
+            connection.execute('UPDATE promotions SET deleted = 1, generation = generation + 1, '
+                               'doc = NULL WHERE id = ?', (promotion_id,))
+
+    def apply(self, documents, seq, caught_up=None):
+        """
+        Applies a batch of changes and its checkpoint in one transaction
+
+        :param caught_up: the time the feed was found to have nothing more
+        """
+        with self.connection() as connection:
+            for document in documents:
+                self._apply(connection, document)
+            connection.execute('INSERT OR REPLACE INTO checkpoint (name, seq, updated) '
+                               "VALUES ('changes', ?, ?)", (json.dumps(seq), time.time()))
+            if caught_up is not None:
+                connection.execute('INSERT OR REPLACE INTO checkpoint (name, seq, updated) '
+                                   "VALUES ('caught_up', NULL, ?)", (caught_up,))
+
+    def clear(self):
+        """ Removes every document but keeps the checkpoint """
+        if self.read_only:
+            self.written = time.time()
+            return
+        with self.connection() as connection:
+            connection.execute('DELETE FROM promotions')
+
+    @staticmethod
+    def _apply(connection, document):
+        """ Writes a document unless the replica has a newer revision of it """
+        new = generation(document.get('_rev'))
+        row = connection.execute('SELECT generation FROM promotions WHERE id = ?',
+                                 (document['_id'],)).fetchone()
+        if row and row[0] > new:
+            return
+        deleted = bool(document.get('_deleted'))
+        values = [None] * len(COLUMNS) if deleted else row_values(document)
+        connection.execute(
+            'INSERT OR REPLACE INTO promotions (id, generation, deleted, doc, {}) '
+            'VALUES (?, ?, ?, ?, {})'.format(', '.join('"{}"'.format(column) for column in COLUMNS),
+                                             ', '.join('?' * len(COLUMNS))),
+            [document['_id'], new, int(deleted), None if deleted else json.dumps(document)] + values)
+
+    ##################################################
+    # Replication
+    ##################################################
+
+    def sync(self):
+        """ Applies the next batch of changes and returns how many there were """
+        polled = time.time()
+        result = self._changes(self.checkpoint())
+        documents = [change.get('doc') or {'_id': change['id'], '_deleted': True,
+                                           '_rev': change.get('changes', [{}])[0].get('rev')}
+                     for change in result.get('results', [])
+                     if not change['id'].startswith('_design/')]
+        self.pending = result.get('pending',
+                                  0 if len(result.get('results', [])) < self.batch_size else None)
+        self.apply(documents, result['last_seq'], polled if self.pending == 0 else None)
+        if self.pending == 0:
+            self.caught_up = polled
+        metrics.increment('replica.changes', len(documents))
+        metrics.set('replica.pending', self.pending)
+        metrics.set('replica.lag', round(self.lag(), 3) if self.lag() is not None else None)
+        return len(documents)
+
+    def start(self):
+        """ Follows the changes feed in a background thread """
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='replica')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops following the changes feed """
+        self._stopped.set()
+
+    def _run(self):
+        """ Syncs while elected until stopped, backing off when Cloudant can't be reached """
+        while not self._stopped.is_set():
+            if not self._elected():
+                self._stopped.wait(self.poll)
+                continue
+            try:
+                self.sync()
+            except (HTTPError, ConnectionError, Timeout, sqlite3.Error) as error:
+                metrics.increment('replica.errors')
+                logger.warning('Replicating to %s failed: %s', self.path, error)
+                self._stopped.wait(self.poll)
+
+    def _elected(self):
+        """ True if this worker syncs the replica, taking or renewing the lock """
+        if not self.redis:
+            return True
+        try:
+            if self.redis.set(self.lock_key, self.owner, nx=True, ex=REPLICA_LOCK_TTL):
+                logger.info('Syncing the replica %s as %s', self.path, self.owner)
+                return True
+            if self.redis.get(self.lock_key) == self.owner:
+                self.redis.expire(self.lock_key, REPLICA_LOCK_TTL)
+                return True
+            return False
+        except RedisError as err:
+            logger.warning('Replica election failed, syncing anyway: %s', err)
+            return True
+
+    def _changes(self, since):
+        """ Long polls the changes feed for the changes after since """
+        params = {'since': since if since is not None else 0,
+                  'include_docs': 'true', 'style': 'main_only', 'limit': self.batch_size,
+                  'feed': 'longpoll', 'timeout': int(self.poll * 1000)}
+        resp = self.database.r_session.get('/'.join((self.database.database_url, '_changes')),
+                                           params=params, timeout=self.poll + 60)
+        resp.raise_for_status()
+        return resp.json()
@@ -0,0 +1,155 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Parallel key range scanning of a Cloudant database
+
+Splits the document id space into SCAN_SPLITS ranges and pages through
+them with ``_all_docs`` on SCAN_WORKERS threads, so a full scan costs
+about N / (page_size * workers) round trips instead of N / page_size.
+
+Promotion ids are uuids (hex strings) so the ranges are split on hex
+prefixes; the first and last ranges are open ended so ids of any other
+shape are still scanned, just not evenly spread.
+
+Each range hands its pages over through a small bounded queue, so at
+most about ``workers * 2`` pages are held in memory at a time.
+"""
+
+import os
+import threading
+from Queue import Queue, Empty, Full
+
+# get configruation from enviuronment (12-factor)
+SCAN_WORKERS = int(os.environ.get('SCAN_WORKERS', 4))
+SCAN_SPLITS = int(os.environ.get('SCAN_SPLITS', 16))
+SCAN_PAGE_SIZE = int(os.environ.get('SCAN_PAGE_SIZE', 500))
+
+LOWEST_KEY = u'\u0000'
+HIGHEST_KEY = u'\ufff0'
+_HEX = '0123456789abcdef'
+_DONE = object()    # marks the end of a range in a queue
+
+
+def key_ranges(splits):
+    """ Returns [(startkey, endkey), ...] covering every document id """
+    prefixes = [a + b for a in _HEX for b in _HEX]
+    splits = max(1, min(splits, len(prefixes)))
+    bounds = [prefixes[i * len(prefixes) // splits] for i in range(1, splits)]
+    starts = [LOWEST_KEY] + bounds
+    ends = bounds + [HIGHEST_KEY]
+    return list(zip(starts, ends))
+
+
+class _Failure(object):
+    """ Carries an exception from a worker to the consumer """
+
+    def __init__(self, error):
+        self.error = error
+
+
+class ParallelScanner(object):
+    """ Reads every document of a database using concurrent key ranges """
+
+    def __init__(self, database, workers=SCAN_WORKERS, splits=SCAN_SPLITS,
+                 page_size=SCAN_PAGE_SIZE):
+        self.database = database
+        self.workers = workers
+        self.splits = splits
+        self.page_size = page_size
+
+    def scan_range(self, startkey, endkey):
+        """ Yields the pages of documents whose ids are in [startkey, endkey) """
+        while startkey is not None:
+            rows = self.database.all_docs(limit=self.page_size, include_docs=True,
+                                          startkey=startkey, endkey=endkey,
+                                          inclusive_end=False).get('rows', [])
+            startkey = rows[-1]['id'] + u'\u0000' if len(rows) >= self.page_size else None
+            yield [row['doc'] for row in rows if not row['id'].startswith('_design/')]
+
+    def scan(self, ordered=True):
+        """
+        Yields every document in the database
+
+        :param ordered: True to yield documents in id order, False to
+            yield them as soon as any range returns them
+        """
+        if self.database.doc_count() <= self.page_size:
+            ranges = [(LOWEST_KEY, HIGHEST_KEY)]   # one request is enough
+        else:
+            ranges = key_ranges(self.splits)
+        if ordered:
+            queues = [Queue(maxsize=2) for _ in ranges]
+        else:
+            queues = [Queue(maxsize=self.workers * 2)] * len(ranges)
+        stopped = threading.Event()
+        pending = iter(list(enumerate(ranges)))
+        lock = threading.Lock()
+
+        def put(queue, item):
+            """ Blocks until the item is queued or the scan is abandoned """
+            while not stopped.is_set():
+                try:
+                    queue.put(item, timeout=0.5)
+                    return
+                except Full:
+                    pass
+
+        def work():
+            """ Scans ranges until there are none left """
+            while not stopped.is_set():
+                with lock:
+                    index, key_range = next(pending, (None, None))
+                if index is None:
+                    return
+                try:
+                    for page in self.scan_range(*key_range):
+                        put(queues[index], page)
+                        if stopped.is_set():
+                            return
+                except Exception as err:    # pylint: disable=broad-except
+                    put(queues[index], _Failure(err))
+                put(queues[index], _DONE)
+
+        threads = [threading.Thread(target=work, name='scan-{}'.format(i))
+                   for i in range(min(self.workers, len(ranges)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for document in self._drain(queues, ordered, len(ranges)):
+                yield document
+        finally:
+            stopped.set()
+
+    @staticmethod
+    def _drain(queues, ordered, count):
+        """ Yields documents from the range queues until every range is done """
+        remaining = count
+        index = 0
+        while remaining:
+            queue = queues[index] if ordered else queues[0]
+            try:
+                item = queue.get(timeout=1)
+            except Empty:
+                continue
+            if item is _DONE:
+                remaining -= 1
+                index += 1
+            elif isinstance(item, _Failure):
+                raise item.error
+            else:
+                for document in item:
+                    yield document
@@ -0,0 +1,113 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Case insensitive and prefix search on normalized text
+
+Text such as a category is stored a second time normalized (trimmed
+and lowercased) in a shadow field, e.g. category_key, so Cloudant Query
+can match it exactly or by prefix with a range on an index instead of
+a $regex.
+
+PrefixTrie answers autocomplete from memory. It holds the distinct
+values (there are far fewer categories than promotions), and a lookup
+walks down the prefix and then stops after the first limit values in
+alphabetical order, so it costs O(len(prefix) + limit * depth) however
+many promotions there are.
+"""
+
+import threading
+
+PREFIX_END = u'\ufff0'     # sorts after every character of a prefix
+
+
+def normalize(text):
+    """ Returns text trimmed and lowercased, or None """
+    if text is None:
+        return None
+    return u'{}'.format(text).strip().lower()
+
+
+def prefix_range(prefix):
+    """ Returns the Cloudant Query range of the normalized values starting with prefix """
+    prefix = normalize(prefix) or ''
+    return {'$gte': prefix, '$lt': prefix + PREFIX_END}
+
+
+class _Node(object):
+    """ One character of the trie """
+    __slots__ = ('children', 'value')
+
+    def __init__(self):
+        self.children = {}
+        self.value = None   # the value as first seen, when a value ends here
+
+
+class PrefixTrie(object):
+    """ In memory trie of distinct values for autocomplete """
+
+    def __init__(self):
+        self._root = _Node()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, value):
+        with self._lock:
+            node = self._find(normalize(value) or '')
+            return node is not None and node.value is not None
+
+    def add(self, value):
+        """ Adds a value, keeping the spelling it was first added with """
+        key = normalize(value)
+        if not key:
+            return
+        with self._lock:
+            node = self._root
+            for char in key:
+                node = node.children.setdefault(char, _Node())
+            if node.value is None:
+                node.value = u'{}'.format(value).strip()
+                self._size += 1
+
+    def clear(self):
+        """ Removes every value """
+        with self._lock:
+            self._root = _Node()
+            self._size = 0
+
+    def complete(self, prefix, limit=10):
+        """ Returns up to limit values that start with prefix, alphabetically """
+        results = []
+        with self._lock:
+            node = self._find(normalize(prefix) or '')
+            stack = [node] if node is not None else []
+            while stack and len(results) < limit:
+                node = stack.pop()
+                if node.value is not None:
+                    results.append(node.value)
+                stack.extend(node.children[char] for char in sorted(node.children, reverse=True))
+        return results
+
+    def _find(self, key):
+        """ Returns the node of a normalized prefix or None """
+        node = self._root
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
@@ -20,21 +20,68 @@ Promotion Service with UI
 Paths:
 ------
 GET / - Displays a UI for Selenium testing
+GET /metrics - Returns the metrics of this worker
+GET /queries - Returns the slow query log and the suggested indexes
 GET /promotions - Returns a list all of the Promotions
+HEAD /promotions - Returns the number of Promotions in the X-Total-Count header
+GET /promotions?active_at={time} - Returns the Promotions active at a time
+GET /promotions?discount_min={n}&discount_max={n}&sort=-discount - Returns Promotions by discount range
+GET /promotions?category_prefix={text} - Returns the Promotions whose category starts with text
+GET /promotions?filter={expression} - Returns the Promotions that pass an AND/OR/NOT filter
+GET /promotions?category={category}&explain=1 - Returns the query plans of a list query
+GET /promotions/categories?prefix={text} - Autocompletes category names
+GET /promotions/top?category={category}&n={n} - Returns the best discounts of a category
+GET /promotions/stats?group={field} - Returns counts and discount statistics per field value
 GET /promotions/{id} - Returns the Promotion with a given id number
 POST /promotions - creates a new Promotion record in the database
+POST /promotions/import - imports Promotions from NDJSON or CSV
+GET /promotions/export - streams Promotions as NDJSON or CSV
+POST /promotions/_lookup - returns the Promotions for many ids and productids
+POST /promotions/evaluate - prices cart lines with their best Promotion
+PUT /promotions/cancel - cancels every Promotion that matches the filters
+POST /jobs/{name} - starts a reset, cancel, reindex, import, sweep or migrate job
+GET /jobs/{id} - returns the state of a background job
 PUT /promotions/{id} - updates a Promotion record in the database
+PATCH /promotions/{id} - changes some fields of a Promotion record
 DELETE /promotions/{id} - deletes a Promotion record in the database
 """
 
+import os
 import sys
+import tempfile
 import logging
-from flask import jsonify, request, json, url_for, make_response, abort
+from flask import Response, jsonify, request, json, url_for, make_response, abort
 from flask_api import status    # HTTP Status Codes
 from werkzeug.exceptions import NotFound
-from app.models import Promotion
+from app.metrics import metrics
+from app.bulk_import import Importer, BulkImportError, IMPORT_FORMATS, read_records, \
+    load_checkpoint
+from app.export import export_chunks, EXPORT_MIMETYPES
+from app.pricing import evaluate, parse_lines
+from app.jobs import jobs, JobStore, FAILED
+from app.intervals import now
 from . import app
 
+# get configruation from enviuronment (12-factor)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'cloudant').lower()
+if STORAGE_BACKEND == 'sqlite':
+    from app.models_sqlite import Promotion
+else:
+    from app.models import Promotion
+
+# most ids plus productids accepted by one lookup
+LOOKUP_MAX_KEYS = 500
+
+# most categories that one autocomplete request returns
+COMPLETE_MAX_LIMIT = 100
+
+# larger imports must be sent to POST /jobs/import so they can't outlast
+# the worker timeout
+IMPORT_INLINE_MAX_BYTES = int(os.environ.get('IMPORT_INLINE_MAX_BYTES', 5 * 1024 * 1024))
+
+# bulk updates matching more Promotions than this run as a background job
+BULK_INLINE_LIMIT = int(os.environ.get('BULK_INLINE_LIMIT', 200))
+
 # Error handlers reuire app to be initialized so we must import
 # then only after we have initialized the Flask app instance
 import error_handlers
@@ -47,6 +94,36 @@ def healthcheck():
     """ Let them know our heart is still beating """
     return make_response(jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
 
+######################################################################
+# GET METRICS
+######################################################################
+@app.route('/metrics')
+def get_metrics():
+    """ Returns the counters of this worker process """
+    counters = metrics.snapshot()
+    counters['singleflight.find.coalesce_rate'] = Promotion.find_flight.coalesce_rate
+    counters['singleflight.find_by.coalesce_rate'] = Promotion.query_flight.coalesce_rate
+    if Promotion.replica:
+        counters['replica.lag'] = Promotion.replica.lag()
+        counters['replica.usable'] = Promotion.replica.usable()
+    for operation in ('update', 'delete', 'patch'):
+        writes = metrics.get('writes.' + operation)
+        conflicts = metrics.get('writes.{}.conflicts'.format(operation))
+        counters['writes.{}.conflict_rate'.format(operation)] = \
+            float(conflicts) / writes if writes else 0.0
+    return make_response(jsonify(counters), status.HTTP_200_OK)
+
+######################################################################
+# SLOW QUERIES
+######################################################################
+@app.route('/queries')
+def get_queries():
+    """ Returns the recent slow queries of this worker and the indexes they need """
+    return make_response(jsonify(threshold_ms=Promotion.profiler.threshold,
+                                 slow=Promotion.profiler.slow_queries(),
+                                 advice=Promotion.profiler.advise()),
+                         status.HTTP_200_OK)
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -63,27 +140,126 @@ def index():
 @app.route('/promotions', methods=['GET'])
 def list_promotions():
     """ Returns all of the Promotions """
-    promotions = []
-    category = request.args.get('category')
-    productid = request.args.get('productid')
-    discount = request.args.get('discount')
-    if category:
-        app.logger.info('Find by category')
-        promotions = Promotion.find_by_category(category)
-    elif productid:
-        app.logger.info('Find by productid')
-        promotions = Promotion.find_by_productid(productid)
-    elif discount:
-        app.logger.info('Find by discount')
-        promotions = Promotion.find_by_discount(discount)
-    else:
-        app.logger.info('Find all')
-        promotions = Promotion.all()
+    if request.method == 'HEAD':
+        return count_promotions()
+    if 'active_at' in request.args:
+        active_at = request.args.get('active_at') or None
+        productid = request.args.get('productid') or None
+        app.logger.info('Find active at %s', active_at or 'now')
+        promotions = Promotion.find_active(active_at, productid)
+        return make_response(jsonify([promotion.serialize() for promotion in promotions]),
+                             status.HTTP_200_OK)
+    if request.args.get('filter'):
+        filters = {'filter': request.args.get('filter'), 'limit': request.args.get('limit')}
+        try:
+            limit = int(filters['limit']) if filters['limit'] else None
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, 'limit must be a number')
+        app.logger.info('Find by filter %s', filters['filter'])
+        body = Promotion.results.get(filters, lambda: json.dumps(
+            [promotion.serialize() for promotion in Promotion.find_by_filter(filters['filter'],
+                                                                             limit)]))
+        return make_response(body, status.HTTP_200_OK, {'Content-Type': 'application/json'})
+    if any(request.args.get(name) for name in RANGE_FILTERS):
+        filters = dict((name, request.args.get(name)) for name in RANGE_FILTERS
+                       if request.args.get(name))
+        for name in ('discount_min', 'discount_max'):
+            try:
+                float(filters.get(name, 0))
+            except ValueError:
+                abort(status.HTTP_400_BAD_REQUEST, '{} must be a number'.format(name))
+        app.logger.info('Find by discount range %s', filters)
+        if is_explain():
+            return explain_query(filters, find_range_json)
+        body = Promotion.results.get(filters, lambda: find_range_json(filters))
+        return make_response(body, status.HTTP_200_OK, {'Content-Type': 'application/json'})
+    filters = {}
+    for name in ('category', 'category_prefix', 'productid', 'discount'):
+        if request.args.get(name):
+            filters = {name: request.args.get(name)}
+            break
+    app.logger.info('Find by %s', filters.keys() or 'all')
+    if is_explain():
+        return explain_query(filters, find_promotions_json)
+    body = Promotion.results.get(filters, lambda: find_promotions_json(filters))
+    return make_response(body, status.HTTP_200_OK, {'Content-Type': 'application/json'})
 
-    app.logger.info('[%s] Promotions returned', len(promotions))
-    results = [promotion.serialize() for promotion in promotions]
-    return make_response(jsonify(results), status.HTTP_200_OK)
 
+def is_explain():
+    """ True if the request asks for the query plans instead of the results """
+    return request.args.get('explain', '').lower() in ('1', 'true')
+
+def explain_query(filters, find_json):
+    """ Runs a list query past the result cache and returns the plans of its queries """
+    with Promotion.profiler.capture() as queries:
+        results = json.loads(find_json(filters))
+    return make_response(jsonify(filters=filters, results=len(results), queries=queries),
+                         status.HTTP_200_OK)
+
+def count_promotions():
+    """ Returns the number of Promotions, or of those with a field value, in a header """
+    field = next((name for name in COUNT_FILTERS if request.args.get(name)), None)
+    value = request.args.get(field) if field else None
+    if field == 'available':
+        value = value.lower() == 'true'
+    total = Promotion.count(field, value, **view_options())
+    return make_response('', status.HTTP_200_OK, {'X-Total-Count': str(total)})
+
+def view_options():
+    """ Returns the stable and update options of a count or stats request """
+    stable = request.args.get('stable')
+    if stable not in (None, 'true', 'false'):
+        abort(status.HTTP_400_BAD_REQUEST, 'stable must be true or false')
+    return {'stable': None if stable is None else stable == 'true',
+            'update': request.args.get('update')}
+
+######################################################################
+# COUNTS AND DISCOUNT STATISTICS
+######################################################################
+@app.route('/promotions/stats', methods=['GET'])
+def promotion_stats():
+    """
+    Returns the number of Promotions and statistics of their discounts
+
+    ?group=category (or available or discount_type) returns one row per
+    value. The views answer as they are unless update=true is given, so
+    a dashboard is never held up by an index build.
+    """
+    group = request.args.get('group') or None
+    app.logger.info('Request for the stats by %s', group or 'all')
+    stats = Promotion.stats(group, **view_options())
+    return make_response(jsonify(stats), status.HTTP_200_OK)
+
+######################################################################
+# AUTOCOMPLETE CATEGORIES
+######################################################################
+@app.route('/promotions/categories', methods=['GET'])
+def complete_categories():
+    """ Returns the known categories that start with a prefix, for type ahead """
+    try:
+        limit = min(int(request.args.get('limit', 10)), COMPLETE_MAX_LIMIT)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, 'limit must be a number')
+    categories = Promotion.complete_category(request.args.get('prefix', ''), limit)
+    return make_response(jsonify(categories), status.HTTP_200_OK)
+
+######################################################################
+# BEST DISCOUNTS OF A CATEGORY
+######################################################################
+@app.route('/promotions/top', methods=['GET'])
+def top_promotions():
+    """ Returns the available Promotions of a category with the highest discounts """
+    category = request.args.get('category')
+    if not category:
+        abort(status.HTTP_400_BAD_REQUEST, 'category is required')
+    try:
+        count = int(request.args.get('n', 10))
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, 'n must be a number')
+    app.logger.info('Request for the top %s Promotions of %s', count, category)
+    promotions = Promotion.find_top(category, count)
+    return make_response(jsonify([promotion.serialize() for promotion in promotions]),
+                         status.HTTP_200_OK)
 
 ######################################################################
 # RETRIEVE A PROMOTION
@@ -136,6 +312,138 @@ def create_promotions():
                          {'Location': location_url})
 
 
+######################################################################
+# IMPORT PROMOTIONS
+######################################################################
+@app.route('/promotions/import', methods=['POST'])
+def import_promotions():
+    """
+    Imports Promotions from NDJSON or CSV
+
+    The import runs inside the request, so bodies are limited to
+    IMPORT_INLINE_MAX_BYTES; larger files go to POST /jobs/import.
+    An interrupted import can be resumed with ?resume_from=<committed>
+    using the committed count from the previous response, and records
+    that were written after it are reported as existing.
+    """
+    content_type = request.headers.get('Content-Type', '').split(';')[0].strip()
+    if content_type not in IMPORT_FORMATS:
+        app.logger.error('Invalid Content-Type: %s', content_type)
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+              'Content-Type must be one of {}'.format(', '.join(sorted(IMPORT_FORMATS))))
+    if request.content_length is None or request.content_length > IMPORT_INLINE_MAX_BYTES:
+        app.logger.error('Import body of %s bytes is too large', request.content_length)
+        abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+              'Imports larger than {} bytes must be sent to POST /jobs/import'.format(
+                  IMPORT_INLINE_MAX_BYTES))
+    resume_from = request.args.get('resume_from', 0, type=int)
+    app.logger.info('Request to Import Promotions from record [%s]', resume_from)
+    records = read_records(request.stream, IMPORT_FORMATS[content_type])
+    try:
+        summary = Importer(model=Promotion).run(records, start=resume_from)
+    except BulkImportError as error:
+        app.logger.error(str(error))
+        return make_response(jsonify(error.summary), status.HTTP_503_SERVICE_UNAVAILABLE)
+    app.logger.info('[%s] Promotions imported', summary['imported'])
+    return make_response(jsonify(summary), status.HTTP_200_OK)
+
+######################################################################
+# EXPORT PROMOTIONS
+######################################################################
+@app.route('/promotions/export', methods=['GET'])
+def export_promotions():
+    """
+    Streams all of the Promotions as NDJSON or CSV
+
+    ?format=ndjson|csv selects the output, ?category=, ?productid= and
+    ?discount= filter it. The X-Export-Seq header is a sequence token:
+    pass it back as ?since= to export only what changed after it.
+    Gzip is used when the client sends Accept-Encoding: gzip.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_MIMETYPES:
+        abort(status.HTTP_400_BAD_REQUEST, 'format must be one of {}'.format(
+            ', '.join(sorted(EXPORT_MIMETYPES))))
+    filters = {}
+    for name in ('category', 'productid', 'discount'):
+        if request.args.get(name):
+            filters[name] = request.args.get(name)
+    since = request.args.get('since')
+    app.logger.info('Request to Export Promotions since [%s] filtered by %s', since, filters)
+
+    seq = Promotion.update_seq()
+    if since:
+        documents = Promotion.changes_since(since)
+    else:
+        documents = Promotion.scan(ordered=False)
+    use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    headers = {'X-Export-Seq': str(seq)}
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+    chunks = export_chunks(documents, fmt, filters, use_gzip)
+    return Response(chunks, status=status.HTTP_200_OK, headers=headers,
+                    mimetype=EXPORT_MIMETYPES[fmt])
+
+######################################################################
+# LOOK UP MANY PROMOTIONS
+######################################################################
+@app.route('/promotions/_lookup', methods=['POST'])
+def lookup_promotions():
+    """
+    Returns the Promotions for many ids and productids at once
+
+    The body is {"ids": [...], "productids": [...]}. The response groups
+    the results by key: each id maps to its Promotion or null and each
+    productid maps to a list of its Promotions.
+    """
+    check_content_type('application/json')
+    data = request.get_json() or {}
+    if not isinstance(data, dict):
+        abort(status.HTTP_400_BAD_REQUEST, 'The body must be a JSON object')
+    ids = data.get('ids') or []
+    productids = data.get('productids') or []
+    if not isinstance(ids, list) or not isinstance(productids, list):
+        abort(status.HTTP_400_BAD_REQUEST, 'ids and productids must be lists')
+    if not all(isinstance(key, basestring) for key in ids + productids):
+        abort(status.HTTP_400_BAD_REQUEST, 'ids and productids must be strings')
+    if len(ids) + len(productids) > LOOKUP_MAX_KEYS:
+        abort(status.HTTP_400_BAD_REQUEST,
+              'At most {} ids and productids can be looked up'.format(LOOKUP_MAX_KEYS))
+    app.logger.info('Request to Look up [%s] ids and [%s] productids', len(ids), len(productids))
+    results = {'ids': {}, 'productids': {}}
+    if ids:
+        for promotion_id, promotion in Promotion.find_many(ids).items():
+            results['ids'][promotion_id] = promotion.serialize() if promotion else None
+    if productids:
+        for productid, promotions in Promotion.find_by_productids(productids).items():
+            results['productids'][productid] = [promotion.serialize() for promotion in promotions]
+    return make_response(jsonify(results), status.HTTP_200_OK)
+
+######################################################################
+# EVALUATE CART PRICES
+######################################################################
+@app.route('/promotions/evaluate', methods=['POST'])
+def evaluate_promotions():
+    """
+    Prices a batch of cart lines with the best available Promotion
+
+    The body is {"lines": [{"productid", "category", "price", "qty"}, ...]}.
+    The response has one row per line in the order of "fields".
+    """
+    check_content_type('application/json')
+    data = request.get_json() or {}
+    if not isinstance(data, dict):
+        abort(status.HTTP_400_BAD_REQUEST, 'The body must be a JSON object')
+    lines = parse_lines(data.get('lines'))
+    app.logger.info('Request to Evaluate [%s] cart lines', len(lines))
+    productids = set(line['productid'] for line in lines)
+    promotions = {}
+    at = now()
+    for productid, matches in Promotion.find_by_productids(productids).items():
+        promotions[productid] = [promotion for promotion in matches
+                                 if promotion.available and promotion.is_active(at)]
+    return make_response(jsonify(evaluate(lines, promotions)), status.HTTP_200_OK)
+
 ######################################################################
 # UPDATE AN EXISTING PROMOTION
 ######################################################################
@@ -158,6 +466,27 @@ def update_promotions(promotion_id):
     promotion.save()
     return make_response(jsonify(promotion.serialize()), status.HTTP_200_OK)
 
+######################################################################
+# CHANGE SOME FIELDS OF A PROMOTION
+######################################################################
+@app.route('/promotions/<promotion_id>', methods=['PATCH'])
+def patch_promotions(promotion_id):
+    """
+    Partially update a Promotion
+
+    Only the fields in the body are changed, in the database, without
+    reading the Promotion first
+    """
+    app.logger.info('Request to Patch a promotion with id [%s]', promotion_id)
+    check_content_type('application/json')
+    changes = request.get_json()
+    if not isinstance(changes, dict):
+        abort(status.HTTP_400_BAD_REQUEST, 'Body must be a JSON object of field changes')
+    promotion = Promotion.patch(promotion_id, changes)
+    if not promotion:
+        raise NotFound("Promotion with id '{}' was not found.".format(promotion_id))
+    return make_response(jsonify(promotion.serialize()), status.HTTP_200_OK)
+
 ######################################################################
 # DELETE A PROMOTION
 ######################################################################
@@ -180,13 +509,65 @@ def delete_promotions(promotion_id):
 @app.route('/promotions/<promotion_id>/cancel', methods=['PUT'])
 def cancel_promotions(promotion_id):
     """ Purchasing a Promotion makes it unavailable """
-    promotion = Promotion.find(promotion_id)
+    promotion = Promotion.patch(promotion_id, {'available': False})
     if not promotion:
         abort(status.HTTP_404_NOT_FOUND, "Promotion with id '{}' was not found.".format(promotion_id))
-    promotion.available = False
-    promotion.save()
     return make_response(jsonify(promotion.serialize()), status.HTTP_200_OK)
 
+######################################################################
+# CANCEL ALL PROMOTIONS THAT MATCH
+######################################################################
+@app.route('/promotions/cancel', methods=['PUT'])
+def cancel_promotions_where():
+    """
+    Cancels every Promotion that matches the category, productid or discount
+
+    The filters match as in the finders, so category ignores case and
+    discount matches on its number. Small match sets are updated inline
+    and the summary is returned. When more than BULK_INLINE_LIMIT match,
+    a background job is started and 202 Accepted is returned with the job
+    to poll.
+    """
+    selector = Promotion.filter_selector(dict((name, request.args.get(name))
+                                              for name in ('category', 'productid', 'discount')))
+    if not selector:
+        abort(status.HTTP_400_BAD_REQUEST,
+              'At least one of category, productid or discount is required')
+    selector['available'] = True
+    app.logger.info('Request to Cancel Promotions where %s', selector)
+    if Promotion.count_where(selector, BULK_INLINE_LIMIT + 1) <= BULK_INLINE_LIMIT:
+        summary = Promotion.update_where(selector, {'available': False})
+        return make_response(jsonify(summary), status.HTTP_200_OK)
+    return job_accepted(submit_cancel_job(selector))
+
+######################################################################
+# START A BACKGROUND JOB
+######################################################################
+@app.route('/jobs/<name>', methods=['POST'])
+def create_jobs(name):
+    """
+    Starts a maintenance job and returns 202 Accepted
+
+    The jobs are reset, cancel (body {"category": ...}), reindex and
+    import (body as for POST /promotions/import, or ?resume=<job id>
+    to resume a failed import)
+    """
+    if name not in JOB_TYPES:
+        abort(status.HTTP_404_NOT_FOUND, "Job type '{}' was not found.".format(name))
+    app.logger.info('Request to Start a [%s] job', name)
+    return job_accepted(JOB_TYPES[name]())
+
+######################################################################
+# RETRIEVE A BACKGROUND JOB
+######################################################################
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_jobs(job_id):
+    """ Returns the state, progress, throughput and result of a background job """
+    job = jobs.get(job_id)
+    if not job:
+        abort(status.HTTP_404_NOT_FOUND, "Job with id '{}' was not found.".format(job_id))
+    return make_response(jsonify(job), status.HTTP_200_OK)
+
 ######################################################################
 # DELETE ALL PROMOTION DATA (for testing only)
 ######################################################################
@@ -205,13 +586,168 @@ def promotions_reset():
 def init_db(dbname="promotions"):
     """ Initlaize the model """
     Promotion.init_db(dbname)
+    if Promotion.client:
+        jobs.store = JobStore.connect(Promotion.client, dbname + '_jobs')
+        jobs.store.fail_stale()
+
+def job_accepted(job):
+    """ Returns a 202 Accepted response for a submitted job """
+    location_url = url_for('get_jobs', job_id=job.id, _external=True)
+    return make_response(jsonify(job.serialize()), status.HTTP_202_ACCEPTED,
+                         {'Location': location_url})
+
+def submit_reset_job():
+    """ Removes all Promotions in the background """
+    def reset_job(job):
+        """ Removes every Promotion """
+        Promotion.remove_all()
+        job.step(processed=1)
+    return jobs.submit('reset', reset_job)
+
+def submit_cancel_job(selector=None):
+    """ Cancels the Promotions that match a selector in the background """
+    if selector is None:
+        filters = request.get_json(silent=True) or {}
+        if not isinstance(filters, dict):
+            abort(status.HTTP_400_BAD_REQUEST, 'The body must be a JSON object')
+        selector = Promotion.filter_selector(filters)
+        if not selector:
+            abort(status.HTTP_400_BAD_REQUEST, 'At least one of category, productid or discount is required')
+        selector['available'] = True
+
+    def cancel_job(job):
+        """ Cancels the matches a page at a time """
+        return Promotion.update_where(selector, {'available': False},
+                                      progress=lambda summary: job.step(processed=summary['matched'],
+                                                                        **summary))
+    return jobs.submit('cancel', cancel_job, selector)
+
+def submit_reindex_job():
+    """ Deploys the design documents and rebuilds the in memory indexes in the background """
+    def reindex_job(job):
+        """ Builds and switches over changed indexes, reporting their progress """
+        design = {}
+        if Promotion.design:
+            design = Promotion.design.deploy(progress=lambda design: job.step(design=design))
+        Promotion.rebuild_indexes()
+        job.step(processed=1)
+        return design
+    return jobs.submit('reindex', reindex_job)
+
+def submit_import_job():
+    """
+    Spools the request body to a file and imports it in the background
+
+    The spool and its checkpoint are kept until the import succeeds, so
+    a failed import can be resumed on the same worker with
+    POST /jobs/import?resume=<job id> and no body.
+    """
+    resume = request.args.get('resume')
+    if resume:
+        record = jobs.get(resume)
+        if not record or record['name'] != 'import' or \
+                not os.path.exists(record['params'].get('spool', '')):
+            abort(status.HTTP_404_NOT_FOUND,
+                  "Import job with id '{}' can't be resumed here.".format(resume))
+        if record['state'] != FAILED:
+            abort(status.HTTP_409_CONFLICT, "Import job '{}' has not failed.".format(resume))
+        params = dict(record['params'], resumes=resume)
+        return jobs.submit('import', import_spool, params)
+
+    content_type = request.headers.get('Content-Type', '').split(';')[0].strip()
+    if content_type not in IMPORT_FORMATS:
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+              'Content-Type must be one of {}'.format(', '.join(sorted(IMPORT_FORMATS))))
+    spool = tempfile.NamedTemporaryFile(prefix='import-', delete=False)
+    with spool:
+        for chunk in iter(lambda: request.stream.read(64 * 1024), ''):
+            spool.write(chunk)
+    try:
+        return jobs.submit('import', import_spool,
+                           {'format': IMPORT_FORMATS[content_type], 'spool': spool.name})
+    except Exception:
+        os.remove(spool.name)
+        raise
+
+def import_spool(job):
+    """ Imports a spooled file from its checkpoint, removing it once it is all written """
+    spool = job.params['spool']
+    checkpoint = spool + '.ckpt'
+    with open(spool) as stream:
+        importer = Importer(checkpoint=checkpoint, model=Promotion,
+                            progress=lambda summary: job.step(processed=summary['read'],
+                                                              **summary))
+        summary = importer.run(read_records(stream, job.params['format']),
+                               start=load_checkpoint(checkpoint))
+    for path in (spool, checkpoint):
+        if os.path.exists(path):
+            os.remove(path)
+    return summary
+
+def submit_sweep_job():
+    """ Deletes the expired Promotions now rather than at the next sweep """
+    def sweep_job(job):
+        """ Runs one sweep """
+        deleted = Promotion.sweeper.sweep(force=True)
+        job.step(processed=deleted)
+        return {'deleted': deleted}
+    return jobs.submit('sweep', sweep_job)
+
+def submit_migrate_job():
+    """ Backfills the derived search fields of older Promotions in the background """
+    def migrate_job(job):
+        """ Rewrites the Promotions that are missing a derived field """
+        return Promotion.migrate_fields(
+            progress=lambda summary: job.step(processed=summary['matched'], **summary))
+    return jobs.submit('migrate', migrate_job)
+
+# the jobs that POST /jobs/<name> can start
+JOB_TYPES = {
+    'reset': submit_reset_job,
+    'cancel': submit_cancel_job,
+    'reindex': submit_reindex_job,
+    'import': submit_import_job,
+    'sweep': submit_sweep_job,
+    'migrate': submit_migrate_job
+}
+
+# query parameters that HEAD /promotions can count by
+COUNT_FILTERS = ('category', 'available', 'discount_type')
+
+# query parameters of a discount range query
+RANGE_FILTERS = ('discount_min', 'discount_max', 'discount_type', 'sort')
 
 # load sample data
 def data_load(payload):
     """ Loads a Promotion into the database """
-    promotion = Promotion(payload['productid'], payload['category'],payload['available'],payload['discount'])
+    promotion = Promotion(payload['productid'], payload['category'],payload['available'],payload['discount'],
+                          payload.get('start'), payload.get('end'), payload.get('expires'))
     promotion.save()
 
+def find_promotions_json(filters):
+    """ Runs a list query and returns the results as a JSON string """
+    if 'category' in filters:
+        promotions = Promotion.find_by_category(filters['category'])
+    elif 'category_prefix' in filters:
+        promotions = Promotion.find_by_category_prefix(filters['category_prefix'])
+    elif 'productid' in filters:
+        promotions = Promotion.find_by_productid(filters['productid'])
+    elif 'discount' in filters:
+        promotions = Promotion.find_by_discount(filters['discount'])
+    else:
+        promotions = Promotion.all()
+    app.logger.info('[%s] Promotions returned', len(promotions))
+    return json.dumps([promotion.serialize() for promotion in promotions])
+
+def find_range_json(filters):
+    """ Runs a discount range query and returns the results as a JSON string """
+    bounds = dict((name, float(filters[name]) if name in filters else None)
+                  for name in ('discount_min', 'discount_max'))
+    promotions = Promotion.find_by_discount_range(discount_type=filters.get('discount_type'),
+                                                  sort=filters.get('sort'), **bounds)
+    app.logger.info('[%s] Promotions returned', len(promotions))
+    return json.dumps([promotion.serialize() for promotion in promotions])
+
 def data_reset():
     """ Removes all Promotions from the database """
     Promotion.remove_all()
@@ -0,0 +1,83 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Single-flight request coalescing
+
+When many threads ask for the same key at once only the first one calls
+the backend. The others wait for it and share its result (or its
+exception). Callers must treat the shared result as read only.
+
+Metrics:
+    singleflight.<name>.calls      backend calls that were made
+    singleflight.<name>.coalesced  requests that shared another call
+"""
+
+import threading
+from app.metrics import metrics
+
+
+class _Call(object):
+    """ A backend call in flight """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """ Runs at most one call per key at a time """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """ Calls func() unless a call for key is already running """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.increment('singleflight.{}.coalesced'.format(self.name))
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        metrics.increment('singleflight.{}.calls'.format(self.name))
+        try:
+            call.result = func()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    @property
+    def coalesce_rate(self):
+        """ Fraction of requests that were served by another request's call """
+        coalesced = metrics.get('singleflight.{}.coalesced'.format(self.name))
+        calls = metrics.get('singleflight.{}.calls'.format(self.name))
+        if not coalesced + calls:
+            return 0.0
+        return float(coalesced) / (coalesced + calls)
@@ -192,6 +192,30 @@ $(function () {
         clear_form_data()
     });
 
+    // ****************************************
+    // Autocomplete the Category
+    // ****************************************
+
+    $("#promotion_category").on("input", function () {
+
+        var prefix = $("#promotion_category").val();
+
+        var ajax = $.ajax({
+            type: "GET",
+            url: "/promotions/categories?prefix=" + encodeURIComponent(prefix),
+            contentType:"application/json",
+            data: ''
+        })
+
+        ajax.done(function(res){
+            $("#category_list").empty();
+            for (var i = 0; i < res.length; i++) {
+                $("#category_list").append($("<option>").attr("value", res[i]));
+            }
+        });
+
+    });
+
     // ****************************************
     // Search for a Promotion
     // ****************************************
@@ -0,0 +1,127 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Periodic removal of expired Promotions from Cloudant
+
+Every SWEEP_INTERVAL seconds the sweeper reads the Promotions whose
+``expires`` time has passed, oldest first from the expires index, and
+deletes them with one _bulk_docs request per SWEEP_BATCH_SIZE documents.
+When Redis is available only one worker sweeps per interval.
+
+Metrics:
+    sweeper.runs             sweeps that were made
+    sweeper.deleted          expired Promotions deleted
+    sweeper.last_deleted     Promotions deleted by the last sweep
+    sweeper.rate             deletes per second in the last sweep
+    documents.count          documents in the database after the last sweep
+    documents.count_delta    change in documents.count since the sweep before
+"""
+
+import os
+import time
+import socket
+import logging
+import threading
+from redis.exceptions import RedisError
+from app.metrics import metrics
+from app.intervals import now
+
+# get configruation from enviuronment (12-factor)
+SWEEP_INTERVAL = int(os.environ.get('SWEEP_INTERVAL', 300))
+SWEEP_BATCH_SIZE = int(os.environ.get('SWEEP_BATCH_SIZE', 200))
+
+LOCK_KEY = 'promotions:sweeper'
+
+logger = logging.getLogger(__name__)
+
+
+class Sweeper(object):
+    """ Deletes expired Promotions on a background thread """
+
+    def __init__(self, model, interval=SWEEP_INTERVAL, batch_size=SWEEP_BATCH_SIZE, redis=None):
+        """
+        :param model: the Promotion class, which provides find_expired, delete_many
+            and doc_count
+        :param redis: optional Redis client used to elect one sweeping worker
+        """
+        self.model = model
+        self.interval = interval
+        self.batch_size = batch_size
+        self.redis = redis
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def sweep(self, force=False):
+        """
+        Deletes every expired Promotion and returns how many were deleted
+
+        :param force: True to sweep now even if another worker was elected
+            for this interval, as POST /jobs/sweep does
+        """
+        if not force and not self._elected():
+            return 0
+        started = time.time()
+        deleted = 0
+        while True:
+            documents = self.model.find_expired(now(), self.batch_size)
+            if not documents:
+                break
+            removed = self.model.delete_many(documents)
+            deleted += removed
+            if removed == 0 or len(documents) < self.batch_size:
+                break   # the rest conflicted with other writers; try next time
+        elapsed = max(time.time() - started, 0.001)
+        count = self.model.doc_count()
+        metrics.increment('sweeper.runs')
+        metrics.increment('sweeper.deleted', deleted)
+        metrics.set('sweeper.last_deleted', deleted)
+        metrics.set('sweeper.rate', round(deleted / elapsed, 2))
+        metrics.set('documents.count_delta', count - metrics.get('documents.count')
+                    if metrics.get('sweeper.runs') > 1 else 0)
+        metrics.set('documents.count', count)
+        logger.info('Sweeper deleted %s expired promotions in %.2fs', deleted, elapsed)
+        return deleted
+
+    def start(self):
+        """ Sweeps every interval until stopped """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='expiry-sweeper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops the background sweeps """
+        self._stopped.set()
+
+    def _run(self):
+        """ Waits for the interval and sweeps, logging any failure """
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as err:    # pylint: disable=broad-except
+                logger.warning('Sweep failed: %s', err)
+
+    def _elected(self):
+        """ True if this worker should sweep this interval """
+        if not self.redis:
+            return True
+        try:
+            return bool(self.redis.set(LOCK_KEY, self.owner, nx=True,
+                                       ex=max(1, self.interval - 1)))
+        except RedisError as err:
+            logger.warning('Sweeper election failed, sweeping anyway: %s', err)
+            return True
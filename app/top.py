@@ -0,0 +1,159 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Incrementally maintained top N Promotions per category
+
+Each category keeps its best TOP_CAPACITY available Promotions ordered
+by discount_value (highest first), so GET /promotions/top reads the
+first n of them instead of the whole category. Saves, deletes and
+cancels update the list in O(log TOP_CAPACITY).
+
+A list only holds the best TOP_CAPACITY, so once a Promotion has been
+pushed out, deleting one of the best can leave fewer than n behind.
+The category is then marked incomplete and top() returns None, which
+tells the caller to reload it from the database. Categories another
+worker wrote to are dropped and reloaded the same way. A load is only
+kept if nothing was written to the category while it was being read.
+"""
+
+import os
+import bisect
+import threading
+
+# get configruation from enviuronment (12-factor)
+TOP_CAPACITY = int(os.environ.get('TOP_CAPACITY', 100))
+
+
+class TopIndex(object):
+    """ The best discounts of each category """
+
+    def __init__(self, capacity=TOP_CAPACITY):
+        self.capacity = capacity
+        self._lists = {}        # category -> sorted [(-value, id)]
+        self._complete = {}     # category -> True if the list has every candidate
+        self._entries = {}      # id -> (category, (-value, id))
+        self._versions = {}     # category -> writes seen, to spot racing loads
+        self._epoch = 0         # times every category was dropped
+        self._lock = threading.Lock()
+
+    def __contains__(self, category):
+        with self._lock:
+            return category in self._lists
+
+    def add(self, promotion_id, category, value):
+        """
+        Records the discount of a saved Promotion
+
+        :param value: the discount_value, or None if the Promotion can't
+            be in the top (no number or not available)
+        """
+        with self._lock:
+            self._remove(promotion_id)
+            self._versions[category] = self._versions.get(category, 0) + 1
+            entries = self._lists.get(category)
+            if value is None or entries is None:
+                return     # categories are loaded the first time they are read
+            entry = (-value, promotion_id)
+            if len(entries) >= self.capacity and entry > entries[-1]:
+                self._complete[category] = False
+                return
+            bisect.insort(entries, entry)
+            self._entries[promotion_id] = (category, entry)
+            if len(entries) > self.capacity:
+                dropped = entries.pop()
+                self._entries.pop(dropped[1], None)
+                self._complete[category] = False
+
+    def discard(self, promotion_id):
+        """ Removes a deleted Promotion """
+        with self._lock:
+            self._remove(promotion_id)
+
+    def version(self, category):
+        """ Returns a stamp that changes whenever the category is written to """
+        with self._lock:
+            return self._epoch, self._versions.get(category, 0)
+
+    def load(self, category, ranked, version):
+        """
+        Replaces a category with Promotions read from the database
+
+        :param ranked: [(promotion_id, value)] at most capacity of them
+        :param version: version(category) from before the read; the load
+            is ignored if the category was written to since then
+        """
+        with self._lock:
+            if (self._epoch, self._versions.get(category, 0)) != version:
+                return
+            self._drop(category)
+            entries = sorted((-value, promotion_id) for promotion_id, value in ranked)
+            self._lists[category] = entries
+            self._complete[category] = len(entries) < self.capacity
+            for entry in entries:
+                self._entries[entry[1]] = (category, entry)
+
+    def top(self, category, n):
+        """ Returns the ids of the best n in a category or None if it must be loaded """
+        with self._lock:
+            entries = self._lists.get(category)
+            if entries is None or (len(entries) < n and not self._complete[category]):
+                return None
+            return [entry[1] for entry in entries[:n]]
+
+    def ranked(self, category, n):
+        """
+        Returns the ids of a category best first, or None if it must be loaded
+
+        Like top(), but returns every id held so that a caller that skips
+        some of them can still find n.
+        """
+        with self._lock:
+            entries = self._lists.get(category)
+            if entries is None or (len(entries) < n and not self._complete[category]):
+                return None
+            return [entry[1] for entry in entries]
+
+    def forget(self, categories):
+        """ Drops categories so they are reloaded when next read """
+        with self._lock:
+            for category in categories:
+                self._drop(category)
+                self._versions[category] = self._versions.get(category, 0) + 1
+
+    def clear(self):
+        """ Drops every category """
+        with self._lock:
+            self._lists.clear()
+            self._complete.clear()
+            self._entries.clear()
+            self._epoch += 1
+
+    def _remove(self, promotion_id):
+        """ Removes a Promotion; the caller holds the lock """
+        found = self._entries.pop(promotion_id, None)
+        if found is None:
+            return
+        category, entry = found
+        entries = self._lists[category]
+        position = bisect.bisect_left(entries, entry)
+        if position < len(entries) and entries[position] == entry:
+            del entries[position]
+
+    def _drop(self, category):
+        """ Removes a category; the caller holds the lock """
+        for entry in self._lists.pop(category, []):
+            self._entries.pop(entry[1], None)
+        self._complete.pop(category, None)
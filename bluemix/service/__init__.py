@@ -24,9 +24,11 @@ from service.resources import PromotionResource
 from service.resources import PromotionCollection
 from service.resources import HomePage
 from service.resources import CancelAction
+from service.resources import LookupAction
 
 api.add_resource(HomePage, '/')
 api.add_resource(PromotionCollection, '/promotions')
+api.add_resource(LookupAction, '/promotions/_lookup')
 api.add_resource(PromotionResource, '/promotions/<promotion_id>')
 api.add_resource(CancelAction, '/promotions/<promotion_id>/cancel')
 
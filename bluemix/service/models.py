@@ -34,10 +34,13 @@ Docker Note:
 import os
 import json
 import logging
-from retry import retry
 from cloudant.client import Cloudant
 from cloudant.query import Query
+from cloudant.design_document import DesignDocument
 from requests import HTTPError, ConnectionError
+from requests.utils import quote
+from .retries import retry
+from .result_cache import ResultCache, index_keys
 
 # get configruation from enviuronment (12-factor)
 ADMIN_PARTY = os.environ.get('ADMIN_PARTY', 'False').lower() == 'true'
@@ -45,16 +48,57 @@ CLOUDANT_HOST = os.environ.get('CLOUDANT_HOST', 'localhost')
 CLOUDANT_USERNAME = os.environ.get('CLOUDANT_USERNAME', 'admin')
 CLOUDANT_PASSWORD = os.environ.get('CLOUDANT_PASSWORD', 'pass')
 
+# attempts at a patch that keeps conflicting with other writers
+PATCH_RETRIES = int(os.environ.get('PATCH_RETRIES', 5))
+
+# fields that a patch may change
+UPDATABLE_FIELDS = ['productid', 'category', 'available', 'discount']
+
+# design document with the server side update functions, the same as
+# app.models.DESIGN_DOCUMENTS['promotions'] as both services share it
+DESIGN_DOC = '_design/promotions'
+PATCH_MISSING = 'promotion_missing'
+PATCH_FUNCTION = '''function(doc, req) {
+  if (!doc) {
+    return [null, {code: 404, json: {error: 'not_found', reason: 'promotion_missing'}}];
+  }
+  var changes = JSON.parse(req.body);
+  var previous = {};
+  for (var field in changes) {
+    if (field.charAt(0) !== '_') {
+      previous[field] = doc[field];
+      doc[field] = changes[field];
+    }
+  }
+  return [doc, {json: {doc: doc, previous: previous}}];
+}'''
+
 class DataValidationError(Exception):
     """ Custom Exception with data validation fails """
     pass
 
+def check_changes(changes, updatable=UPDATABLE_FIELDS):
+    """
+    Returns changes if they can be applied to a Promotion (see app.models.check_changes)
+
+    :raises DataValidationError: if they can't
+    """
+    unknown = set(changes) - set(updatable)
+    if unknown:
+        raise DataValidationError('Fields cannot be updated: {}'.format(', '.join(sorted(unknown))))
+    if 'productid' in changes and changes['productid'] is None:
+        raise DataValidationError('productid attribute is not set')
+    if 'available' in changes and not isinstance(changes['available'], bool):
+        raise DataValidationError('available must be true or false')
+    return changes
+
 class Promotion(object):
     """ Promotion interface to database """
 
     logger = logging.getLogger(__name__)
     client = None   # cloudant.client.Cloudant
     database = None # cloudant.database.CloudantDatabase
+    results = ResultCache()
 
     def __init__(self, productid=None, category=None, available=True, discount=None,):
         """ Constructor """
@@ -80,6 +124,7 @@ class Promotion(object):
 
         if document.exists():
             self.id = document['_id']
+            Promotion.results.bump(index_keys(document))
 
     @retry(HTTPError, delay=1, backoff=2, tries=5)
     def update(self):
@@ -91,8 +136,42 @@ class Promotion(object):
         except KeyError:
             document = None
         if document:
+            keys = index_keys(document)
             document.update(self.serialize())
             document.save()
+            Promotion.results.bump(keys + index_keys(document))
+
+    @classmethod
+    @retry(HTTPError, delay=1, backoff=2, tries=5)
+    def patch(cls, promotion_id, changes):
+        """
+        Changes some fields of a Promotion with a single request
+
+        Runs the patch update function of DESIGN_DOC, again straight away
+        on a 409 Conflict. Returns the Promotion or None if it doesn't exist.
+        """
+        changes = check_changes(changes)
+        url = '/'.join([DesignDocument(cls.database, DESIGN_DOC).document_url,
+                        '_update', 'patch', quote(promotion_id, safe='')])
+        for _ in range(PATCH_RETRIES):
+            resp = cls.database.r_session.put(url, data=json.dumps(changes),
+                                              headers={'Content-Type': 'application/json'})
+            if resp.status_code == 409:
+                continue
+            if resp.status_code == 404:
+                if resp.json().get('reason') == PATCH_MISSING:
+                    return None
+                cls.ensure_design_document()
+                continue
+            break
+        resp.raise_for_status()
+        result = resp.json()
+        document = result['doc']
+        Promotion.results.bump(index_keys(dict(document, **result['previous'])) +
+                               index_keys(document))
+        promotion = Promotion().deserialize(document)
+        promotion.id = document['_id']
+        return promotion
 
     @retry(HTTPError, delay=1, backoff=2, tries=5)
     def save(self):
@@ -112,6 +191,7 @@ class Promotion(object):
         except KeyError:
             document = None
         if document:
+            Promotion.results.bump(index_keys(document))
             document.delete()
 
     def serialize(self):
@@ -167,12 +247,27 @@ class Promotion(object):
         """ Creates a new query index for searching """
         cls.database.create_query_index(index_name=field_name, fields=[{field_name: order}])
 
+    @classmethod
+    @retry(HTTPError, delay=1, backoff=2, tries=5)
+    def ensure_design_document(cls):
+        """ Creates or updates the design document with the update functions """
+        ddoc = DesignDocument(cls.database, DESIGN_DOC)
+        if ddoc.exists():
+            ddoc.fetch()
+        updates = ddoc.get('updates', {})
+        if updates.get('patch') != PATCH_FUNCTION:
+            updates['patch'] = PATCH_FUNCTION
+            ddoc['updates'] = updates
+            ddoc.save()
+
     @classmethod
     @retry(HTTPError, delay=1, backoff=2, tries=5)
     def remove_all(cls):
         """ Removes all documents from the database (use for testing)  """
         for document in cls.database:
-            document.delete()
+            if not document['_id'].startswith('_design/'):
+                document.delete()
+        cls.results.clear()
 
     @classmethod
     @retry(HTTPError, delay=1, backoff=2, tries=5)
@@ -180,6 +275,8 @@ class Promotion(object):
         """ Query that returns all Promotions """
         results = []
         for doc in cls.database:
+            if doc['_id'].startswith('_design/'):
+                continue
             promotion = Promotion().deserialize(doc)
             promotion.id = doc['_id']
             results.append(promotion)
@@ -211,6 +308,29 @@ class Promotion(object):
         except KeyError:
             return None
 
+    @classmethod
+    @retry(HTTPError, delay=1, backoff=2, tries=5)
+    def find_many(cls, promotion_ids):
+        """ Query that finds many Promotions by their ids with one request """
+        results = {}
+        rows = cls.database.all_docs(keys=list(set(promotion_ids)),
+                                     include_docs=True).get('rows', [])
+        for row in rows:
+            document = row.get('doc')
+            results[row['key']] = Promotion().deserialize(document) if document else None
+        return results
+
+    @classmethod
+    @retry(HTTPError, delay=1, backoff=2, tries=5)
+    def find_by_productids(cls, productids):
+        """ Query that finds the Promotions for many productids with one query """
+        results = dict((productid, []) for productid in productids)
+        if results:
+            for promotion in cls.find_by(productid={'$in': sorted(results)}):
+                if promotion.productid in results:
+                    results[promotion.productid].append(promotion)
+        return results
+
     @classmethod
     @retry(HTTPError, delay=1, backoff=2, tries=5)
     def find_by_productid(cls, productid):
@@ -304,3 +424,6 @@ class Promotion(object):
         # check for success
         if not Promotion.database.exists():
             raise AssertionError('Database [{}] could not be obtained'.format(dbname))
+
+        # Install the server side update functions
+        Promotion.ensure_design_document()
@@ -5,3 +5,4 @@ from .promotion_resource import PromotionResource
 from .promotion_collection import PromotionCollection
 from .home_page import HomePage
 from .cancel_action import CancelAction
+from .lookup_action import LookupAction
@@ -13,13 +13,9 @@ class CancelAction(Resource):
     """ Resource to Cancel a Promotion """
     def put(self, promotion_id):
         """ Cancel a Promotion """
-        promotion = Promotion.find(promotion_id)
+        promotion = Promotion.patch(promotion_id, {'available': False})
 
         if not promotion:
             abort(status.HTTP_404_NOT_FOUND, "Promotion with id '{}' was not found.".format(promotion_id))
 
-        promotion.available = False
-
-        promotion.save()
-
         return promotion.serialize(), status.HTTP_200_OK
@@ -0,0 +1,45 @@
+"""
+This module contains the batch lookup action
+"""
+from flask import abort, request
+from flask_api import status
+from flask_restful import Resource
+from service.models import Promotion
+
+# most ids plus productids accepted by one lookup
+LOOKUP_MAX_KEYS = 500
+
+######################################################################
+# LOOK UP MANY PROMOTIONS
+######################################################################
+class LookupAction(Resource):
+    """ Resource to Look up many Promotions at once """
+    def post(self):
+        """
+        Returns the Promotions for many ids and productids
+
+        The body is {"ids": [...], "productids": [...]}. Each id maps to
+        its Promotion or null and each productid to a list of Promotions.
+        """
+        if request.headers.get('Content-Type') != 'application/json':
+            abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, 'Content-Type must be application/json')
+        data = request.get_json() or {}
+        if not isinstance(data, dict):
+            abort(status.HTTP_400_BAD_REQUEST, 'The body must be a JSON object')
+        ids = data.get('ids') or []
+        productids = data.get('productids') or []
+        if not isinstance(ids, list) or not isinstance(productids, list):
+            abort(status.HTTP_400_BAD_REQUEST, 'ids and productids must be lists')
+        if not all(isinstance(key, basestring) for key in ids + productids):
+            abort(status.HTTP_400_BAD_REQUEST, 'ids and productids must be strings')
+        if len(ids) + len(productids) > LOOKUP_MAX_KEYS:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  'At most {} ids and productids can be looked up'.format(LOOKUP_MAX_KEYS))
+        results = {'ids': {}, 'productids': {}}
+        if ids:
+            for promotion_id, promotion in Promotion.find_many(ids).items():
+                results['ids'][promotion_id] = promotion.serialize() if promotion else None
+        if productids:
+            for productid, promotions in Promotion.find_by_productids(productids).items():
+                results['productids'][productid] = [promotion.serialize() for promotion in promotions]
+        return results, status.HTTP_200_OK
@@ -1,6 +1,7 @@
 """
 This module contains the Promotion Collection Resource
 """
+import json
 from flask import request, abort
 from flask_restful import Resource
 from flask_api import status    # HTTP Status Codes
@@ -15,30 +16,38 @@ class PromotionCollection(Resource):
     def get(self):
         """ Returns all of the Promotions """
         app.logger.info('Request to list Promotions...')
-        promotions = []
-        category = request.args.get('category')
-        productid = request.args.get('productid')
-        available = request.args.get('available')
-        discount = request.args.get('discount')
-        if category:
-            app.logger.info('Filtering by category: %s', category)
-            promotions = Promotion.find_by_category(category)
-        elif productid:
-            app.logger.info('Filtering by productid:%s', productid)
-            promotions = Promotion.find_by_productid(productid)
-        elif available:
-            app.logger.info('Filtering by available: %s', available)
-            is_available = available.lower() in ['yes', 'y', 'true', 't', '1']
-            promotions = Promotion.find_by_availability(is_available)
-        elif discount:
-            app.logger.info('Filtering by discount:%s', discount)
-            promotions = Promotion.find_by_discount(discount)
+        filters = {}
+        for name in ('category', 'productid', 'available', 'discount'):
+            if request.args.get(name):
+                filters = {name: request.args.get(name)}
+                break
+        if 'available' in filters:
+            is_available = filters['available'].lower() in ['yes', 'y', 'true', 't', '1']
+            filters['available'] = 'true' if is_available else 'false'
+        body = Promotion.results.get(filters, lambda: self.find_json(filters))
+        return app.response_class(body, status=status.HTTP_200_OK,
+                                  mimetype='application/json')
+
+    @staticmethod
+    def find_json(filters):
+        """ Runs a list query and returns the results as a JSON string """
+        if 'category' in filters:
+            app.logger.info('Filtering by category: %s', filters['category'])
+            promotions = Promotion.find_by_category(filters['category'])
+        elif 'productid' in filters:
+            app.logger.info('Filtering by productid:%s', filters['productid'])
+            promotions = Promotion.find_by_productid(filters['productid'])
+        elif 'available' in filters:
+            app.logger.info('Filtering by available: %s', filters['available'])
+            promotions = Promotion.find_by_availability(filters['available'] == 'true')
+        elif 'discount' in filters:
+            app.logger.info('Filtering by discount:%s', filters['discount'])
+            promotions = Promotion.find_by_discount(filters['discount'])
         else:
             promotions = Promotion.all()
 
         app.logger.info('[%s] Promotions returned', len(promotions))
-        results = [promotion.serialize() for promotion in promotions]
-        return results, status.HTTP_200_OK
+        return json.dumps([promotion.serialize() for promotion in promotions])
 
     def post(self):
         """
@@ -18,6 +18,7 @@ class PromotionResource(Resource):
     Allows the manipulation of a single Promotion
     GET /promotions/{id} - Returns a Promotion with the id
     PUT /promotions/{id} - Update a Promotion with the id
+    PATCH /promotions/{id} - Change some fields of a Promotion with the id
     DELETE /promotions/{id} -  Deletes a Promotion with the id
     """
 
@@ -56,6 +57,24 @@ class PromotionResource(Resource):
         promotion.save()
         return promotion.serialize(), status.HTTP_200_OK
 
+    def patch(self, promotion_id):
+        """
+        Partially update a Promotion
+
+        This endpoint will change only the fields in the body that is posted
+        """
+        app.logger.info('Request to Patch a promotion with id [%s]', promotion_id)
+        changes = request.get_json()
+        if not isinstance(changes, dict):
+            raise BadRequest('Body must be a JSON object of field changes')
+        try:
+            promotion = Promotion.patch(promotion_id, changes)
+        except DataValidationError as error:
+            raise BadRequest(str(error))
+        if not promotion:
+            abort(status.HTTP_404_NOT_FOUND, "Promotion with id '{}' was not found.".format(promotion_id))
+        return promotion.serialize(), status.HTTP_200_OK
+
     def delete(self, promotion_id):
         """
         Delete a Promotion
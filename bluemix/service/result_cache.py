@@ -0,0 +1,197 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+List query result cache with stale-while-revalidate
+
+Caches the serialized JSON body of a list query keyed by its filters.
+Fresh entries are served as is. Stale entries are still served while a
+background thread reloads them. Every write bumps a generation counter
+for the index keys it touched (e.g. ``category:bogo``) which makes the
+matching entries invalid straight away. If the backend fails, an entry
+is served for up to RESULT_STALE_IF_ERROR seconds instead of an error;
+while there is such an entry to fall back on, the loader runs under
+retries.fail_fast() so an outage is noticed without waiting out the
+retries.
+
+The bluemix service is deployed on its own, so this is a copy of
+app/result_cache.py with the index keys of app/invalidation.py; keep
+them in step.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from .retries import fail_fast
+
+# get configruation from enviuronment (12-factor)
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 256))
+RESULT_FRESH_TTL = int(os.environ.get('RESULT_FRESH_TTL', 5))
+RESULT_STALE_TTL = int(os.environ.get('RESULT_STALE_TTL', 60))
+RESULT_STALE_IF_ERROR = int(os.environ.get('RESULT_STALE_IF_ERROR', 300))
+
+ALL = 'all'         # index key that every write affects
+FLUSH_ALL = '*'     # index key that invalidates everything
+
+# filters whose results only change when a document with that value is
+# written; any other filter (ranges, sorts, discount) depends on ALL. A
+# discount filter matches on the number in it, so '10' is answered by
+# '10%' and '10.0' too and can't be keyed by the value it was given
+EXACT_FILTERS = ('productid', 'category', 'available')
+
+logger = logging.getLogger(__name__)
+
+
+def index_key(field, value):
+    """ Returns the list query key of a field value, categories trimmed """
+    if field == 'category' and value is not None:
+        value = u'{}'.format(value).strip()
+    return u'{}:{}'.format(field, value).lower()
+
+
+def index_keys(document):
+    """ Returns the list query keys a document belongs to """
+    if not document:
+        return []
+    return [index_key(field, document[field])
+            for field in ('productid', 'category', 'discount', 'available')
+            if field in document]
+
+
+def filter_key(filters):
+    """ Returns a hashable key for a dictionary of query filters """
+    return tuple(sorted((name.lower(), value) for name, value in filters.items()
+                        if value is not None and value != ''))
+
+
+def filter_index_keys(key):
+    """ Returns the index keys whose writes invalidate a filter key """
+    if any(name not in EXACT_FILTERS for name, _ in key):
+        return [ALL]
+    return [index_key(name, value) for name, value in key]
+
+
+class ResultEntry(object):
+    """ A cached result body and when and for which generation it was made """
+
+    def __init__(self, body, generation):
+        self.body = body
+        self.generation = generation
+        self.created = time.time()
+
+    @property
+    def age(self):
+        """ Seconds since this entry was loaded """
+        return time.time() - self.created
+
+
+class ResultCache(object):
+    """ Caches list query results and refreshes them in the background """
+
+    def __init__(self, size=RESULT_CACHE_SIZE, fresh=RESULT_FRESH_TTL,
+                 stale=RESULT_STALE_TTL, stale_if_error=RESULT_STALE_IF_ERROR):
+        self.size = size
+        self.fresh = fresh
+        self.stale = stale
+        self.stale_if_error = stale_if_error
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, filters, loader):
+        """
+        Returns the cached body for filters, calling loader() on a miss
+
+        :param filters: dictionary of the query filters
+        :param loader: function that returns the serialized result body
+        """
+        key = filter_key(filters)
+        generation = self.generation(key)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry.generation == generation:
+            if entry.age < self.fresh:
+                return entry.body
+            if entry.age < self.stale:
+                self._refresh(key, generation, loader)
+                return entry.body
+        fallback = entry is not None and entry.age < self.stale_if_error
+        try:
+            if fallback:
+                with fail_fast():
+                    body = loader()
+            else:
+                body = loader()
+        except Exception:
+            if fallback:
+                logger.warning('Serving stale result for %s', key)
+                return entry.body
+            raise
+        self._store(key, ResultEntry(body, generation))
+        return body
+
+    def generation(self, key):
+        """ Returns the generation stamp that a result for key depends on """
+        index_keys = filter_index_keys(key) or [ALL]
+        with self._lock:
+            return (self._generations.get(FLUSH_ALL, 0),) + \
+                tuple(self._generations.get(index, 0) for index in index_keys)
+
+    def bump(self, keys):
+        """ Invalidates every result that depends on one of the index keys """
+        with self._lock:
+            for key in set(keys) | set([ALL]):
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        """ Removes every cached result """
+        with self._lock:
+            self._entries.clear()
+            self._generations[FLUSH_ALL] = self._generations.get(FLUSH_ALL, 0) + 1
+
+    def _store(self, key, entry):
+        """ Saves an entry, evicting the least recently used if full """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _refresh(self, key, generation, loader):
+        """ Reloads a stale entry on a background thread """
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def reload_entry():
+            """ Calls the loader and stores the result if still current """
+            try:
+                with fail_fast():
+                    body = loader()
+                if self.generation(key) == generation:
+                    self._store(key, ResultEntry(body, generation))
+            except Exception as err:    # pylint: disable=broad-except
+                logger.warning('Background refresh of %s failed: %s', key, err)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=reload_entry, name='result-refresh')
+        thread.daemon = True
+        thread.start()
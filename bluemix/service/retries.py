@@ -0,0 +1,56 @@
+######################################################################
+# Copyright 2016, 2018 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Retries of database calls that a caller can cut short
+
+``retry`` is a drop in for ``retry.retry``. Inside a ``fail_fast()``
+block the decorated calls on that thread make a single attempt, so a
+caller that has something else to fall back on (such as a stale cached
+result) finds out about an outage at once instead of after minutes of
+backoff.
+"""
+
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from retry.api import retry_call
+
+_state = threading.local()
+
+
+def retry(exceptions=Exception, **options):
+    """ Returns a decorator that retries like retry.retry unless failing fast """
+    def decorator(func):
+        """ Wraps func in the retries """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            """ Calls func, retrying unless the thread is failing fast """
+            if getattr(_state, 'fail_fast', False):
+                return func(*args, **kwargs)
+            return retry_call(func, args, kwargs, exceptions, **options)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def fail_fast():
+    """ Makes every retried call on this thread a single attempt """
+    previous = getattr(_state, 'fail_fast', False)
+    _state.fail_fast = True
+    try:
+        yield
+    finally:
+        _state.fail_fast = previous
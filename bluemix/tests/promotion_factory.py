@@ -2,8 +2,8 @@
 Test Factory to make fake objects for testing
 """
 import factory
-#import datetime
-#import factory.fuzzy as ff
+import datetime
+import factory.fuzzy as ff
 from factory.fuzzy import FuzzyChoice
 from factory.fuzzy import FuzzyFloat
 from factory.fuzzy import FuzzyText
@@ -19,10 +19,12 @@ class PromotionFactory(factory.Factory):
     category = FuzzyChoice(choices=['dollar', 'percentage', 'BOGO', 'BOHO'])
     available = FuzzyChoice(choices=[True, False])
     discount = FuzzyFloat(50)
-#    startdate = ff.FuzzyDate(datetime.date.today()-datetime.timedelta(days=10),
-#                              datetime.date.today())
-#    enddate = ff.FuzzyDate(datetime.date.today(),
-#                            datetime.date.today()+datetime.timedelta(days=10))
+    start = factory.LazyFunction(lambda: ff.FuzzyDate(
+        datetime.date.today()-datetime.timedelta(days=10),
+        datetime.date.today()).fuzz().isoformat())
+    end = factory.LazyFunction(lambda: ff.FuzzyDate(
+        datetime.date.today()+datetime.timedelta(days=1),
+        datetime.date.today()+datetime.timedelta(days=10)).fuzz().isoformat())
 
 if __name__ == '__main__':
     for _ in range(10):
@@ -152,6 +152,11 @@ class TestPromotions(unittest.TestCase):
         promotion = Promotion(None, "cat")
         self.assertRaises(DataValidationError, promotion.create)
 
+    def test_patch_with_bad_fields(self):
+        """ Patch a Promotion with fields it can't take """
+        self.assertRaises(DataValidationError, Promotion.patch, 'id', {'available': 'yes'})
+        self.assertRaises(DataValidationError, Promotion.patch, 'id', {'color': 'red'})
+
     def test_find_promotion(self):
         """ Find a Promotion by id """
         Promotion("A002", "dog").save()
@@ -22,7 +22,8 @@ def step_impl(context):
     headers = {'Content-Type': 'application/json'}
     context.resp = requests.delete(context.base_url + '/promotions/reset', headers=headers)
     expect(context.resp.status_code).to_equal(204)
-    create_url = context.base_url + '/promotions'
+    import_url = context.base_url + '/promotions/import'
+    rows = []
     for row in context.table:
         data = {
             "productid": row['productid'],
@@ -30,9 +31,12 @@ def step_impl(context):
             "available": row['available'] in ['True', 'true', '1'],
             "discount": row['discount']
             }
-        payload = json.dumps(data)
-        context.resp = requests.post(create_url, data=payload, headers=headers)
-        expect(context.resp.status_code).to_equal(201)
+        rows.append(json.dumps(data))
+    payload = '\n'.join(rows)
+    headers = {'Content-Type': 'application/x-ndjson'}
+    context.resp = requests.post(import_url, data=payload, headers=headers)
+    expect(context.resp.status_code).to_equal(200)
+    expect(context.resp.json()['imported']).to_equal(len(rows))
 
 @when('I visit the "home page"')
 def step_impl(context):
@@ -0,0 +1,112 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bitmap Index Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import time
+import unittest
+from app.bitmaps import Bitmap, BitmapIndex, CHUNK_BITS, parse_filter, matches, \
+    document_values, discount_bucket
+
+
+def promotion(category, available=True, value=20.0):
+    """ Returns the indexed values of a Promotion """
+    return document_values({'category': category, 'available': available}, value)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestBitmaps(unittest.TestCase):
+    """ Bitmap index tests """
+
+    def test_bitmap_operations(self):
+        """ AND, OR and AND NOT bitmaps across chunks """
+        first = Bitmap()
+        second = Bitmap()
+        for ordinal in (1, 5, CHUNK_BITS + 3):
+            first.add(ordinal)
+        for ordinal in (5, 7, 3 * CHUNK_BITS):
+            second.add(ordinal)
+        self.assertEqual(list(first & second), [5])
+        self.assertEqual(list(first | second), [1, 5, 7, CHUNK_BITS + 3, 3 * CHUNK_BITS])
+        self.assertEqual(list(first - second), [1, CHUNK_BITS + 3])
+        self.assertEqual(len(first), 3)
+        first.discard(CHUNK_BITS + 3)
+        self.assertNotIn(CHUNK_BITS + 3, first)
+        self.assertEqual(len(first.chunks), 1)
+
+    def test_discount_bucket(self):
+        """ Put discounts into buckets """
+        self.assertEqual(discount_bucket(5), '0-10')
+        self.assertEqual(discount_bucket(10), '10-25')
+        self.assertEqual(discount_bucket(250), '100+')
+        self.assertEqual(discount_bucket(None), 'none')
+
+    def test_parse_filter(self):
+        """ Parse AND, OR, NOT and brackets with the usual precedence """
+        self.assertEqual(parse_filter('category:BOGO or available:true and not discount:0-10'),
+                         ('or', [('is', 'category', 'bogo'),
+                                 ('and', [('is', 'available', True),
+                                          ('not', ('is', 'discount', '0-10'))])]))
+        self.assertEqual(parse_filter('(category:a OR category:b) AND available:false'),
+                         ('and', [('or', [('is', 'category', 'a'), ('is', 'category', 'b')]),
+                                  ('is', 'available', False)]))
+        for bad in ['', 'category:a AND', '(category:a', 'category:a)', 'productid:1',
+                    'available:maybe', 'category:']:
+            self.assertRaises(ValueError, parse_filter, bad)
+
+    def test_select(self):
+        """ Select Promotions with a filter and keep the index up to date """
+        index = BitmapIndex()
+        index.add('1', promotion('BOGO'))
+        index.add('2', promotion('bogo', available=False))
+        index.add('3', promotion('Dollar', value=5))
+        node = parse_filter('category:bogo AND NOT available:false')
+        self.assertEqual(index.select(node), ['1'])
+        self.assertTrue(matches(node, promotion('BOGO')))
+        self.assertEqual(index.select(parse_filter('discount:0-10 OR available:false')), ['2', '3'])
+        index.add('1', promotion('Dollar'))
+        self.assertEqual(index.select(node), [])
+        index.discard('3')
+        index.add('4', promotion('dollar'))     # reuses the ordinal of 3
+        self.assertEqual(sorted(index.select(parse_filter('category:dollar'))), ['1', '4'])
+        self.assertEqual(index.count(parse_filter('NOT category:dollar')), 1)
+        self.assertEqual(len(index), 3)
+
+    def test_combined_filter_speed(self):
+        """ Count a combined filter over many Promotions quickly """
+        index = BitmapIndex()
+        categories = ['bogo', 'dollar', 'percentage', 'summer']
+        for number in xrange(200000):
+            index.add(number, promotion(categories[number % 4], number % 3 != 0, number % 60))
+        node = parse_filter('(category:bogo OR category:summer) AND available:true '
+                            'AND NOT discount:0-10')
+        started = time.time()
+        count = index.count(node)
+        elapsed = time.time() - started
+        self.assertEqual(count, sum(1 for number in xrange(200000)
+                                    if number % 4 in (0, 3) and number % 3 != 0
+                                    and number % 60 >= 10))
+        self.assertLess(elapsed, 0.05)
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
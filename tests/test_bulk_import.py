@@ -0,0 +1,114 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bulk Import Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from mock import patch
+from requests import HTTPError
+from app.bulk_import import Importer, BulkImportError, read_records, load_checkpoint
+
+NDJSON = '\n'.join([
+    '{"productid": "A1234", "category": "BOGO", "available": true, "discount": "20"}',
+    '',
+    '{"productid": "B4321", "category": "dollar", "available": false, "discount": "5"}',
+    'not json',
+    '{"category": "dollar", "available": false, "discount": "5"}',
+    '{"productid": "C1111", "category": "dollar", "available": true, "discount": "5"}'
+])
+
+CSV = 'productid,category,available,discount\nA1234,BOGO,true,20\nB4321,dollar,no,5\n'
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+@patch('app.models.Promotion.create_many')
+class TestBulkImport(unittest.TestCase):
+    """ Test Cases for streaming imports """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.folder, 'import.ckpt')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_import_ndjson(self, create_mock):
+        """ Import NDJSON and count the bad records """
+        create_mock.return_value = []
+        summary = Importer(batch_size=2).run(read_records(StringIO(NDJSON)))
+        self.assertEqual(summary['read'], 5)
+        self.assertEqual(summary['imported'], 3)
+        self.assertEqual(summary['failed'], 2)
+        self.assertEqual(summary['committed'], 5)
+        written = [p.productid for call in create_mock.call_args_list for p in call[0][0]]
+        self.assertEqual(sorted(written), ['A1234', 'B4321', 'C1111'])
+
+    def test_import_csv(self, create_mock):
+        """ Import CSV converting the available column """
+        create_mock.return_value = []
+        Importer().run(read_records(StringIO(CSV), 'csv'))
+        promotions = create_mock.call_args[0][0]
+        self.assertEqual([p.available for p in promotions], [True, False])
+
+    def test_bulk_docs_errors(self, create_mock):
+        """ Per document errors are reported """
+        create_mock.return_value = [{'error': 'forbidden', 'reason': 'Not allowed.'}]
+        summary = Importer().run(read_records(StringIO(CSV), 'csv'))
+        self.assertEqual(summary['imported'], 1)
+        self.assertEqual(summary['failed'], 1)
+
+    def test_rerun_ids(self, create_mock):
+        """ A rerun gives every record the same id, and conflicts count as existing """
+        create_mock.return_value = []
+        Importer().run(read_records(StringIO(CSV), 'csv'))
+        first = [p.id for p in create_mock.call_args[0][0]]
+        create_mock.return_value = [{'error': 'conflict', 'reason': 'Document update conflict.'}]
+        summary = Importer().run(read_records(StringIO(CSV), 'csv'))
+        self.assertEqual([p.id for p in create_mock.call_args[0][0]], first)
+        self.assertEqual(len(set(first)), 2)
+        self.assertEqual(summary['imported'], 1)
+        self.assertEqual(summary['existing'], 1)
+        self.assertEqual(summary['failed'], 0)
+
+    def test_resume_from_checkpoint(self, create_mock):
+        """ A failed import resumes after the last committed batch """
+        create_mock.side_effect = [[], HTTPError()]
+        importer = Importer(batch_size=2, workers=1, checkpoint=self.checkpoint)
+        self.assertRaises(BulkImportError, importer.run, read_records(StringIO(NDJSON)))
+        committed = load_checkpoint(self.checkpoint)
+        self.assertEqual(committed, 2)
+        create_mock.side_effect = None
+        create_mock.return_value = []
+        summary = Importer(batch_size=2).run(read_records(StringIO(NDJSON)), start=committed)
+        self.assertEqual(summary['read'], 5)
+        self.assertEqual(summary['committed'], 5)
+        written = [p.productid for p in create_mock.call_args[0][0]]
+        self.assertEqual(written, ['C1111'])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
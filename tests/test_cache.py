@@ -0,0 +1,308 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cache Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import unittest
+import time
+import threading
+from mock import MagicMock, patch
+from requests import ConnectionError, HTTPError
+from redis.exceptions import RedisError
+from app.cache import LocalCache, TieredCache, rev_number, is_tombstone, NEGATIVE_CACHE_TTL
+from app.invalidation import InvalidationBus, index_keys, FLUSH_ALL
+from app.result_cache import ResultCache
+from app.retries import retry
+from app.singleflight import SingleFlight
+from app.metrics import metrics
+from app.bloom import BloomFilter
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCache(unittest.TestCase):
+    """ Test Cases for the tiered Promotion cache """
+
+    def setUp(self):
+        self.local = LocalCache(size=2, ttl=60)
+        self.remote = MagicMock()
+        self.remote.get.return_value = None
+        self.remote.put.return_value = True
+        self.cache = TieredCache(self.local, self.remote)
+
+    def test_rev_number(self):
+        """ Parse the generation out of a revision """
+        self.assertEqual(rev_number('3-abc'), 3)
+        self.assertEqual(rev_number(None), 0)
+        self.assertEqual(rev_number('garbage'), 0)
+
+    def test_local_cache_lru(self):
+        """ Evict the least recently used entry when full """
+        self.local.put('a', 1)
+        self.local.put('b', 2)
+        self.local.get('a')
+        self.local.put('c', 3)
+        self.assertEqual(self.local.get('a'), 1)
+        self.assertIsNone(self.local.get('b'))
+        self.assertEqual(len(self.local), 2)
+
+    @patch('app.cache.time.time')
+    def test_local_cache_expires(self, time_mock):
+        """ Expired entries are not returned """
+        time_mock.return_value = 1000
+        self.local.put('a', 1)
+        time_mock.return_value = 1061
+        self.assertIsNone(self.local.get('a'))
+
+    def test_read_through_redis(self):
+        """ A local miss is filled from Redis """
+        doc = {'_id': 'a', '_rev': '1-x', 'productid': 'A1234'}
+        self.remote.get.return_value = doc
+        self.assertEqual(self.cache.get('a'), doc)
+        self.assertEqual(self.local.get('a'), doc)
+
+    def test_stale_put_is_not_cached(self):
+        """ A put rejected by Redis is not cached locally """
+        self.remote.put.return_value = False
+        self.cache.put('a', {'_id': 'a', '_rev': '1-x'})
+        self.assertIsNone(self.local.get('a'))
+
+    def test_delete_writes_tombstone(self):
+        """ Deleting records a newer tombstone revision """
+        self.cache.delete('a', '2-x')
+        tombstone = self.local.get('a')
+        self.assertTrue(is_tombstone(tombstone))
+        self.assertEqual(rev_number(tombstone['_rev']), 3)
+
+    @patch('app.cache.time.time')
+    def test_tombstone_is_short_lived(self, time_mock):
+        """ A tombstone expires after NEGATIVE_CACHE_TTL rather than the entry TTL """
+        time_mock.return_value = 1000
+        self.cache.delete('a', '2-x')
+        self.assertEqual(self.remote.put.call_args[0][2], NEGATIVE_CACHE_TTL)
+        time_mock.return_value = 1000 + NEGATIVE_CACHE_TTL + 1
+        self.assertIsNone(self.local.get('a'))
+
+    def test_clear(self):
+        """ Clear empties every tier """
+        self.cache.put('a', {'_id': 'a', '_rev': '1-x'})
+        self.cache.clear()
+        self.assertIsNone(self.local.get('a'))
+        self.remote.clear.assert_called_once_with()
+
+
+class TestInvalidationBus(unittest.TestCase):
+    """ Test Cases for the cache invalidation bus """
+
+    def setUp(self):
+        self.redis = MagicMock()
+        self.bus = InvalidationBus(self.redis)
+        self.handler = MagicMock()
+        self.bus.subscribe(self.handler)
+
+    def test_index_keys(self):
+        """ Index keys are lower case field:value pairs """
+        doc = {'productid': 'A1234', 'category': 'BOGO', 'available': True}
+        self.assertEqual(index_keys(doc),
+                         ['productid:a1234', 'category:bogo', 'available:true'])
+        self.assertEqual(index_keys(None), [])
+        self.assertEqual(index_keys({'category': ' Summer '}), ['category:summer'])
+
+    def test_publish_and_dispatch(self):
+        """ Messages from other workers reach the handlers """
+        other = InvalidationBus(self.redis)
+        other.publish(['1'], ['category:bogo'])
+        data = self.redis.publish.call_args[0][1]
+        self.bus.dispatch(data)
+        self.handler.assert_called_once_with(['1'], ['category:bogo'])
+
+    def test_ignore_own_messages(self):
+        """ A worker does not evict its own writes """
+        self.bus.publish(['1'], [])
+        self.bus.dispatch(self.redis.publish.call_args[0][1])
+        self.handler.assert_not_called()
+
+    def test_ignore_bad_messages(self):
+        """ Garbage on the channel is ignored """
+        self.bus.dispatch('not json')
+        self.handler.assert_not_called()
+
+    @patch('app.invalidation.time.sleep')
+    def test_flush_on_disconnect_and_reconnect(self, sleep):
+        """ Handlers are flushed when the bus drops and again when it is back """
+        pubsub = self.redis.pubsub.return_value
+        pubsub.subscribe.side_effect = [RedisError('down'), None]
+        states = []
+
+        def receive(timeout):
+            """ Stops the bus once it has resubscribed """
+            states.append(self.bus.connected)
+            self.bus._stopped.set()
+        pubsub.get_message.side_effect = receive
+        self.assertFalse(self.bus.connected)
+        self.bus._listen()
+        self.assertEqual(states, [True])
+        self.assertFalse(self.bus.connected)
+        self.assertEqual(self.handler.call_count, 2)
+        self.handler.assert_called_with([], [FLUSH_ALL])
+
+
+class TestResultCache(unittest.TestCase):
+    """ Test Cases for the list query result cache """
+
+    def setUp(self):
+        self.results = ResultCache(fresh=60, stale=120, stale_if_error=300)
+        self.loader = MagicMock(return_value='[]')
+
+    def test_fresh_hit(self):
+        """ A fresh result is served without calling the loader """
+        self.results.get({'category': 'BOGO'}, self.loader)
+        self.assertEqual(self.results.get({'category': 'BOGO'}, self.loader), '[]')
+        self.assertEqual(self.loader.call_count, 1)
+
+    def test_write_invalidates_matching_filter(self):
+        """ Bumping an index key reloads only the affected results """
+        self.results.get({'category': 'BOGO'}, self.loader)
+        self.results.get({'category': 'dollar'}, self.loader)
+        self.results.bump(['category:bogo'])
+        self.results.get({'category': 'BOGO'}, self.loader)
+        self.results.get({'category': 'dollar'}, self.loader)
+        self.assertEqual(self.loader.call_count, 3)
+
+    def test_write_invalidates_category_variants(self):
+        """ A write invalidates the filters that match its category with other spacing or case """
+        self.results.get({'category': ' Summer '}, self.loader)
+        self.results.bump(index_keys({'category': 'SUMMER'}))
+        self.results.get({'category': ' Summer '}, self.loader)
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_write_invalidates_unfiltered_list(self):
+        """ Every write invalidates the list of all promotions """
+        self.results.get({}, self.loader)
+        self.results.bump(['category:bogo'])
+        self.results.get({}, self.loader)
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_stale_if_error(self):
+        """ A failing backend serves the last result it had """
+        self.results.get({}, self.loader)
+        self.results.bump([])
+        self.loader.side_effect = ConnectionError()
+        self.assertEqual(self.results.get({}, self.loader), '[]')
+
+    def test_stale_if_error_fails_fast(self):
+        """ Retries are skipped while a stale result can be served instead """
+        self.results.get({}, self.loader)
+        self.results.bump([])
+        query = MagicMock(side_effect=HTTPError())
+        loader = retry(HTTPError, tries=3, delay=0)(lambda: query())
+        self.assertEqual(self.results.get({}, loader), '[]')
+        self.assertEqual(query.call_count, 1)
+        self.assertRaises(HTTPError, loader)
+        self.assertEqual(query.call_count, 4)
+
+    def test_error_without_entry(self):
+        """ A failing backend with nothing cached raises """
+        self.loader.side_effect = ConnectionError()
+        self.assertRaises(ConnectionError, self.results.get, {}, self.loader)
+
+
+class TestSingleFlight(unittest.TestCase):
+    """ Test Cases for single-flight request coalescing """
+
+    def setUp(self):
+        metrics.reset()
+        self.flight = SingleFlight('test')
+        self.release = threading.Event()
+        self.calls = []
+
+    def slow_call(self):
+        """ A backend call that blocks until released """
+        self.calls.append(1)
+        self.release.wait(5)
+        return ['doc']
+
+    def test_concurrent_calls_are_coalesced(self):
+        """ Concurrent requests for one key share one call """
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self.flight.do('key', self.slow_call))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        # wait for every other request to queue behind the first one
+        while metrics.get('singleflight.test.coalesced') < 9:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [['doc']] * 10)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.flight.coalesce_rate, 0.9)
+
+    def test_errors_are_raised(self):
+        """ A failed call raises to the caller and is not remembered """
+        failing = MagicMock(side_effect=ConnectionError())
+        self.assertRaises(ConnectionError, self.flight.do, 'key', failing)
+        self.assertEqual(self.flight.do('key', lambda: 'ok'), 'ok')
+
+
+class TestBloomFilter(unittest.TestCase):
+    """ Test Cases for the productid Bloom filter """
+
+    def setUp(self):
+        self.bloom = BloomFilter(capacity=1000, error_rate=0.01)
+
+    def test_not_ready(self):
+        """ Everything is present until the filter is loaded """
+        self.assertIn('A1234', self.bloom)
+
+    def test_rebuild(self):
+        """ Added values are found and others are not """
+        self.bloom.rebuild('P{}'.format(i) for i in range(1000))
+        for i in range(1000):
+            self.assertIn('P{}'.format(i), self.bloom)
+        misses = sum(1 for i in range(1000) if 'Q{}'.format(i) in self.bloom)
+        self.assertLess(misses, 50)
+
+    def test_case_insensitive(self):
+        """ Values are compared ignoring case """
+        self.bloom.rebuild(['a1234'])
+        self.assertIn('A1234', self.bloom)
+
+    def test_add_during_rebuild(self):
+        """ A value added while rebuilding is not lost """
+        def values():
+            """ Adds a value part way through the rebuild """
+            yield 'A1234'
+            self.bloom.add('B4321')
+        self.bloom.rebuild(values())
+        self.assertIn('B4321', self.bloom)
+
+    def test_reset(self):
+        """ Rebuilding with nothing empties the filter """
+        self.bloom.rebuild(['A1234'])
+        self.bloom.rebuild([])
+        self.assertNotIn('A1234', self.bloom)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Design Document Manager Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import unittest
+from requests.exceptions import Timeout
+from app.design import DesignManager, version_of, index_fields, ACTIVE, BUILDING, FAILED
+
+VIEWS = {'count': {'map': 'function(doc) { emit(doc.category, null); }', 'reduce': '_count'}}
+CHANGED_VIEWS = {'count': {'map': 'function(doc) { emit(doc.available, null); }',
+                           'reduce': '_count'}}
+
+class FakeManager(DesignManager):
+    """ A DesignManager that keeps its documents and indexes in memory """
+
+    def __init__(self, documents, indexes, **kwargs):
+        DesignManager.__init__(self, None, documents, indexes, **kwargs)
+        self.docs = {}
+        self.query_indexes = []
+        self.slow = {}          # doc id -> polls before its build finishes
+        self.built = []
+        self.cleaned = 0
+        self.rev = 0
+
+    def _get(self, doc_id):
+        return dict(self.docs[doc_id]) if doc_id in self.docs else None
+
+    def _save(self, doc_id, body):
+        self.rev += 1
+        self.docs[doc_id] = dict(body, _id=doc_id, _rev=str(self.rev))
+
+    def _delete(self, doc_id, rev):
+        self.docs.pop(doc_id, None)
+
+    def _query_indexes(self):
+        return list(self.query_indexes)
+
+    def _create_index(self, doc_id, name, fields):
+        self.query_indexes.append((doc_id, name))
+
+    def _delete_index(self, doc_id, name):
+        self.query_indexes.remove((doc_id, name))
+
+    def _trigger(self, kind, doc_id, definition, timeout):
+        if self.slow.get(doc_id):
+            self.slow[doc_id] -= 1
+            raise Timeout()
+        self.built.append(doc_id)
+
+    def _progress(self, doc_id):
+        return 50
+
+    def _cleanup(self):
+        self.cleaned += 1
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestDesignManager(unittest.TestCase):
+    """ Test Cases for versioned design document deployment """
+
+    def setUp(self):
+        self.manager = FakeManager({'stats': {'views': VIEWS},
+                                    'promotions': {'updates': {'patch': 'function(doc, req) {}'}}},
+                                   {'category': [{'category': 'asc'}]}, poll=0)
+
+    def test_version(self):
+        """ The version changes with the definition and not with key order """
+        self.assertEqual(version_of({'a': 1, 'b': 2}), version_of({'b': 2, 'a': 1}))
+        self.assertNotEqual(version_of(VIEWS), version_of(CHANGED_VIEWS))
+        self.assertEqual(index_fields([{'a': 'asc'}, 'b']), ['a', 'b'])
+
+    def test_first_deploy(self):
+        """ New design documents are saved in place and built """
+        status = self.manager.deploy()
+        self.assertEqual(self.manager.docs['_design/stats']['version'], version_of({'views': VIEWS}))
+        self.assertIn('patch', self.manager.docs['_design/promotions']['updates'])
+        self.assertEqual(set(state['state'] for state in status.values()), set([ACTIVE]))
+        self.assertTrue(self.manager.use_index('category').startswith('_design/index-category-'))
+        self.assertEqual(self.manager.index_for(['category']), self.manager.use_index('category'))
+        self.assertEqual(self.manager.cleaned, 1)
+
+    def test_unchanged_deploy(self):
+        """ Nothing is written when the live versions match """
+        self.manager.deploy()
+        rev = self.manager.rev
+        self.manager.deploy()
+        self.assertEqual(self.manager.rev, rev)
+
+    def test_staged_switch(self):
+        """ A changed view is built under a staging id before the live copy changes """
+        self.manager.deploy()
+        old_version = self.manager.docs['_design/stats']['version']
+        self.manager.documents['stats'] = {'views': CHANGED_VIEWS}
+        version = version_of({'views': CHANGED_VIEWS})
+        staging = '_design/stats-' + version
+        self.manager.slow[staging] = 2
+        pending = self.manager.publish()
+        self.assertIn(('view', 'stats', staging), [item[:3] for item in pending])
+        # the live copy still answers with the old views while the staging copy builds
+        self.assertEqual(self.manager.docs['_design/stats']['version'], old_version)
+        self.assertEqual(self.manager.status()['stats']['state'], BUILDING)
+        reports = []
+        self.manager.deploy(progress=reports.append)
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(reports[0]['stats']['progress'], 50)
+        self.assertEqual(self.manager.docs['_design/stats']['version'], version)
+        self.assertEqual(self.manager.docs['_design/stats']['views'], CHANGED_VIEWS)
+        self.assertNotIn(staging, self.manager.docs)
+        self.assertEqual(self.manager.status()['stats']['state'], ACTIVE)
+
+    def test_index_switch(self):
+        """ Queries stay on the old index until the new one is built """
+        self.manager.query_indexes.append(('_design/legacy', 'category'))
+        self.manager.indexes['category'] = [{'category': 'asc'}]
+        new = '_design/index-category-' + version_of([{'category': 'asc'}])
+        self.manager.slow[new] = 1
+        self.manager.publish()
+        self.assertEqual(self.manager.use_index('category'), '_design/legacy')
+        self.manager.deploy()
+        self.assertEqual(self.manager.use_index('category'), new)
+        self.assertEqual(self.manager.query_indexes, [(new, 'category')])
+
+    def test_new_index_not_hinted_while_building(self):
+        """ An index with no older version is only used once it is built """
+        self.manager.publish()
+        self.assertIsNone(self.manager.use_index('category'))
+        self.manager.timeout = -1
+        self.manager.slow['_design/index-category-' + version_of([{'category': 'asc'}])] = 5
+        self.manager.deploy()
+        self.assertIsNone(self.manager.index_for(['category']))
+        self.assertEqual(self.manager.status()['category']['state'], FAILED)
+
+    def test_unhinted_queries_avoid_building_index(self):
+        """ Queries a building index could answer are kept on built indexes """
+        self.manager.indexes['productid'] = [{'productid': 'asc'}]
+        self.manager.deploy()
+        productid = self.manager.use_index('productid')
+        self.manager.indexes['window'] = [{'productid': 'asc'}, {'start': 'asc'}]
+        self.manager.publish()
+        # the exact index is pinned as before
+        self.assertEqual(self.manager.query_hint(['productid']), {'use_index': productid})
+        # a query the new index could answer is pinned to a built one that can
+        self.assertEqual(self.manager.query_hint(['productid', 'start']),
+                         {'use_index': productid})
+        # with no built index to use it is sent to the primary index
+        self.manager.indexes['type_value'] = [{'type': 'asc'}, {'value': 'asc'}]
+        self.manager.publish()
+        self.assertEqual(self.manager.query_hint(['type', 'value', 'available']),
+                         {'sort': [{'_id': 'asc'}]})
+        # queries no building index could answer are left to the database
+        self.assertEqual(self.manager.query_hint(['available']), {})
+        self.manager.deploy()
+        window = self.manager.use_index('window')
+        self.assertEqual(self.manager.query_hint(['productid', 'start']), {'use_index': window})
+        self.assertEqual(self.manager.query_hint(['type', 'value', 'available']), {})
+
+    def test_existing_indexes_are_checked_first(self):
+        """ Indexes left by an earlier deploy come before new builds """
+        self.manager.deploy()
+        self.manager.documents['stats'] = {'views': CHANGED_VIEWS}
+        self.manager.indexes['productid'] = [{'productid': 'asc'}]
+        pending = [item[:2] for item in self.manager.publish()]
+        self.assertEqual(pending, [('index', 'category'), ('view', 'stats'),
+                                   ('index', 'productid')])
+        # publishing again leaves a built index hinted
+        category = self.manager.use_index('category')
+        self.manager.deploy()
+        self.manager.publish()
+        self.assertEqual(self.manager.query_hint(['category']), {'use_index': category})
+        self.assertEqual(self.manager.query_hint(['productid', 'category']), {})
+
+    def test_build_timeout(self):
+        """ A build that doesn't finish in time leaves the live copy alone """
+        self.manager.deploy()
+        self.manager.timeout = -1
+        self.manager.documents['stats'] = {'views': CHANGED_VIEWS}
+        staging = '_design/stats-' + version_of({'views': CHANGED_VIEWS})
+        self.manager.slow[staging] = 5
+        status = self.manager.deploy()
+        self.assertEqual(status['stats']['state'], FAILED)
+        self.assertEqual(self.manager.docs['_design/stats']['views'], VIEWS)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Discount Parsing Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import unittest
+from app.discounts import discount_fields, discount_query
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestDiscounts(unittest.TestCase):
+    """ Discount parsing tests """
+
+    def test_discount_fields(self):
+        """ Store a discount as a number and a type """
+        self.assertEqual(discount_fields('Percentage', '50'),
+                         {'discount_value': 50.0, 'discount_type': 'percent'})
+        self.assertEqual(discount_fields('sale', '$2.50'),
+                         {'discount_value': 2.5, 'discount_type': 'amount'})
+        self.assertEqual(discount_fields('BOGO', None),
+                         {'discount_value': 100.0, 'discount_type': 'bogo'})
+        self.assertEqual(discount_fields('dollar', 'lots'),
+                         {'discount_value': None, 'discount_type': None})
+
+    def test_discount_query(self):
+        """ Match a discount filter on its number and stated type """
+        self.assertEqual(discount_query('10'), (10.0, None))
+        self.assertEqual(discount_query('10.0'), (10.0, None))
+        self.assertEqual(discount_query('10%'), (10.0, 'percent'))
+        self.assertEqual(discount_query('$10'), (10.0, 'amount'))
+        self.assertEqual(discount_query('BOGO'), (None, None))
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Export Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import json
+import zlib
+import unittest
+from StringIO import StringIO
+from app.export import export_chunks
+from app.bulk_import import read_records
+
+DOCUMENTS = [
+    {'_id': '1', '_rev': '1-a', 'productid': 'A1234', 'category': 'BOGO',
+     'available': True, 'discount': '20'},
+    {'_id': '2', '_rev': '1-b', 'productid': 'B4321', 'category': 'dollar',
+     'available': False, 'discount': '5'},
+    {'_id': '3', '_rev': '2-c', '_deleted': True}
+]
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestExport(unittest.TestCase):
+    """ Test Cases for streaming exports """
+
+    def test_export_ndjson(self):
+        """ Export one JSON line per document """
+        lines = ''.join(export_chunks(iter(DOCUMENTS))).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0])['productid'], 'A1234')
+        self.assertNotIn('_rev', json.loads(lines[0]))
+        self.assertEqual(json.loads(lines[2]), {'_id': '3', '_deleted': True})
+
+    def test_export_csv(self):
+        """ Export CSV that can be imported again """
+        data = ''.join(export_chunks(iter(DOCUMENTS[:2]), 'csv'))
+        records = list(read_records(StringIO(data), 'csv'))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['_id'], '1')
+        self.assertEqual(records[1]['available'], False)
+
+    def test_export_filtered(self):
+        """ Export only the documents that match the filters """
+        lines = ''.join(export_chunks(iter(DOCUMENTS[:2]), filters={'category': 'BOGO'}))
+        self.assertEqual(len(lines.splitlines()), 1)
+
+    def test_export_filtered_like_finders(self):
+        """ Match the category ignoring case and the discount on its number """
+        documents = DOCUMENTS[:2] + [
+            {'_id': '4', 'productid': 'C1111', 'category': 'Percentage', 'discount': '20%'},
+            {'_id': '5', 'productid': 'D2222', 'category': 'bogo', 'discount': '20.0',
+             'category_key': 'bogo', 'discount_value': 20.0, 'discount_type': None}]
+        for filters, ids in (({'category': ' bogo'}, ['1', '5']),
+                             ({'discount': '20'}, ['1', '4', '5']),
+                             ({'discount': '20%'}, ['4']),
+                             ({'category': 'BOGO', 'productid': 'D2222'}, ['5']),
+                             ({'category': 'BOGO', 'discount': '5'}, [])):
+            lines = ''.join(export_chunks(iter(documents), filters=filters)).splitlines()
+            self.assertEqual([json.loads(line)['_id'] for line in lines], ids)
+
+    def test_export_gzip(self):
+        """ Export gzip compressed data """
+        data = ''.join(export_chunks(iter(DOCUMENTS), gzip=True))
+        lines = zlib.decompress(data, 16 + zlib.MAX_WBITS).splitlines()
+        self.assertEqual(len(lines), 3)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Interval Index Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import unittest
+from app.intervals import IntervalIndex, parse_time, to_epoch, is_active
+
+JAN = '2019-01-01T00:00:00Z'
+FEB = '2019-02-01T00:00:00Z'
+MAR = '2019-03-01T00:00:00Z'
+FUTURE = '2999-01-01T00:00:00Z'
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestIntervals(unittest.TestCase):
+    """ Time window tests """
+
+    def test_parse_time(self):
+        """ Normalize times to UTC ISO 8601 """
+        self.assertEqual(parse_time('2019-01-01'), JAN)
+        self.assertEqual(parse_time('2019-01-01T00:00'), JAN)
+        self.assertEqual(parse_time('2019-01-01T00:00:00.250Z'), JAN)
+        self.assertEqual(parse_time(to_epoch(JAN)), JAN)
+        self.assertIsNone(parse_time(''))
+        self.assertRaises(ValueError, parse_time, 'next tuesday')
+
+    def test_is_active(self):
+        """ Check open and closed windows """
+        self.assertTrue(is_active(JAN, FEB, JAN))
+        self.assertFalse(is_active(JAN, FEB, FEB))
+        self.assertTrue(is_active(None, FEB, JAN))
+        self.assertTrue(is_active(JAN, None, FUTURE))
+
+    def test_active_by_productid(self):
+        """ Find the windows active at a time """
+        index = IntervalIndex()
+        index.add('1', 'A1', JAN, FEB)
+        index.add('2', 'A1', FEB, None)
+        index.add('3', 'B2', None, None)
+        self.assertEqual(index.active(JAN, 'A1'), ['1'])
+        self.assertEqual(index.active(MAR, 'A1'), ['2'])
+        self.assertEqual(sorted(index.active(MAR)), ['2', '3'])
+        self.assertEqual(index.active(MAR, 'C3'), [])
+
+    def test_replace_and_discard(self):
+        """ Move and remove windows """
+        index = IntervalIndex()
+        index.add('1', 'A1', JAN, FEB)
+        index.add('1', 'A1', MAR, None)
+        self.assertEqual(index.active(JAN, 'A1'), [])
+        self.assertEqual(index.active(FUTURE, 'A1'), ['1'])
+        index.discard('1')
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.active(FUTURE), [])
+
+    def test_ended_windows_drop_out(self):
+        """ Prune windows that have ended """
+        index = IntervalIndex()
+        index.add('1', 'A1', JAN, FEB)
+        index.add('2', 'A1', JAN, FUTURE)
+        self.assertEqual(index.active(MAR, 'A1'), ['2'])
+        self.assertEqual(len(index), 1)
+
+    def test_active_for_every_productid(self):
+        """ Find the windows of every product without visiting each product """
+        index = IntervalIndex()
+        index.add('1', 'A1', JAN, FEB)
+        index.add('2', 'B2', JAN, FUTURE)
+        index.add('3', 'C3', MAR, None)
+        self.assertEqual(index.active(MAR), ['2', '3'])
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.active(JAN, 'A1'), [])
+        index.discard('2')
+        self.assertEqual(index.active(FUTURE), ['3'])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Background Job Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import time
+import unittest
+import threading
+from mock import MagicMock, patch
+from requests import HTTPError
+from app.jobs import JobRunner, JobStore, JobQueueFull, FINISHED, FAILED, RUNNING, \
+    STOPPED_ERROR
+
+
+class MemoryStore(object):
+    """ A JobStore that keeps the records in a dictionary """
+
+    def __init__(self):
+        self.records = {}
+
+    def save(self, record):
+        self.records[record['id']] = record
+
+    def get(self, job_id):
+        return self.records.get(job_id)
+
+
+class FakeDocument(dict):
+    """ A cloudant Document that is fetched from and saved to a dictionary """
+    records = {}
+
+    def __init__(self, database, doc_id):
+        dict.__init__(self, FakeDocument.records.get(doc_id, {}))
+        self.doc_id = doc_id
+
+    def fetch(self):
+        pass
+
+    def save(self):
+        FakeDocument.records[self.doc_id] = dict(self)
+
+
+def wait_for(job, timeout=5):
+    """ Waits for a job to finish or fail """
+    deadline = time.time() + timeout
+    while job.state not in (FINISHED, FAILED) and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestJobs(unittest.TestCase):
+    """ Background job tests """
+
+    def setUp(self):
+        self.store = MemoryStore()
+        self.runner = JobRunner(workers=1, queue_size=2, history=2, store=self.store)
+
+    def test_job_finishes(self):
+        """ Run a job to completion """
+        def work(job):
+            job.step(processed=10)
+            return {'updated': 3}
+        job = wait_for(self.runner.submit('test', work, {'category': 'BOGO'}))
+        self.assertEqual(job.state, FINISHED)
+        data = self.runner.get(job.id)
+        self.assertEqual(data['result'], {'updated': 3})
+        self.assertEqual(data['progress'], {'processed': 10})
+        self.assertEqual(data['params'], {'category': 'BOGO'})
+        self.assertTrue(data['throughput'] > 0)
+        self.assertEqual(self.store.records[job.id]['state'], FINISHED)
+
+    def test_job_fails(self):
+        """ Record the error of a failed job """
+        def work(job):
+            raise ValueError('boom')
+        job = wait_for(self.runner.submit('test', work))
+        self.assertEqual(job.state, FAILED)
+        self.assertEqual(job.error, 'boom')
+
+    def test_history_is_bounded(self):
+        """ Forget the oldest jobs but keep their records in the store """
+        submitted = [wait_for(self.runner.submit('test', lambda job: None)) for _ in range(3)]
+        with self.runner._lock:
+            self.assertNotIn(submitted[0].id, self.runner._jobs)
+        self.assertEqual(self.runner.get(submitted[0].id)['state'], FINISHED)
+        self.store.records.clear()
+        self.assertIsNone(self.runner.get(submitted[0].id))
+        self.assertIsNotNone(self.runner.get(submitted[2].id))
+
+    def test_queue_is_bounded(self):
+        """ Refuse jobs when too many are waiting """
+        started = threading.Event()
+        release = threading.Event()
+
+        def block(job):
+            started.set()
+            release.wait(5)
+        self.runner.submit('test', block)
+        started.wait(5)
+        waiting = [self.runner.submit('test', lambda job: None) for _ in range(2)]
+        self.assertRaises(JobQueueFull, self.runner.submit, 'test', lambda job: None)
+        release.set()
+        for job in waiting:
+            self.assertEqual(wait_for(job).state, FINISHED)
+
+    def test_heartbeat(self):
+        """ Save a running job that hasn't reported progress for a while """
+        started = threading.Event()
+        release = threading.Event()
+
+        def block(job):
+            started.set()
+            release.wait(5)
+        job = self.runner.submit('test', block)
+        started.wait(5)
+        saved = self.store.records[job.id]['heartbeat']
+        time.sleep(0.02)
+        self.runner.heartbeat(interval=0.01)
+        self.assertTrue(self.store.records[job.id]['heartbeat'] > saved)
+        release.set()
+        wait_for(job)
+        heartbeat = self.store.records[job.id]['heartbeat']
+        self.runner.heartbeat(interval=0)
+        self.assertEqual(self.store.records[job.id]['heartbeat'], heartbeat)
+
+
+class TestJobStore(unittest.TestCase):
+    """ Job record store tests """
+
+    @patch('app.jobs.Document')
+    def test_missing_job(self, document_mock):
+        """ Only a 404 means the job does not exist """
+        store = JobStore(MagicMock())
+        document_mock.return_value.fetch.side_effect = HTTPError(response=MagicMock(status_code=404))
+        self.assertIsNone(store.get('0'))
+        document_mock.return_value.fetch.side_effect = HTTPError(response=MagicMock(status_code=500))
+        self.assertRaises(HTTPError, store.get, '0')
+
+    @patch('app.jobs.Document')
+    def test_revisions_are_dropped(self, document_mock):
+        """ Forget the revision of a job once it has ended """
+        store = JobStore(MagicMock())
+        document_mock.return_value.__getitem__.return_value = '1-a'
+        store.save({'id': '1', 'state': RUNNING})
+        self.assertIn('1', store._revs)
+        store.save({'id': '1', 'state': FINISHED})
+        self.assertNotIn('1', store._revs)
+
+    @patch('app.jobs.Document', FakeDocument)
+    def test_stale_jobs_fail(self):
+        """ Report and mark the jobs of a stopped process as failed """
+        stale = {'_id': '1', '_rev': '2-b', 'name': 'test', 'state': RUNNING,
+                 'heartbeat': time.time() - 3600}
+        fresh = dict(stale, _id='2', heartbeat=time.time())
+        FakeDocument.records = {'1': stale, '2': fresh}
+        store = JobStore(MagicMock())
+        self.assertEqual(store.get('1')['error'], STOPPED_ERROR)
+        self.assertEqual(store.get('2')['state'], RUNNING)
+        store.database.get_query_result.return_value = {'docs': [stale, fresh]}
+        self.assertEqual(store.fail_stale(), 1)
+        self.assertEqual(FakeDocument.records['1']['state'], FAILED)
+        self.assertEqual(FakeDocument.records['2']['state'], RUNNING)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
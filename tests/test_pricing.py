@@ -0,0 +1,104 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pricing Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import unittest
+from app.models import Promotion, DataValidationError
+from app.pricing import parse_discount, parse_lines, evaluate, PERCENT, AMOUNT, BOGO
+
+
+def make_promotion(promotion_id, productid, category, discount, available=True):
+    """ Returns a Promotion that hasn't been saved """
+    promotion = Promotion(productid, category, available, discount)
+    promotion.id = promotion_id
+    return promotion
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestPricing(unittest.TestCase):
+    """ Cart price evaluation tests """
+
+    def test_parse_discount(self):
+        """ Parse the free form discounts """
+        self.assertEqual(parse_discount('Percentage', '50'), (PERCENT, 50.0))
+        self.assertEqual(parse_discount('sale', '15%'), (PERCENT, 15.0))
+        self.assertEqual(parse_discount('dollar', '5'), (AMOUNT, 5.0))
+        self.assertEqual(parse_discount('sale', '$2.50'), (AMOUNT, 2.5))
+        self.assertEqual(parse_discount('BOGO', None), (BOGO, 100.0))
+        self.assertEqual(parse_discount('BOGO', '20'), (BOGO, 20.0))
+        self.assertIsNone(parse_discount('dollar', 'lots'))
+
+    def test_parse_lines(self):
+        """ Validate cart lines """
+        lines = parse_lines([{'productid': 'A1', 'price': '2.5'}])
+        self.assertEqual(lines[0]['qty'], 1)
+        self.assertEqual(lines[0]['price'], 2.5)
+        self.assertRaises(DataValidationError, parse_lines, [])
+        self.assertRaises(DataValidationError, parse_lines, [{'productid': 'A1'}])
+        self.assertRaises(DataValidationError, parse_lines,
+                          [{'productid': 'A1', 'price': 1, 'qty': 0}])
+
+    def test_parse_bad_lines(self):
+        """ Refuse lines that are not objects, not finite or have unknown fields """
+        for line in ['A1', {'productid': 'A1', 'price': float('nan')},
+                     {'productid': 'A1', 'price': 'inf'}, {'productid': 'A1', 'price': 1e400},
+                     {'productid': 'A1', 'price': 1, 'qty': float('inf')},
+                     {'productid': ['A1'], 'price': 1},
+                     {'productid': 'A1', 'price': 1, 'color': 'red'}]:
+            self.assertRaises(DataValidationError, parse_lines, [line])
+
+    def test_parse_lines_with_category(self):
+        """ Accept the category of a line """
+        lines = parse_lines([{'productid': 'A1', 'category': 'BOGO', 'price': 2, 'qty': 3}])
+        self.assertEqual(lines, [{'productid': 'A1', 'price': 2.0, 'qty': 3}])
+
+    def test_evaluate_best_discount(self):
+        """ Pick the best discount for each line """
+        lines = parse_lines([
+            {'productid': 'A1', 'price': 10, 'qty': 2},
+            {'productid': 'B2', 'price': 4, 'qty': 3},
+            {'productid': 'C3', 'price': 1, 'qty': 1}
+        ])
+        promotions = {
+            'A1': [make_promotion('p1', 'A1', 'Percentage', '10'),
+                   make_promotion('p2', 'A1', 'BOGO', None)],
+            'B2': [make_promotion('p3', 'B2', 'dollar', '5')]
+        }
+        result = evaluate(lines, promotions)
+        self.assertEqual(result['lines'][0], ['A1', 'p2', 20.0, 10.0, 10.0])
+        self.assertEqual(result['lines'][1], ['B2', 'p3', 12.0, 12.0, 0.0])
+        self.assertEqual(result['lines'][2], ['C3', None, 1.0, 0.0, 1.0])
+        self.assertEqual(result['subtotal'], 33.0)
+        self.assertEqual(result['savings'], 22.0)
+        self.assertEqual(result['total'], 11.0)
+
+    def test_evaluate_ignores_unparsed(self):
+        """ Skip discounts that can't be parsed """
+        lines = parse_lines([{'productid': 'A1', 'price': 10}])
+        result = evaluate(lines, {'A1': [make_promotion('p1', 'A1', 'dollar', 'soon')]})
+        self.assertEqual(result['lines'][0], ['A1', None, 10.0, 0.0, 10.0])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Query Profiler Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import unittest
+from app.metrics import metrics
+from app.profiler import QueryProfiler, selector_shape, suggest_index, plan_index, FULL_SCAN
+
+FULL_SCAN_PLAN = {'index': {'ddoc': None, 'name': '_all_docs', 'type': 'special'}}
+INDEX_PLAN = {'index': {'ddoc': '_design/index-category_key-1', 'name': 'category_key',
+                        'type': 'json'}}
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestQueryProfiler(unittest.TestCase):
+    """ Test Cases for the slow query log and index advisor """
+
+    def setUp(self):
+        metrics.reset()
+        self.profiler = QueryProfiler(threshold=100)
+        self.explained = 0
+
+    def explain(self, plan):
+        """ Returns an explain function that counts its calls """
+        def explain():
+            self.explained += 1
+            return plan
+        return explain
+
+    def test_selector_shape(self):
+        """ Selectors are split into equality, range and sort fields """
+        shape = selector_shape({'category_key': 'bogo', 'available': {'$eq': True},
+                                'discount_value': {'$gte': 10}})
+        self.assertEqual(shape, (['available', 'category_key'], ['discount_value'], []))
+        shape = selector_shape({'discount_type': 'percent', 'discount_value': {'$type': 'number'}},
+                               [{'discount_type': 'desc'}, {'discount_value': 'desc'}])
+        self.assertEqual(shape, (['discount_type'], [], ['discount_type', 'discount_value']))
+        shape = selector_shape({'$or': [{'category_key': {'$exists': False}}, {'productid': 'A1'}]})
+        self.assertEqual(shape, ([], ['category_key', 'productid'], []))
+
+    def test_suggest_index(self):
+        """ Equality fields come first, then sort fields, then ranges """
+        shape = (['category_key'], ['expires'], ['discount_value'])
+        self.assertEqual(suggest_index(shape), ['category_key', 'discount_value', 'expires'])
+
+    def test_plan_index(self):
+        """ The index of a plan is named, a full scan is _all_docs """
+        self.assertEqual(plan_index(INDEX_PLAN), 'category_key')
+        self.assertEqual(plan_index(FULL_SCAN_PLAN), FULL_SCAN)
+        self.assertEqual(plan_index(None), FULL_SCAN)
+
+    def test_fast_query(self):
+        """ Fast queries are counted but not explained or logged """
+        self.profiler.record({'productid': 'A1'}, None, 5, {}, self.explain(INDEX_PLAN))
+        self.assertEqual(self.explained, 0)
+        self.assertEqual(self.profiler.slow_queries(), [])
+        self.assertEqual(metrics.get('query.count'), 1)
+
+    def test_slow_query(self):
+        """ Slow queries are explained, logged and advised on """
+        stats = {'total_docs_examined': 5000, 'results_returned': 3}
+        for _ in range(3):
+            self.profiler.record({'available': True}, None, 250, stats,
+                                 self.explain(FULL_SCAN_PLAN))
+        self.profiler.record({'category_key': 'bogo'}, None, 400,
+                             {'total_docs_examined': 900, 'results_returned': 900},
+                             self.explain(INDEX_PLAN))
+        self.assertEqual(self.explained, 4)
+        self.assertEqual(metrics.get('query.slow'), 4)
+        slow = self.profiler.slow_queries()
+        self.assertEqual(slow[0]['index'], 'category_key')
+        self.assertEqual(slow[1]['docs_examined'], 5000)
+        advice = self.profiler.advise()
+        self.assertEqual(len(advice), 1)    # category_key already has an index
+        self.assertEqual(advice[0]['fields'], ['available'])
+        self.assertEqual(advice[0]['queries'], 3)
+        self.assertEqual(advice[0]['index'], {'fields': [{'available': 'asc'}]})
+        self.profiler.reset()
+        self.assertEqual(self.profiler.advise(), [])
+
+    def test_capture(self):
+        """ Captured queries keep their plan even when they are fast """
+        with self.profiler.capture() as queries:
+            self.assertTrue(self.profiler.capturing)
+            self.profiler.record({'productid': 'A1'}, None, 5, {'results_returned': 1},
+                                 self.explain(INDEX_PLAN))
+        self.assertFalse(self.profiler.capturing)
+        self.assertEqual(queries[0]['plan'], INDEX_PLAN)
+        self.assertEqual(queries[0]['results_returned'], 1)
+        self.assertEqual(self.profiler.slow_queries(), [])
+
+    def test_explain_failure(self):
+        """ A failing explain still logs the slow query """
+        def explain():
+            raise ValueError('no plan')
+        self.profiler.record({'productid': 'A1'}, None, 500, {}, explain)
+        self.assertEqual(self.profiler.slow_queries()[0]['index'], FULL_SCAN)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -19,14 +19,20 @@ Test cases can be run with the following:
 nosetests -v --with-spec --spec-color
 """
 
+import shutil
+import tempfile
 import unittest
-#import os
+import threading
+import os
 #import json
 from mock import MagicMock, patch
 from requests import HTTPError, ConnectionError
 #from redis import Redis, ConnectionError
 #from werkzeug.exceptions import NotFound
-from app.models import Promotion, DataValidationError
+from app.models import Promotion, DataValidationError, ConflictError, selector_for
+from app.metrics import metrics
+from app.replica import SQLiteReplica
+from app.bitmaps import parse_filter
 #from app.custom_exceptions import DataValidationError
 #from app import server  # to get Redis
 
@@ -51,17 +57,19 @@ VCAP_SERVICES = {
 ######################################################################
 #  T E S T   C A S E S
 ######################################################################
-class TestPromotions(unittest.TestCase):
-    """ Test Cases for Promotion Model """
+class PromotionModelTests(object):
+    """
+    Test Cases that every Promotion model must pass
 
-    def setUp(self):
-        """ Initialize the Cloudant database """
-        Promotion.init_db("test_promotion")
-        Promotion.remove_all()
+    A TestCase mixes these in and sets model to the Promotion class of
+    its storage backend.
+    """
+
+    model = None
 
     def test_create_a_promotion(self):
         """ Create a promotion and assert that it exists """
-        promotion = Promotion("A1234", "BOGO", False, "20")
+        promotion = self.model("A1234", "BOGO", False, "20")
         self.assertNotEqual(promotion, None)
         self.assertEqual(promotion.id, None)
         self.assertEqual(promotion.productid, "A1234")
@@ -71,15 +79,15 @@ class TestPromotions(unittest.TestCase):
 
     def test_add_a_promotion(self):
         """ Create a promotion and add it to the database """
-        promotions = Promotion.all()
+        promotions = self.model.all()
         self.assertEqual(promotions, [])
-        promotion = Promotion("A1234", "BOGO", True, "20")
+        promotion = self.model("A1234", "BOGO", True, "20")
         self.assertNotEqual(promotion, None)
         self.assertEqual(promotion.id, None)
         promotion.save()
         # Asert that it was assigned an id and shows up in the database
         self.assertNotEqual(promotion.id, None)
-        promotions = Promotion.all()
+        promotions = self.model.all()
         self.assertEqual(len(promotions), 1)
         self.assertEqual(promotions[0].productid, "A1234")
         self.assertEqual(promotions[0].category, "BOGO")
@@ -88,7 +96,7 @@ class TestPromotions(unittest.TestCase):
 
     def test_update_a_promotion(self):
         """ Update a Promotion """
-        promotion = Promotion("A1234", "BOGO", True, "20")
+        promotion = self.model("A1234", "BOGO", True, "20")
         promotion.save()
         self.assertNotEqual(promotion.id, None)
         # Change it an save it
@@ -96,23 +104,23 @@ class TestPromotions(unittest.TestCase):
         promotion.save()
         # Fetch it back and make sure the id hasn't changed
         # but the data did change
-        promotions = Promotion.all()
+        promotions = self.model.all()
         self.assertEqual(len(promotions), 1)
         self.assertEqual(promotions[0].category, "Percentage")
         self.assertEqual(promotions[0].productid, "A1234")
 
     def test_delete_a_promotion(self):
         """ Delete a Promotion """
-        promotion = Promotion("A1234", "BOGO", False, "20")
+        promotion = self.model("A1234", "BOGO", False, "20")
         promotion.save()
-        self.assertEqual(len(Promotion.all()), 1)
+        self.assertEqual(len(self.model.all()), 1)
         # delete the promotion and make sure it isn't in the database
         promotion.delete()
-        self.assertEqual(len(Promotion.all()), 0)
+        self.assertEqual(len(self.model.all()), 0)
 
     def test_serialize_a_promotion(self):
         """ Serialize a Promotion """
-        promotion = Promotion("A1234", "BOGO", True, "20")
+        promotion = self.model("A1234", "BOGO", True, "20")
         data = promotion.serialize()
         self.assertNotEqual(data, None)
         self.assertNotIn('_id', data)
@@ -128,7 +136,7 @@ class TestPromotions(unittest.TestCase):
     def test_deserialize_a_promotion(self):
         """ Deserialize a Promotion """
         data = {"productid": "B4321", "category": "dollar", "available": True, "discount": "5"}
-        promotion = Promotion()
+        promotion = self.model()
         promotion.deserialize(data)
         self.assertNotEqual(promotion, None)
         self.assertEqual(promotion.id, None)
@@ -140,84 +148,385 @@ class TestPromotions(unittest.TestCase):
     def test_deserialize_with_no_productid(self):
         """ Deserialize a Promotion that has no productid """
         data = {"id":0, "category": "dollar"}
-        promotion = Promotion()
+        promotion = self.model()
         self.assertRaises(DataValidationError, promotion.deserialize, data)
 
     def test_deserialize_with_no_data(self):
         """ Deserialize a Promotion that has no data """
-        promotion = Promotion()
+        promotion = self.model()
         self.assertRaises(DataValidationError, promotion.deserialize, None)
 
     def test_deserialize_with_bad_data(self):
         """ Deserialize a Promotion that has bad data """
-        promotion = Promotion()
+        promotion = self.model()
         self.assertRaises(DataValidationError, promotion.deserialize, "string data")
 
     def test_save_a_promotion_with_no_productid(self):
         """ Save a Promotion with no productid """
-        promotion = Promotion(None, "dollar",True,"5")
+        promotion = self.model(None, "dollar",True,"5")
         self.assertRaises(DataValidationError, promotion.save)
 
     def test_create_a_promotion_with_no_productid(self):
         """ Save a Promotion with no productid """
-        promotion = Promotion(None, "dollar",True,"5")
+        promotion = self.model(None, "dollar",True,"5")
         self.assertRaises(DataValidationError, promotion.create)
 
     def test_find_promotion(self):
         """ Find a Promotion by id """
-        Promotion("A1234", "BOGO", True, "20").save()
-        saved_promotion = Promotion("B4321", "dollar", False, "5")
+        self.model("A1234", "BOGO", True, "20").save()
+        saved_promotion = self.model("B4321", "dollar", False, "5")
         saved_promotion.save()
-        promotion = Promotion.find(saved_promotion.id)
+        promotion = self.model.find(saved_promotion.id)
         self.assertIsNot(promotion, None)
         self.assertEqual(promotion.id, saved_promotion.id)
         self.assertEqual(promotion.productid, "B4321")
 
     def test_find_with_no_promotions(self):
         """ Find a Promotion with empty database """
-        promotion = Promotion.find("1")
+        promotion = self.model.find("1")
         self.assertIs(promotion, None)
 
     def test_promotion_not_found(self):
         """ Find a Promotion that doesnt exist """
-        Promotion("A1234", "BOGO", True, "20").save()
-        promotion = Promotion.find("2")
+        self.model("A1234", "BOGO", True, "20").save()
+        promotion = self.model.find("2")
         self.assertIs(promotion, None)
 
+    def test_find_deleted_promotion(self):
+        """ Find a Promotion that was cached and then deleted """
+        promotion = self.model("A1234", "BOGO", True, "20")
+        promotion.save()
+        self.assertIsNotNone(self.model.find(promotion.id))
+        promotion.delete()
+        self.assertIsNone(self.model.find(promotion.id))
+
+    def test_find_many(self):
+        """ Find many Promotions by their ids """
+        promotion = self.model("A1234", "BOGO", True, "20")
+        promotion.save()
+        self.model("B4321", "dollar", False, "5").save()
+        promotions = self.model.find_many([promotion.id, "2"])
+        self.assertEqual(len(promotions), 2)
+        self.assertEqual(promotions[promotion.id].productid, "A1234")
+        self.assertIsNone(promotions["2"])
+
+    def test_find_by_productids(self):
+        """ Find the Promotions for many productids """
+        self.model("A1234", "BOGO", True, "20").save()
+        self.model("A1234", "dollar", True, "5").save()
+        self.model("B4321", "dollar", False, "5").save()
+        promotions = self.model.find_by_productids(["A1234", "C9999"])
+        self.assertEqual(len(promotions["A1234"]), 2)
+        self.assertEqual(promotions["C9999"], [])
+        self.assertNotIn("B4321", promotions)
+
+    def test_update_where(self):
+        """ Update every Promotion that matches a selector """
+        self.model("A1234", "BOGO", True, "20").save()
+        self.model("A5678", "BOGO", True, "10").save()
+        self.model("B4321", "dollar", True, "5").save()
+        summary = self.model.update_where({'category': 'BOGO'}, {'available': False}, batch_size=1)
+        self.assertEqual(summary, {'matched': 2, 'updated': 2, 'failed': 0})
+        self.assertEqual(len(self.model.find_by_availability(False)), 2)
+        self.assertEqual(self.model.find_by_productid("B4321")[0].available, True)
+
+    def test_update_where_bad_field(self):
+        """ Update a field that can't be changed in bulk """
+        self.assertRaises(DataValidationError, self.model.update_where, {}, {'_id': '1'})
+
+    def test_patch_a_promotion(self):
+        """ Change one field of a Promotion in the database """
+        promotion = self.model("A1234", "BOGO", True, "20")
+        promotion.save()
+        patched = self.model.patch(promotion.id, {'available': False})
+        self.assertEqual(patched.available, False)
+        self.assertEqual(patched.category, "BOGO")
+        self.assertEqual(self.model.find(promotion.id).available, False)
+        self.assertEqual(len(self.model.find_by_availability(False)), 1)
+
+    def test_patch_missing_promotion(self):
+        """ Patch a Promotion that doesn't exist """
+        self.assertIsNone(self.model.patch("2", {'available': False}))
+        self.assertRaises(DataValidationError, self.model.patch, "2", {'_rev': '1-a'})
+
+    def test_concurrent_updates(self):
+        """ Update one Promotion from many threads without losing a write """
+        promotion = self.model("A1234", "BOGO", True, "0")
+        promotion.save()
+        metrics.reset()
+        errors = []
+
+        def hammer(number):
+            """ Saves the same Promotion a few times """
+            for attempt in range(5):
+                writer = self.model("A1234", "BOGO", True, "{}-{}".format(number, attempt))
+                writer.id = promotion.id
+                try:
+                    writer.save()
+                except ConflictError as error:
+                    errors.append(error)
+
+        threads = [threading.Thread(target=hammer, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        saved = self.model.fetch_document(promotion.id)
+        exhausted = metrics.get('writes.update.exhausted')
+        self.assertEqual(len(errors), exhausted)
+        self.assertEqual(int(saved['_rev'].split('-')[0]), 1 + 50 - exhausted)
+        self.assertEqual(metrics.get('writes.update'), 50)
+
+    def test_window_is_normalized(self):
+        """ Save a Promotion with a start and end """
+        promotion = self.model("A1234", "BOGO", True, "20", start="2019-01-01", end="2019-02-01")
+        promotion.save()
+        found = self.model.find(promotion.id)
+        self.assertEqual(found.start, "2019-01-01T00:00:00Z")
+        self.assertEqual(found.end, "2019-02-01T00:00:00Z")
+        bad = self.model("A1234", "BOGO", True, "20", start="2019-02-01", end="2019-01-01")
+        self.assertRaises(DataValidationError, bad.save)
+
+    def test_find_active(self):
+        """ Find the Promotions active at a time """
+        self.model("A1234", "BOGO", True, "20", start="2019-01-01", end="2019-02-01").save()
+        self.model("A1234", "dollar", True, "5", start="2019-02-01").save()
+        self.model("B4321", "dollar", True, "5").save()
+        self.model("B4321", "dollar", False, "5").save()
+        active = self.model.find_active("2019-01-15", "A1234")
+        self.assertEqual([promotion.category for promotion in active], ["BOGO"])
+        active = self.model.find_active(productid="A1234")
+        self.assertEqual([promotion.category for promotion in active], ["dollar"])
+        self.assertEqual(len(self.model.find_active()), 2)
+        self.model.rebuild_indexes()
+        self.assertEqual(len(self.model.find_active("2999-01-01")), 2)
+        self.assertRaises(DataValidationError, self.model.find_active, "soon")
+
+    def test_sweep_expired(self):
+        """ Sweep away the Promotions that have expired """
+        self.model("A1234", "BOGO", True, "20", expires="2019-01-01").save()
+        self.model("A1234", "dollar", True, "5", expires="2999-01-01").save()
+        self.model("B4321", "dollar", True, "5").save()
+        self.assertEqual(len(self.model.find_expired("2020-01-01T00:00:00Z")), 1)
+        self.assertEqual(self.model.sweeper.sweep(), 1)
+        promotions = self.model.all()
+        self.assertEqual(len(promotions), 2)
+        self.assertEqual(sorted(promotion.category for promotion in promotions), ["dollar", "dollar"])
+        self.assertEqual(self.model.find_by_category("BOGO"), [])
+        self.assertEqual(self.model.sweeper.sweep(), 0)
+
     def test_find_by_productid(self):
         """ Find a Promotion by Productid """
-        Promotion("A1234", "BOGO", True, "20").save()
-        Promotion("B4321", "dollar", False, "5").save()
-        promotions = Promotion.find_by_productid("A1234")
+        self.model("A1234", "BOGO", True, "20").save()
+        self.model("B4321", "dollar", False, "5").save()
+        promotions = self.model.find_by_productid("A1234")
         self.assertNotEqual(len(promotions), 0)
         self.assertEqual(promotions[0].category, "BOGO")
         self.assertEqual(promotions[0].productid, "A1234")
 
     def test_find_by_category(self):
         """ Find a Promotion by Category """
-        Promotion("A1234", "BOGO", True, "20").save()
-        Promotion("B4321", "dollar", False, "5").save()
-        promotions = Promotion.find_by_category("dollar")
+        self.model("A1234", "BOGO", True, "20").save()
+        self.model("B4321", "dollar", False, "5").save()
+        promotions = self.model.find_by_category("dollar")
         self.assertNotEqual(len(promotions), 0)
         self.assertEqual(promotions[0].category, "dollar")
         self.assertEqual(promotions[0].productid, "B4321")
 
+    def test_find_by_category_ignores_case(self):
+        """ Find Promotions by Category in any case or by its prefix """
+        self.model("A1234", "Summer Sale", True, "20").save()
+        self.model("B4321", " summer ", True, "5").save()
+        self.model("C1111", "Sunday", True, "5").save()
+        promotions = self.model.find_by_category("SUMMER")
+        self.assertEqual([promotion.productid for promotion in promotions], ["B4321"])
+        promotions = self.model.find_by_category_prefix("Summ")
+        self.assertEqual(sorted(promotion.productid for promotion in promotions), ["A1234", "B4321"])
+        self.assertEqual(len(self.model.find_by_category_prefix("su")), 3)
+        self.assertEqual(self.model.complete_category("SU"), ["summer", "Summer Sale", "Sunday"])
+
     def test_find_by_availability(self):
         """ Find a Promotion by Availability """
-        Promotion("A1234", "BOGO", True, "20").save()
-        Promotion("B4321", "dollar", False, "5").save()
-        promotions = Promotion.find_by_availability(True)
+        self.model("A1234", "BOGO", True, "20").save()
+        self.model("B4321", "dollar", False, "5").save()
+        promotions = self.model.find_by_availability(True)
         self.assertEqual(len(promotions), 1)
         self.assertEqual(promotions[0].productid, "A1234")
 
     def test_find_by_discount(self):
         """ Find a Promotion by Discount """
-        Promotion("A1234", "BOGO", True, "20").save()
-        Promotion("B4321", "dollar", False, "5").save()
-        promotions = Promotion.find_by_discount("20")
+        self.model("A1234", "BOGO", True, "20").save()
+        self.model("B4321", "dollar", False, "5").save()
+        promotions = self.model.find_by_discount("20")
         self.assertEqual(len(promotions), 1)
         self.assertEqual(promotions[0].productid, "A1234")
 
+    def test_find_by_discount_number(self):
+        """ Find a Promotion by the number in its discount """
+        self.model("A1234", "sale", True, "10.0").save()
+        self.model("B4321", "sale", True, "$10").save()
+        self.model("C1111", "sale", True, "5%").save()
+        self.assertEqual(len(self.model.find_by_discount("10")), 2)
+        promotions = self.model.find_by_discount("$10")
+        self.assertEqual([promotion.productid for promotion in promotions], ["B4321"])
+        self.assertEqual(promotions[0].discount_type, "amount")
+
+    def test_find_by_discount_range(self):
+        """ Find Promotions in a discount range sorted by discount """
+        self.model("A1234", "Percentage", True, "20").save()
+        self.model("B4321", "dollar", True, "5").save()
+        self.model("C1111", "Percentage", True, "50").save()
+        self.model("D2222", "sale", True, "lots").save()
+        promotions = self.model.find_by_discount_range(discount_min=5, sort="-discount")
+        self.assertEqual([p.productid for p in promotions], ["C1111", "A1234", "B4321"])
+        promotions = self.model.find_by_discount_range(discount_max=20, discount_type="percent",
+                                                      sort="discount")
+        self.assertEqual([p.productid for p in promotions], ["A1234"])
+        self.assertRaises(DataValidationError, self.model.find_by_discount_range, sort="category")
+
+    def test_find_top(self):
+        """ Find the best discounts of a category as they change """
+        self.model("A1234", "Percentage", True, "20").save()
+        self.model("B4321", "percentage", True, "50").save()
+        self.model("C1111", "Percentage", False, "90").save()
+        cheap = self.model("D2222", "Percentage", True, "10")
+        cheap.save()
+        promotions = self.model.find_top("PERCENTAGE", 2)
+        self.assertEqual([promotion.productid for promotion in promotions], ["B4321", "A1234"])
+        cheap.discount = "60"
+        cheap.save()
+        promotions = self.model.find_top("percentage", 2)
+        self.assertEqual([promotion.productid for promotion in promotions], ["D2222", "B4321"])
+        cheap.delete()
+        self.model.update_where({'productid': 'A1234'}, {'available': False})
+        promotions = self.model.find_top("percentage", 5)
+        self.assertEqual([promotion.productid for promotion in promotions], ["B4321"])
+        self.assertRaises(DataValidationError, self.model.find_top, "percentage", 0)
+        self.assertRaises(DataValidationError, self.model.find_top, "percentage", 1000)
+
+    def test_find_top_skips_windows(self):
+        """ Leave Promotions that have ended or not yet started out of the best discounts """
+        self.model("A1234", "BOGO", True, "90", end="2019-01-01").save()
+        self.model("B4321", "BOGO", True, "80", start="2999-01-01").save()
+        self.model("C1111", "BOGO", True, "20", start="2019-01-01").save()
+        self.model("D2222", "BOGO", True, "10").save()
+        promotions = self.model.find_top("bogo", 2)
+        self.assertEqual([promotion.productid for promotion in promotions], ["C1111", "D2222"])
+        self.assertTrue(promotions[0].is_active())
+        self.assertFalse(promotions[0].is_active("2018-01-01T00:00:00Z"))
+
+    def test_find_by_filter(self):
+        """ Find Promotions with an AND/OR/NOT filter on the bitmaps """
+        self.model("A1234", "BOGO", True, "20").save()
+        self.model("B4321", "bogo", False, "50").save()
+        self.model("C1111", "Dollar", True, "5").save()
+        expression = 'category:bogo AND NOT available:false'
+        loading = self.model.find_by_filter(expression)   # may run before the bitmaps are built
+        self.assertEqual([promotion.productid for promotion in loading], ["A1234"])
+        self.model.rebuild_indexes()
+        promotions = self.model.find_by_filter(expression)
+        self.assertEqual([promotion.productid for promotion in promotions], ["A1234"])
+        self.model("D2222", "Bogo", True, "10").save()
+        promotions = self.model.find_by_filter('(category:bogo OR discount:0-10) AND available:true')
+        self.assertEqual(sorted(promotion.productid for promotion in promotions),
+                         ["A1234", "C1111", "D2222"])
+        self.assertEqual(len(self.model.find_by_filter('available:true', limit=2)), 2)
+        self.assertRaises(DataValidationError, self.model.find_by_filter, 'category:bogo AND')
+
+    def test_slow_query_log(self):
+        """ Slow finder queries are logged with their plan and advised on """
+        self.model("A1234", "BOGO", True, "20").save()
+        self.model.profiler.reset()
+        self.model.profiler.threshold = 0
+        try:
+            self.model.find_by(available=True)
+        finally:
+            self.model.profiler.threshold = 500
+        slow = self.model.profiler.slow_queries()
+        self.assertEqual(slow[0]['selector'], {'available': True})
+        self.assertEqual(slow[0]['results_returned'], 1)
+
+
+class TestPromotions(PromotionModelTests, unittest.TestCase):
+    """ Test Cases for the Cloudant Promotion Model """
+
+    model = Promotion
+
+    def setUp(self):
+        """ Initialize the Cloudant database """
+        Promotion.init_db("test_promotion")
+        Promotion.remove_all()
+
+    def test_update_conflicts_give_up(self):
+        """ Give up on an update that always conflicts """
+        promotion = Promotion("A1234", "BOGO", True, "20")
+        promotion.save()
+        response = MagicMock(status_code=409)
+        with patch('cloudant.document.Document.save', side_effect=HTTPError(response=response)):
+            self.assertRaises(ConflictError, promotion.update)
+
+    def test_count_and_stats(self):
+        """ Count Promotions and summarize their discounts from the views """
+        Promotion("A1234", "BOGO", True, "20").save()
+        Promotion("B4321", "bogo", False, "50").save()
+        Promotion("C1111", "Dollar", True, "5").save()
+        self.assertEqual(Promotion.count(update='true'), 3)
+        self.assertEqual(Promotion.count('category', 'Bogo', update='true'), 2)
+        self.assertEqual(Promotion.count('available', False, update='true'), 1)
+        stats = Promotion.stats(update='true')
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['discount']['max'], 50)
+        stats = Promotion.stats('category', stable=True, update='true')
+        self.assertEqual([(row['category'], row['count']) for row in stats],
+                         [('bogo', 2), ('dollar', 1)])
+        self.assertEqual(stats[0]['discount']['avg'], 35)
+        self.assertRaises(DataValidationError, Promotion.stats, 'productid')
+        self.assertRaises(DataValidationError, Promotion.count, update='sometimes')
+
+    def test_read_replica(self):
+        """ Finders read from the SQLite replica while it is current """
+        Promotion("A1234", "BOGO", True, "20").save()
+        folder = tempfile.mkdtemp()
+        Promotion.replica = SQLiteReplica(Promotion.database, os.path.join(folder, 'replica.db'))
+        try:
+            while Promotion.replica.sync():
+                pass
+            Promotion("B4321", "bogo", True, "50").save()     # read your own writes
+            reads = metrics.get('replica.reads')
+            promotions = Promotion.find_by_category("BOGO")
+            self.assertEqual(sorted(promotion.productid for promotion in promotions),
+                             ["A1234", "B4321"])
+            self.assertEqual(metrics.get('replica.reads'), reads + 1)
+            Promotion.replica.caught_up -= Promotion.replica.max_lag + 1
+            self.assertEqual(len(Promotion.find_by_category("BOGO")), 2)  # from Cloudant
+            self.assertEqual(metrics.get('replica.reads'), reads + 1)
+        finally:
+            Promotion.replica = None
+            shutil.rmtree(folder)
+
+    def test_migrate_fields(self):
+        """ Backfill the derived fields of older documents """
+        Promotion.database.create_document({"productid": "A1234", "category": "dollar",
+                                            "available": True, "discount": "5"})
+        self.assertEqual(Promotion.find_by_discount_range(), [])
+        summary = Promotion.migrate_fields()
+        self.assertEqual(summary['updated'], 1)
+        promotions = Promotion.find_by_discount_range()
+        self.assertEqual(promotions[0].discount_value, 5.0)
+        self.assertEqual(Promotion.find_by_category("Dollar")[0].productid, "A1234")
+        self.assertEqual(Promotion.migrate_fields()['matched'], 0)
+
+    def test_slow_query_advice(self):
+        """ Slow queries without a matching index get an index suggested """
+        Promotion("A1234", "BOGO", True, "20").save()
+        Promotion.profiler.reset()
+        Promotion.profiler.threshold = 0
+        try:
+            Promotion.find_by(available=True)
+        finally:
+            Promotion.profiler.threshold = 500
+        self.assertIn('available', [advice['fields'][0] for advice in Promotion.profiler.advise()])
+
     def test_create_query_index(self):
         """ Test create query index """
         Promotion("A1234", "BOGO", True, "20").save()
@@ -271,6 +580,114 @@ class TestPromotions(unittest.TestCase):
         self.assertRaises(AssertionError, Promotion.init_db, 'test_promotion')
 
 
+class TestFilterSelector(unittest.TestCase):
+    """ Test Cases for the selectors of the category, productid and discount filters """
+
+    def test_selector_for(self):
+        """ Filters match on the derived fields """
+        self.assertEqual(selector_for({'category': ' BOGO', 'productid': 'A1234'}),
+                         {'category_key': 'bogo', 'productid': 'A1234'})
+        self.assertEqual(selector_for({'discount': '10%'}),
+                         {'discount_value': 10.0, 'discount_type': 'percent'})
+        self.assertEqual(selector_for({'discount': 'lots', 'category': None}),
+                         {'discount': 'lots'})
+
+    def test_selector_before_migration(self):
+        """ Documents without the derived fields match as they were written """
+        selector = selector_for({'category': 'BOGO', 'discount': '10'}, migrated=False)
+        self.assertEqual(selector['$and'][0]['$or'],
+                         [{'category_key': 'bogo'},
+                          {'category_key': {'$exists': False}, 'category': 'BOGO'}])
+        self.assertEqual(selector['$and'][1]['$or'][1],
+                         {'discount_value': {'$exists': False}, 'discount': '10'})
+
+    def test_scan_finds_unmigrated_documents(self):
+        """ Rebuilding the indexes notices documents without the derived fields """
+        old = {'_id': '1', 'productid': 'A1234', 'category': 'BOGO', 'discount': '20'}
+        new = dict(old, _id='2', category_key='bogo', discount_value=20.0, discount_type=None)
+        for documents, migrated in (([new, old], False), ([new], True)):
+            with patch.object(Promotion, 'scan', return_value=iter(documents)), \
+                 patch.object(Promotion, 'windows'), patch.object(Promotion, 'categories'), \
+                 patch.object(Promotion, 'bitmaps'), patch.object(Promotion, 'productids'), \
+                 patch.object(Promotion, 'indexes_ready'), \
+                 patch.object(Promotion, 'fields_migrated', not migrated):
+                Promotion.productids.rebuild.side_effect = list
+                Promotion.rebuild_indexes()
+                self.assertEqual(Promotion.fields_migrated, migrated)
+
+    def test_active_selectors(self):
+        """ Once migrated the active windows are range queries on productid and start """
+        at = '2019-01-15T00:00:00Z'
+        with patch.object(Promotion, 'find_by', return_value=[]) as find_by, \
+             patch.object(Promotion, 'fields_migrated', True):
+            Promotion.query_active(at, 'A1234')
+            Promotion.query_active(at)
+        starts = [call[1]['start'] for call in find_by.call_args_list]
+        self.assertEqual(starts, [None, {'$gt': None, '$lte': at}] * 2)
+        self.assertEqual([call[1]['productid'] for call in find_by.call_args_list],
+                         ['A1234', 'A1234', {'$gt': None}, {'$gt': None}])
+        for call in find_by.call_args_list:
+            self.assertNotIn('$and', call[1])
+
+
+class TestIndexInvalidation(unittest.TestCase):
+    """ Test Cases for the in memory indexes after a flush from the invalidation bus """
+
+    def setUp(self):
+        self.patches = [patch.object(Promotion, 'cache', MagicMock()),
+                        patch.object(Promotion, 'results', MagicMock()),
+                        patch.object(Promotion, 'start_rebuild')]
+        for patcher in self.patches:
+            patcher.start()
+        Promotion.indexes_ready = True
+        Promotion.index_document({'_id': '1', 'productid': 'A1234', 'category': 'BOGO',
+                                  'available': True, 'discount': '20'})
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        Promotion.indexes_ready = False
+        Promotion.unindex_document('1')
+
+    def test_flush_rebuilds_windows(self):
+        """ A flush falls back to Cloudant and rebuilds instead of emptying the windows """
+        Promotion.invalidate([], ['*'])
+        self.assertFalse(Promotion.indexes_ready)
+        Promotion.start_rebuild.assert_called_once_with()
+        self.assertEqual(Promotion.windows.active('2999-01-01T00:00:00Z', 'A1234'), ['1'])
+        with patch.object(Promotion, 'query_active', return_value=['found']) as query_active:
+            self.assertEqual(Promotion.find_active('2999-01-01'), ['found'])
+        query_active.assert_called_once_with('2999-01-01T00:00:00Z', None)
+
+    def test_flush_keeps_bitmaps(self):
+        """ A flush scans for filters until the bitmaps are rebuilt, and keeps them meanwhile """
+        Promotion.invalidate([], ['*'])
+        self.assertEqual(Promotion.bitmaps.select(parse_filter('category:bogo')), ['1'])
+        bogo = Promotion("A1234", "BOGO", True, "20")
+        with patch.object(Promotion, 'all', return_value=[bogo]) as scan:
+            self.assertEqual(Promotion.find_by_filter('category:bogo'), [bogo])
+        scan.assert_called_once_with()
+
+    def test_flush_keeps_categories(self):
+        """ A flush keeps autocompleting categories while the trie is rebuilt """
+        Promotion.invalidate([], ['*'])
+        self.assertIn('BOGO', Promotion.complete_category('bo'))
+
+    def test_productid_miss_needs_connected_bus(self):
+        """ A productid filter miss is only trusted while the bus is connected """
+        Promotion.productids.rebuild(['A1234'])
+        bus = MagicMock(connected=True)
+        with patch.object(Promotion, 'bus', bus), \
+             patch.object(Promotion, 'find_by', return_value=['found']) as find_by:
+            self.assertEqual(Promotion.find_by_productid('Z9999'), [])
+            find_by.assert_not_called()
+            bus.connected = False
+            self.assertEqual(Promotion.find_by_productid('Z9999'), ['found'])
+        with patch.object(Promotion, 'bus', None), \
+             patch.object(Promotion, 'find_by', return_value=['found']):
+            self.assertEqual(Promotion.find_by_productid('Z9999'), ['found'])
+
+
         
 ##    @patch.dict(os.environ, {'VCAP_SERVICES': json.dumps(VCAP_SERVICES).encode('utf8')})
 #    @patch.dict(os.environ, {'VCAP_SERVICES': VCAP_SERVICES})
@@ -0,0 +1,179 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Promotion Model that uses SQLite
+
+The backend agnostic cases come from test_promotions.PromotionModelTests;
+the ones here cover what only the SQLite store does.
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+from app.models_sqlite import Promotion, query_plan
+from app.models import DataValidationError
+from test_promotions import PromotionModelTests
+
+logger = logging.getLogger(__name__)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSQLitePromotions(PromotionModelTests, unittest.TestCase):
+    """ Test Cases for the SQLite Promotion Model """
+
+    model = Promotion
+
+    def setUp(self):
+        """ Initialize a SQLite database in a temporary folder """
+        self.folder = tempfile.mkdtemp()
+        Promotion.init_db(os.path.join(self.folder, 'test_promotion'))
+        Promotion.sweeper.stop()
+        Promotion.remove_all()
+
+    def tearDown(self):
+        Promotion.disconnect()
+        shutil.rmtree(self.folder)
+
+    def test_update_revisions(self):
+        """ Every update takes the next revision """
+        promotion = Promotion("A1234", "BOGO", True, "20")
+        promotion.save()
+        promotion.category = "Percentage"
+        promotion.save()
+        promotions = Promotion.all()
+        self.assertEqual(len(promotions), 1)
+        self.assertEqual(promotions[0].category, "Percentage")
+        self.assertEqual(Promotion.fetch_document(promotion.id)['_rev'][:2], '2-')
+        self.assertEqual(Promotion.find_by_category("BOGO"), [])
+
+    def test_finders(self):
+        """ Find Promotions by their fields """
+        Promotion("A1234", "BOGO", True, "20").save()
+        Promotion("A1234", "Dollar", True, "$5").save()
+        Promotion("B4321", "dollar", False, "10%").save()
+        self.assertEqual(len(Promotion.find_by_productid("A1234")), 2)
+        self.assertEqual(len(Promotion.find_by_category("DOLLAR")), 2)
+        self.assertEqual(len(Promotion.find_by_category_prefix("do")), 2)
+        self.assertEqual(len(Promotion.find_by_availability(False)), 1)
+        self.assertEqual([p.category for p in Promotion.find_by_discount("10%")], ["dollar"])
+        promotions = Promotion.find_by_productids(["A1234", "C9999"])
+        self.assertEqual(len(promotions["A1234"]), 2)
+        self.assertEqual(promotions["C9999"], [])
+        ranged = Promotion.find_by_discount_range(5, 20, sort='-discount')
+        self.assertEqual([p.discount for p in ranged], ["20", "10%", "$5"])
+        self.assertRaises(DataValidationError, Promotion.find_by_discount_range, sort='name')
+        self.assertEqual(Promotion.complete_category("d"), ["Dollar"])
+        self.assertEqual(len(Promotion.find_by_filter("category:dollar AND available:true")), 1)
+
+    def test_count_and_stats(self):
+        """ Count the Promotions and summarize their discounts """
+        Promotion("A1234", "BOGO", True, "20").save()
+        Promotion("A5678", "bogo", False, "10").save()
+        Promotion("B4321", "dollar", True, "5").save()
+        self.assertEqual(Promotion.count(), 3)
+        self.assertEqual(Promotion.count('category', 'Bogo'), 2)
+        self.assertEqual(Promotion.count('available', False), 1)
+        stats = Promotion.stats()
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['discount']['sum'], 35)
+        groups = Promotion.stats('available')
+        self.assertEqual([group['available'] for group in groups], [False, True])
+        self.assertEqual(groups[1]['discount']['avg'], 12.5)
+        self.assertRaises(DataValidationError, Promotion.stats, 'color')
+
+    def test_bulk_writes(self):
+        """ Create many Promotions in one transaction and refuse stale revisions """
+        promotions = [Promotion("P{}".format(i), "BOGO", True, str(i)) for i in range(10)]
+        self.assertEqual(Promotion.create_many(promotions), [])
+        self.assertEqual(Promotion.count(), 10)
+        errors = Promotion.create_many([promotions[0]])
+        self.assertEqual(errors[0]['error'], 'conflict')
+        stale = Promotion.fetch_document(promotions[1].id)
+        Promotion.patch(promotions[1].id, {'available': False})
+        self.assertEqual(Promotion.write_page([dict(stale, discount='50')], [stale]), 0)
+        self.assertEqual(Promotion.delete_many([stale]), 0)
+        self.assertEqual(Promotion.delete_many([Promotion.fetch_document(promotions[1].id)]), 1)
+        self.assertEqual(Promotion.count(), 9)
+
+    def test_pages_and_changes(self):
+        """ Stream the Promotions in pages and read the changes since a sequence """
+        promotions = [Promotion("P{}".format(i), "BOGO", True, "5") for i in range(7)]
+        Promotion.create_many(promotions)
+        pages = list(Promotion.pages_where({'category': 'BOGO'}, 3))
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(len(list(Promotion.scan(batch_size=2))), 7)
+        since = Promotion.update_seq()
+        promotions[0].delete()
+        promotions[1].available = False
+        promotions[1].save()
+        changes = list(Promotion.changes_since(since))
+        self.assertEqual(changes[0], {'_id': promotions[0].id, '_deleted': True})
+        self.assertEqual(changes[1]['available'], False)
+        self.assertRaises(DataValidationError, list, Promotion.changes_since('now'))
+
+    def test_remove_all_keeps_seq(self):
+        """ Removing everything moves the seq on and reports the deletions """
+        promotion = Promotion("A1234", "BOGO", True, "5")
+        promotion.save()
+        since = Promotion.update_seq()
+        Promotion.remove_all()
+        self.assertTrue(Promotion.update_seq() > since)
+        self.assertEqual(list(Promotion.changes_since(since)),
+                         [{'_id': promotion.id, '_deleted': True}])
+        self.assertEqual(Promotion.all(), [])
+
+    def test_query_plans(self):
+        """ The finders use the indexes and their plans are captured """
+        self.assertEqual(query_plan('SELECT', [(2, 0, 0, 'SCAN promotions')])['index']['name'],
+                         '_all_docs')
+        with Promotion.profiler.capture() as queries:
+            Promotion.find_top("bogo", 5)
+            Promotion.find_by_discount_range(10, 20, 'percent')
+            Promotion.find_expired("2020-01-01T00:00:00Z")
+        self.assertEqual([query['index'] for query in queries],
+                         ['category_discount', 'discount_type_value', 'expires'])
+
+    def test_bulk_speed(self):
+        """ Import and query many Promotions quickly """
+        categories = ['bogo', 'dollar', 'percentage', 'summer']
+        started = time.time()
+        for start in range(0, 20000, 1000):
+            Promotion.create_many([Promotion("P{}".format(number), categories[number % 4],
+                                             number % 3 != 0, str(number % 60))
+                                   for number in range(start, start + 1000)])
+        writes = time.time() - started
+        started = time.time()
+        for number in range(200):
+            self.assertEqual(len(Promotion.find_by_productid("P{}".format(number * 7))), 1)
+        reads = time.time() - started
+        top = Promotion.find_top("summer", 10)
+        self.assertEqual(set(promotion.discount_value for promotion in top), set([59]))
+        logger.info('20000 writes in %.3fs, 200 reads in %.3fs', writes, reads)
+        self.assertLess(writes / 20000, 0.001)
+        self.assertLess(reads / 200, 0.005)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
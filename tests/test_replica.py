@@ -0,0 +1,177 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+SQLite Read Replica Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock
+from app.replica import SQLiteReplica, UnsupportedQuery, where_clause, generation
+
+def change(doc_id, rev, **fields):
+    """ Returns one row of a changes feed """
+    doc = dict(fields, _id=doc_id, _rev=rev)
+    return {'id': doc_id, 'changes': [{'rev': rev}], 'doc': doc}
+
+class FakeReplica(SQLiteReplica):
+    """ A replica fed from a list of changes instead of Cloudant """
+
+    def __init__(self, path, feed, **kwargs):
+        self.feed = feed
+        self.requests = []
+        SQLiteReplica.__init__(self, None, path, **kwargs)
+
+    def _changes(self, since):
+        self.requests.append(since)
+        start = int(since or 0)
+        results = self.feed[start:start + self.batch_size]
+        return {'results': results, 'last_seq': start + len(results),
+                'pending': max(0, len(self.feed) - start - len(results))}
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSQLiteReplica(unittest.TestCase):
+    """ Test Cases for the SQLite read replica """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'replica.db')
+        self.feed = [
+            change('a', '1-a', productid='A1234', category='BOGO', available=True, discount='20'),
+            change('b', '1-b', productid='B4321', category='Percentage', available=False,
+                   discount='50'),
+            change('c', '1-c', productid='C1111', category='Dollar', available=True, discount='5'),
+            {'id': '_design/stats', 'changes': [{'rev': '1-d'}], 'doc': {'_id': '_design/stats'}}
+        ]
+        self.replica = FakeReplica(self.path, self.feed, batch_size=2, max_lag=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def sync_all(self):
+        """ Applies the whole feed """
+        while self.replica.sync():
+            pass
+
+    def test_where_clause(self):
+        """ Selectors are turned into SQL """
+        sql, params = where_clause({'category_key': 'bogo', 'discount_value': {'$gte': 10}})
+        self.assertEqual(sql, '("category_key" = ? AND "discount_value" >= ?)')
+        self.assertEqual(params, ['bogo', 10])
+        sql, params = where_clause({'$or': [{'productid': {'$in': ['A', 'B']}},
+                                            {'expires': {'$exists': False}}]})
+        self.assertEqual(sql, '((("productid" IN (?, ?)) OR ("expires" IS NULL)))')
+        self.assertRaises(UnsupportedQuery, where_clause, {'color': 'red'})
+        self.assertRaises(UnsupportedQuery, where_clause, {'category': {'$regex': '^B'}})
+
+    def test_generation(self):
+        """ The generation is the number before the dash of a revision """
+        self.assertEqual(generation('12-abc'), 12)
+        self.assertEqual(generation(None), 0)
+
+    def test_sync(self):
+        """ The feed is applied in batches and checkpointed """
+        self.assertFalse(self.replica.usable())
+        self.assertEqual(self.replica.sync(), 2)
+        self.assertFalse(self.replica.usable())     # still behind
+        self.assertEqual(self.replica.sync(), 1)    # the design document is skipped
+        self.assertTrue(self.replica.usable())
+        self.assertEqual(self.replica.checkpoint(), 4)
+        self.assertEqual(self.replica.get('a')['productid'], 'A1234')
+        self.assertIsNone(self.replica.get('_design/stats'))
+        # a new replica on the same file carries on from the checkpoint
+        replica = FakeReplica(self.path, self.feed, batch_size=2)
+        replica.sync()
+        self.assertEqual(replica.requests, [4])
+        self.assertEqual(len(replica.all()), 3)
+
+    def test_select(self):
+        """ Finder selectors run against the replica """
+        self.sync_all()
+        ids = [doc['_id'] for doc in self.replica.select({'available': True})]
+        self.assertEqual(sorted(ids), ['a', 'c'])
+        docs = self.replica.select({'discount_value': {'$type': 'number'}},
+                                   [{'discount_value': 'desc'}])
+        self.assertEqual([doc['_id'] for doc in docs], ['b', 'a', 'c'])
+        docs = self.replica.select({'category_key': {'$gte': 'b', '$lt': 'c'}})
+        self.assertEqual([doc['_id'] for doc in docs], ['a'])
+        self.assertEqual(self.replica.get_many(['a', 'x']), {'a': self.replica.get('a'), 'x': None})
+
+    def test_revisions(self):
+        """ An older change never replaces a newer write """
+        self.replica.put({'_id': 'a', '_rev': '2-a', 'productid': 'A1234', 'category': 'BOGO',
+                          'available': False, 'discount': '30'})
+        self.sync_all()     # the feed still has 1-a
+        self.assertEqual(self.replica.get('a')['discount'], '30')
+        self.replica.delete('a')
+        self.assertIsNone(self.replica.get('a'))
+        self.feed.append({'id': 'b', 'changes': [{'rev': '2-b'}], 'doc': None, 'deleted': True})
+        self.sync_all()
+        self.assertEqual([doc['_id'] for doc in self.replica.all()], ['c'])
+
+    def test_lag_bound(self):
+        """ The replica is only usable while it is within its lag bound """
+        self.sync_all()
+        self.assertTrue(self.replica.lag() < 5)
+        self.replica.caught_up -= 10
+        self.assertFalse(self.replica.usable())
+
+    def test_clear(self):
+        """ Clearing removes the documents but keeps the checkpoint """
+        self.sync_all()
+        self.replica.clear()
+        self.assertEqual(self.replica.all(), [])
+        self.assertEqual(self.replica.checkpoint(), 4)
+
+    def test_one_syncer(self):
+        """ Only the worker holding the lock syncs; the lock is renewed while held """
+        redis = MagicMock()
+        replica = FakeReplica(self.path, self.feed, redis=redis)
+        redis.set.return_value = True
+        self.assertTrue(replica._elected())
+        redis.set.return_value = None
+        redis.get.return_value = replica.owner
+        self.assertTrue(replica._elected())
+        redis.expire.assert_called_once_with(replica.lock_key, 30)
+        redis.get.return_value = 'other:1'
+        self.assertFalse(replica._elected())
+
+    def test_readers_do_not_write(self):
+        """ Without the lock the replica is read only and reads its writes from Cloudant """
+        self.sync_all()
+        reader = FakeReplica(self.path, self.feed, redis=MagicMock())
+        self.assertTrue(reader.usable())
+        self.assertEqual(reader.connection().execute('PRAGMA query_only').fetchone(), (1,))
+        reader.put({'_id': 'd', '_rev': '1-d', 'productid': 'D2222'})
+        self.assertIsNone(reader.get('d'))
+        self.assertFalse(reader.usable())
+        self.feed.append(change('d', '1-d', productid='D2222'))
+        self.sync_all()
+        self.assertEqual(reader.get('d')['productid'], 'D2222')
+        self.assertTrue(reader.usable())
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
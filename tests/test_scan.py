@@ -0,0 +1,92 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Parallel Scan Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import uuid
+import unittest
+from requests import HTTPError
+from app.scan import ParallelScanner, key_ranges
+
+class FakeDatabase(object):
+    """ Just enough of a Cloudant database to answer _all_docs """
+
+    def __init__(self, ids):
+        self.ids = sorted(ids)
+        self.requests = 0
+        self.fail = False
+
+    def doc_count(self):
+        return len(self.ids)
+
+    def all_docs(self, limit, include_docs, startkey, endkey, inclusive_end):
+        self.requests += 1
+        if self.fail:
+            raise HTTPError()
+        rows = [{'id': doc_id, 'doc': {'_id': doc_id}} for doc_id in self.ids
+                if startkey <= doc_id < endkey][:limit]
+        return {'rows': rows}
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestParallelScanner(unittest.TestCase):
+    """ Test Cases for parallel key range scans """
+
+    def setUp(self):
+        self.ids = [uuid.uuid4().hex for _ in range(500)] + ['_design/promotions', 'custom']
+        self.database = FakeDatabase(self.ids)
+        self.scanner = ParallelScanner(self.database, workers=4, splits=16, page_size=20)
+
+    def test_key_ranges(self):
+        """ Key ranges are contiguous and cover everything """
+        ranges = key_ranges(16)
+        self.assertEqual(len(ranges), 16)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+
+    def test_ordered_scan(self):
+        """ An ordered scan returns every document in id order """
+        ids = [doc['_id'] for doc in self.scanner.scan()]
+        expected = sorted(i for i in self.ids if not i.startswith('_design/'))
+        self.assertEqual(ids, expected)
+
+    def test_unordered_scan(self):
+        """ An unordered scan returns every document once """
+        ids = [doc['_id'] for doc in self.scanner.scan(ordered=False)]
+        expected = sorted(i for i in self.ids if not i.startswith('_design/'))
+        self.assertEqual(sorted(ids), expected)
+
+    def test_small_database(self):
+        """ A database smaller than a page is read with one request """
+        scanner = ParallelScanner(FakeDatabase(['a', 'b']), page_size=20)
+        self.assertEqual(len(list(scanner.scan())), 2)
+        self.assertEqual(scanner.database.requests, 1)
+
+    def test_scan_failure(self):
+        """ Errors from a range are raised to the caller """
+        self.database.fail = True
+        self.assertRaises(HTTPError, list, self.scanner.scan())
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Prefix Search Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import unittest
+from app.search import PrefixTrie, normalize, prefix_range, PREFIX_END
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSearch(unittest.TestCase):
+    """ Normalized and prefix search tests """
+
+    def test_normalize(self):
+        """ Trim and lowercase text """
+        self.assertEqual(normalize('  Summer Sale '), 'summer sale')
+        self.assertIsNone(normalize(None))
+
+    def test_prefix_range(self):
+        """ Make a Cloudant Query range for a prefix """
+        self.assertEqual(prefix_range(' Sum'), {'$gte': 'sum', '$lt': 'sum' + PREFIX_END})
+
+    def test_complete(self):
+        """ Complete a prefix in alphabetical order """
+        trie = PrefixTrie()
+        for value in ['Summer', 'summer', 'Sunday', 'BOGO', 'Sum', 'Dollar', None, '']:
+            trie.add(value)
+        self.assertEqual(len(trie), 5)
+        self.assertEqual(trie.complete('su'), ['Sum', 'Summer', 'Sunday'])
+        self.assertEqual(trie.complete('SU', limit=2), ['Sum', 'Summer'])
+        self.assertEqual(trie.complete('x'), [])
+        self.assertEqual(len(trie.complete('')), 5)
+        self.assertIn('bogo', trie)
+        self.assertNotIn('bog', trie)
+        trie.clear()
+        self.assertEqual(trie.complete(''), [])
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
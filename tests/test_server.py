@@ -19,8 +19,10 @@ Test cases can be run with the following:
 nosetests -v --with-spec --spec-color
 """
 
+import time
 import unittest
 import logging
+from mock import patch
 from werkzeug.datastructures import MultiDict, ImmutableMultiDict
 #import json
 from app import server
@@ -28,11 +30,13 @@ from app import server
 # Status Codes
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
+HTTP_202_ACCEPTED = 202
 HTTP_204_NO_CONTENT = 204
 HTTP_400_BAD_REQUEST = 400
 HTTP_404_NOT_FOUND = 404
 HTTP_405_METHOD_NOT_ALLOWED = 405
 HTTP_409_CONFLICT = 409
+HTTP_413_REQUEST_ENTITY_TOO_LARGE = 413
 HTTP_415_UNSUPPORTED_MEDIA_TYPE = 415
 
 ######################################################################
@@ -174,6 +178,110 @@ class TestPromotionServer(unittest.TestCase):
         resp = self.app.post('/promotions', json=new_promotion, content_type='application/json')
         self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
 
+    def test_import_promotions(self):
+        """ Import Promotions from NDJSON """
+        promotion_count = self.get_promotion_count()
+        data = '{"productid": "C1111", "category": "Dollar", "available": true, "discount": "5"}\n' \
+               '{"productid": "D2222", "category": "BOGO", "available": true, "discount": "10"}\n'
+        resp = self.app.post('/promotions/import', data=data,
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(resp.get_json()['imported'], 2)
+        self.assertEqual(self.get_promotion_count(), promotion_count + 2)
+
+    @patch('app.server.IMPORT_INLINE_MAX_BYTES', 10)
+    def test_import_promotions_too_large(self):
+        """ Import Promotions that belong in a background job """
+        data = '{"productid": "C1111", "category": "Dollar", "available": true, "discount": "5"}\n'
+        resp = self.app.post('/promotions/import', data=data,
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_import_promotions_wrong_content_type(self):
+        """ Import Promotions with the wrong Content-Type """
+        resp = self.app.post('/promotions/import', data='productid', content_type='plain/text')
+        self.assertEqual(resp.status_code, HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_export_promotions(self):
+        """ Export Promotions as NDJSON and then only the changes """
+        resp = self.app.get('/promotions/export')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(len(resp.data.splitlines()), 2)
+        seq = resp.headers.get('X-Export-Seq')
+        self.assertIsNotNone(seq)
+        server.data_load({"productid": "C1111", "category": "Dollar", "available": True, "discount": "5"})
+        resp = self.app.get('/promotions/export', query_string={'since': seq})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertIn('C1111', resp.data)
+        self.assertNotIn('A1234', resp.data)
+
+    def test_export_promotions_bad_format(self):
+        """ Export Promotions in an unknown format """
+        resp = self.app.get('/promotions/export', query_string='format=xml')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_lookup_promotions(self):
+        """ Look up many Promotions by ids and productids """
+        promotion = self.get_promotion('A1234')[0]
+        data = {'ids': [promotion['_id'], '0'], 'productids': ['B4321', 'Z0000']}
+        resp = self.app.post('/promotions/_lookup', json=data, content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        results = resp.get_json()
+        self.assertEqual(results['ids'][promotion['_id']]['productid'], 'A1234')
+        self.assertIsNone(results['ids']['0'])
+        self.assertEqual(results['productids']['B4321'][0]['category'], 'Percentage')
+        self.assertEqual(results['productids']['Z0000'], [])
+
+    def test_lookup_bad_keys(self):
+        """ Look up keys that are not strings or a body that is not an object """
+        for data in ({'ids': [['A1234']]}, {'productids': [{'id': 1}]}, {'ids': [1]}, ['A1234']):
+            resp = self.app.post('/promotions/_lookup', json=data, content_type='application/json')
+            self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_lookup_too_many_keys(self):
+        """ Look up more keys than allowed """
+        data = {'ids': [str(i) for i in range(server.LOOKUP_MAX_KEYS + 1)]}
+        resp = self.app.post('/promotions/_lookup', json=data, content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_evaluate_bad_body(self):
+        """ Price a body that is not an object or has a price that is not finite """
+        for data in ([{'productid': 'B4321', 'price': 10}],
+                     {'lines': [{'productid': 'B4321', 'price': 'NaN'}]}):
+            resp = self.app.post('/promotions/evaluate', json=data,
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_evaluate_cart(self):
+        """ Price cart lines with their best Promotion """
+        lines = [{'productid': 'B4321', 'price': 10, 'qty': 2},
+                 {'productid': 'Z0000', 'price': 3, 'qty': 1}]
+        resp = self.app.post('/promotions/evaluate', json={'lines': lines},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        result = resp.get_json()
+        self.assertEqual(result['lines'][0][2:], [20.0, 10.0, 10.0])
+        self.assertIsNone(result['lines'][1][1])
+        self.assertEqual(result['total'], 13.0)
+
+    def test_evaluate_skips_inactive(self):
+        """ Price lines without the Promotions that have ended or not yet started """
+        server.data_load({"productid": "E5555", "category": "Percentage", "available": True,
+                          "discount": "50", "end": "2019-01-01"})
+        server.data_load({"productid": "E5555", "category": "Percentage", "available": True,
+                          "discount": "40", "start": "2999-01-01"})
+        resp = self.app.post('/promotions/evaluate',
+                             json={'lines': [{'productid': 'E5555', 'price': 10}]},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(resp.get_json()['savings'], 0)
+
+    def test_evaluate_bad_lines(self):
+        """ Price cart lines that are missing a price """
+        resp = self.app.post('/promotions/evaluate', json={'lines': [{'productid': 'A1234'}]},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
     def test_create_promotion_no_content_type(self):
         """ Create a Promotion with no Content-Type """
         resp = self.app.post('/promotions', data="new_promotion")
@@ -214,6 +322,47 @@ class TestPromotionServer(unittest.TestCase):
         query_item = data[0]
         self.assertEqual(query_item['productid'], 'A1234')
 
+    def test_query_active_at(self):
+        """ Query the Promotions active at a time """
+        server.data_load({"productid": "A1234", "category": "dollar", "available": True,
+                          "discount": "5", "start": "2000-01-01", "end": "2000-02-01"})
+        resp = self.app.get('/promotions', query_string='active_at=2000-01-15&productid=A1234')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 2)
+        resp = self.app.get('/promotions', query_string='active_at=&productid=A1234')
+        self.assertEqual(len(resp.get_json()), 1)
+        resp = self.app.get('/promotions', query_string='active_at=someday')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_query_by_discount_range(self):
+        """ Query Promotions by a discount range sorted by discount """
+        server.data_load({"productid": "C1111", "category": "Percentage", "available": True,
+                          "discount": "30.0%"})
+        resp = self.app.get('/promotions', query_string='discount_min=25&sort=-discount')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([item['productid'] for item in data], ['B4321', 'C1111'])
+        self.assertEqual(data[0]['discount_value'], 50.0)
+        self.assertEqual(data[0]['discount_type'], 'percent')
+        resp = self.app.get('/promotions', query_string='discount_max=30&discount_type=percent')
+        self.assertEqual([item['productid'] for item in resp.get_json()], ['C1111'])
+        resp = self.app.get('/promotions', query_string='discount=30')
+        self.assertEqual([item['productid'] for item in resp.get_json()], ['C1111'])
+        resp = self.app.get('/promotions', query_string='discount_min=lots')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/promotions', query_string='sort=productid')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_query_by_category_after_write(self):
+        """ Query a category again after a write to it with other spacing or case """
+        resp = self.app.get('/promotions', query_string='category=%20Summer%20')
+        self.assertEqual(resp.get_json(), [])
+        server.data_load({"productid": "S1111", "category": "SUMMER ", "available": True,
+                          "discount": "15"})
+        resp = self.app.get('/promotions', query_string='category=%20Summer%20')
+        self.assertEqual([item['productid'] for item in resp.get_json()], ['S1111'])
+
     def test_query_by_category(self):
         """ Query Promotions by category """
         resp = self.app.get('/promotions', query_string='category=BOGO')
@@ -225,6 +374,73 @@ class TestPromotionServer(unittest.TestCase):
         query_item = data[0]
         self.assertEqual(query_item['category'], 'BOGO')
 
+    def test_query_by_category_prefix(self):
+        """ Query Promotions by the start of their category """
+        resp = self.app.get('/promotions', query_string='category_prefix=perc')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([item['productid'] for item in data], ['B4321'])
+
+    def test_top_promotions(self):
+        """ Get the best discounts of a category """
+        server.data_load({"productid": "C1111", "category": "Percentage", "available": True,
+                          "discount": "70"})
+        resp = self.app.get('/promotions/top', query_string='category=percentage&n=1')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual([item['productid'] for item in resp.get_json()], ['C1111'])
+        resp = self.app.get('/promotions/top', query_string='n=1')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/promotions/top', query_string='category=BOGO&n=1000')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_query_by_filter(self):
+        """ Query Promotions with a filter expression """
+        resp = self.app.get('/promotions', query_string={'filter': 'category:bogo OR discount:50-100'})
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(sorted(item['productid'] for item in resp.get_json()), ['A1234', 'B4321'])
+        resp = self.app.get('/promotions', query_string={'filter': 'NOT'})
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_complete_categories(self):
+        """ Autocomplete category names """
+        resp = self.app.get('/promotions/categories', query_string='prefix=b')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(resp.get_json(), ['BOGO'])
+        resp = self.app.get('/promotions/categories', query_string='limit=many')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_promotion_stats(self):
+        """ Get counts and discount statistics by category """
+        resp = self.app.get('/promotions/stats', query_string='group=category&update=true')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(sorted((row['category'], row['count']) for row in resp.get_json()),
+                         [('bogo', 1), ('percentage', 1)])
+        resp = self.app.get('/promotions/stats', query_string='group=discount')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/promotions/stats', query_string='stable=maybe')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_count_promotions(self):
+        """ Count Promotions with a HEAD request """
+        resp = self.app.head('/promotions', query_string='update=true')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(resp.headers['X-Total-Count'], '2')
+        self.assertEqual(resp.data, '')
+        resp = self.app.head('/promotions', query_string='category=bogo&update=true')
+        self.assertEqual(resp.headers['X-Total-Count'], '1')
+
+    def test_explain_query(self):
+        """ Get the query plan of a list query """
+        resp = self.app.get('/promotions', query_string='category=bogo&explain=1')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data['results'], 1)
+        self.assertEqual(data['queries'][0]['selector'], {'category_key': 'bogo'})
+        self.assertIn('index', data['queries'][0]['plan'])
+        resp = self.app.get('/queries')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertIn('advice', resp.get_json())
+
     def test_query_by_available(self):
         """ Query Promotions by availability """
         resp = self.app.get('/promotions', query_string='available=true')
@@ -261,6 +477,88 @@ class TestPromotionServer(unittest.TestCase):
         resp_json = resp.get_json()
         self.assertIn('not found', resp_json['message'])
 
+    def test_patch_promotion(self):
+        """ Change the discount of a Promotion """
+        promotion = self.get_promotion('A1234')[0]
+        resp = self.app.patch('/promotions/{}'.format(promotion['_id']), json={'discount': '30'},
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data['discount'], '30')
+        self.assertEqual(data['category'], 'BOGO')
+
+    def test_patch_promotion_not_found(self):
+        """ Patch a Promotion that doesn't exist """
+        resp = self.app.patch('/promotions/0', json={'discount': '30'},
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_404_NOT_FOUND)
+
+    def test_patch_promotion_bad_field(self):
+        """ Patch a field that can't be changed """
+        promotion = self.get_promotion('A1234')[0]
+        resp = self.app.patch('/promotions/{}'.format(promotion['_id']), json={'_id': 'x'},
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_cancel_by_category(self):
+        """ Cancel every Promotion in a category """
+        resp = self.app.put('/promotions/cancel', query_string='category=BOGO')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(resp.get_json()['updated'], 1)
+        promotion = self.get_promotion('A1234')[0]
+        self.assertEqual(promotion['available'], False)
+        self.assertEqual(self.get_promotion('B4321')[0]['available'], True)
+
+    def test_cancel_by_category_ignores_case(self):
+        """ Cancel matches the category the way the finders do """
+        resp = self.app.put('/promotions/cancel', query_string='category=%20bogo')
+        self.assertEqual(resp.status_code, HTTP_200_OK)
+        self.assertEqual(resp.get_json()['updated'], 1)
+        self.assertEqual(self.get_promotion('A1234')[0]['available'], False)
+
+    def test_cancel_by_category_in_background(self):
+        """ Cancel a large match set with a background job """
+        server.data_load({"productid": "C1111", "category": "BOGO", "available": True, "discount": "10"})
+        limit = server.BULK_INLINE_LIMIT
+        server.BULK_INLINE_LIMIT = 1
+        try:
+            resp = self.app.put('/promotions/cancel', query_string='category=BOGO')
+        finally:
+            server.BULK_INLINE_LIMIT = limit
+        self.assertEqual(resp.status_code, HTTP_202_ACCEPTED)
+        job_url = resp.headers.get('Location')
+        for _ in range(50):
+            job = self.app.get(job_url).get_json()
+            if job['state'] == 'finished':
+                break
+            time.sleep(0.1)
+        self.assertEqual(job['result']['updated'], 2)
+
+    def test_reindex_job(self):
+        """ Run a reindex job in the background """
+        resp = self.app.post('/jobs/reindex')
+        self.assertEqual(resp.status_code, HTTP_202_ACCEPTED)
+        job_url = resp.headers.get('Location')
+        for _ in range(50):
+            job = self.app.get(job_url).get_json()
+            if job['state'] in ('finished', 'failed'):
+                break
+            time.sleep(0.1)
+        self.assertEqual(job['state'], 'finished')
+        self.assertEqual(job['name'], 'reindex')
+
+    def test_unknown_job(self):
+        """ Start a job that doesn't exist """
+        resp = self.app.post('/jobs/defrag')
+        self.assertEqual(resp.status_code, HTTP_404_NOT_FOUND)
+        resp = self.app.get('/jobs/0')
+        self.assertEqual(resp.status_code, HTTP_404_NOT_FOUND)
+
+    def test_cancel_without_filters(self):
+        """ Cancel without any filter """
+        resp = self.app.put('/promotions/cancel')
+        self.assertEqual(resp.status_code, HTTP_400_BAD_REQUEST)
+
     def test_reset_promotion_data(self):
         resp = self.app.delete('/promotions/reset',content_type='application/json')
         self.assertEqual(resp.status_code, HTTP_204_NO_CONTENT)
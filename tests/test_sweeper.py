@@ -0,0 +1,114 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Expiry Sweeper Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import unittest
+from mock import MagicMock
+from app.sweeper import Sweeper
+from app.metrics import metrics
+
+
+class MemoryModel(object):
+    """ Stands in for the Promotion class with documents in a dictionary """
+
+    def __init__(self, expires):
+        self.documents = dict((str(i), {'_id': str(i), '_rev': '1', 'expires': value})
+                              for i, value in enumerate(expires))
+        self.conflicts = set()
+
+    def doc_count(self):
+        return len(self.documents)
+
+    def find_expired(self, at, limit):
+        expired = sorted((document for document in self.documents.values()
+                          if document['expires'] and document['expires'] <= at),
+                         key=lambda document: document['expires'])
+        return expired[:limit]
+
+    def delete_many(self, documents):
+        deleted = 0
+        for document in documents:
+            if document['_id'] not in self.conflicts:
+                del self.documents[document['_id']]
+                deleted += 1
+        return deleted
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSweeper(unittest.TestCase):
+    """ Expiry sweeper tests """
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_sweep_in_batches(self):
+        """ Delete every expired document a batch at a time """
+        model = MemoryModel(['2019-01-01T00:00:00Z'] * 5 + ['2999-01-01T00:00:00Z', None])
+        sweeper = Sweeper(model, batch_size=2)
+        self.assertEqual(sweeper.sweep(), 5)
+        self.assertEqual(len(model.documents), 2)
+        self.assertEqual(metrics.get('sweeper.runs'), 1)
+        self.assertEqual(metrics.get('sweeper.deleted'), 5)
+        self.assertEqual(metrics.get('documents.count'), 2)
+        self.assertEqual(metrics.get('documents.count_delta'), 0)
+
+    def test_count_trend(self):
+        """ Report the change in document count between sweeps """
+        model = MemoryModel(['2019-01-01T00:00:00Z'])
+        sweeper = Sweeper(model)
+        sweeper.sweep()
+        model.documents['new'] = {'_id': 'new', '_rev': '1', 'expires': None}
+        model.documents['other'] = {'_id': 'other', '_rev': '1', 'expires': None}
+        self.assertEqual(sweeper.sweep(), 0)
+        self.assertEqual(metrics.get('documents.count'), 2)
+        self.assertEqual(metrics.get('documents.count_delta'), 2)
+        self.assertEqual(metrics.get('sweeper.last_deleted'), 0)
+
+    def test_conflicts_wait_for_next_sweep(self):
+        """ Stop sweeping when every expired document conflicts """
+        model = MemoryModel(['2019-01-01T00:00:00Z'] * 3)
+        model.conflicts.update(['0', '1', '2'])
+        self.assertEqual(Sweeper(model, batch_size=3).sweep(), 0)
+        self.assertEqual(len(model.documents), 3)
+
+    def test_only_elected_worker_sweeps(self):
+        """ Skip the sweep when another worker holds the lock """
+        model = MemoryModel(['2019-01-01T00:00:00Z'])
+        redis = MagicMock()
+        redis.set.return_value = None
+        self.assertEqual(Sweeper(model, redis=redis).sweep(), 0)
+        self.assertEqual(len(model.documents), 1)
+        redis.set.return_value = True
+        self.assertEqual(Sweeper(model, redis=redis).sweep(), 1)
+
+    def test_forced_sweep_skips_election(self):
+        """ An on demand sweep runs even while another worker holds the lock """
+        model = MemoryModel(['2019-01-01T00:00:00Z'])
+        redis = MagicMock()
+        redis.set.return_value = None
+        self.assertEqual(Sweeper(model, redis=redis).sweep(force=True), 1)
+        redis.set.assert_not_called()
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Top N Index Test Suite
+
+Test cases can be run with the following:
+nosetests -v --with-spec --spec-color
+"""
+
+import time
+import random
+import logging
+import unittest
+from app.top import TopIndex
+
+logger = logging.getLogger(__name__)
+
+
+def best(promotions, category, n):
+    """ Returns the ids of the best n in a category the slow way """
+    ranked = sorted((-value, promotion_id) for promotion_id, (cat, value)
+                    in promotions.items() if cat == category and value is not None)
+    return [promotion_id for _, promotion_id in ranked[:n]]
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestTopIndex(unittest.TestCase):
+    """ Top N index tests """
+
+    def setUp(self):
+        self.index = TopIndex(capacity=3)
+
+    def test_unloaded_category(self):
+        """ Ask for a category that hasn't been loaded """
+        self.index.add('1', 'bogo', 10)
+        self.assertIsNone(self.index.top('bogo', 1))
+        self.assertNotIn('bogo', self.index)
+
+    def test_add_and_discard(self):
+        """ Keep a loaded category up to date """
+        self.index.load('bogo', [('1', 10), ('2', 20)], self.index.version('bogo'))
+        self.assertEqual(self.index.top('bogo', 5), ['2', '1'])
+        self.index.add('3', 'bogo', 15)
+        self.index.add('1', 'bogo', None)   # cancelled
+        self.assertEqual(self.index.top('bogo', 5), ['2', '3'])
+        self.index.discard('2')
+        self.assertEqual(self.index.top('bogo', 5), ['3'])
+
+    def test_overflow_needs_reload(self):
+        """ Reload a category after its best were pushed out and deleted """
+        self.index.load('bogo', [], self.index.version('bogo'))
+        for promotion_id, value in [('1', 10), ('2', 20), ('3', 30), ('4', 40)]:
+            self.index.add(promotion_id, 'bogo', value)
+        self.assertEqual(self.index.top('bogo', 3), ['4', '3', '2'])
+        self.index.discard('4')
+        self.assertIsNone(self.index.top('bogo', 3))
+        self.assertEqual(self.index.top('bogo', 2), ['3', '2'])
+        self.assertEqual(self.index.ranked('bogo', 1), ['3', '2'])
+        self.assertIsNone(self.index.ranked('bogo', 3))
+
+    def test_racing_load_is_ignored(self):
+        """ Ignore a load when the category was written to while reading """
+        version = self.index.version('bogo')
+        self.index.add('1', 'bogo', 10)
+        self.index.load('bogo', [], version)
+        self.assertNotIn('bogo', self.index)
+        self.index.load('bogo', [('1', 10)], self.index.version('bogo'))
+        self.index.forget(['bogo'])
+        self.assertNotIn('bogo', self.index)
+
+    def test_write_churn(self):
+        """ Stay correct and fast under heavy write churn """
+        index = TopIndex(capacity=50)
+        promotions = {}
+        categories = ['cat{}'.format(i) for i in range(20)]
+        for category in categories:
+            index.load(category, [], index.version(category))
+        random.seed(42)
+        started = time.time()
+        operations = 50000
+        for _ in range(operations):
+            promotion_id = str(random.randint(0, 5000))
+            if random.random() < 0.2:
+                promotions.pop(promotion_id, None)
+                index.discard(promotion_id)
+            else:
+                category = random.choice(categories)
+                value = random.choice([None] + range(1, 100))
+                promotions[promotion_id] = (category, value)
+                index.add(promotion_id, category, value)
+        writes = time.time() - started
+        started = time.time()
+        for category in categories:
+            ids = index.top(category, 10)
+            if ids is None:     # reload the way Promotion.load_top does
+                index.load(category, [(promotion_id, promotions[promotion_id][1])
+                                      for promotion_id in best(promotions, category, 50)],
+                           index.version(category))
+                ids = index.top(category, 10)
+            self.assertEqual([promotions[i][1] for i in ids],
+                             [promotions[i][1] for i in best(promotions, category, 10)])
+        reads = time.time() - started
+        logger.info('%d writes in %.3fs, %d reads in %.3fs',
+                    operations, writes, len(categories), reads)
+        self.assertLess(writes / operations, 0.001)
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()